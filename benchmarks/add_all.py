@@ -0,0 +1,68 @@
+# Compare the startup time of Watcher.add_all with the os.walk based
+# implementation it replaced.
+
+# Usage: python benchmarks/add_all.py [number of directories] [fanout]
+
+from __future__ import print_function
+
+import inotify
+from inotify import watcher
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+
+def make_tree(root, ndirs, fanout=10):
+    '''Create ndirs directories below root, fanout directories per level.'''
+    queue = [root]
+    made = 0
+    while made < ndirs:
+        parent = queue.pop(0)
+        for i in range(min(fanout, ndirs - made)):
+            path = os.path.join(parent, 'd%d' % i)
+            os.mkdir(path)
+            queue.append(path)
+            made += 1
+
+
+def legacy_add_all(w, path, mask):
+    '''The os.walk based add_all of python-inotify 0.6.'''
+    submask = mask | inotify.IN_ONLYDIR
+    watches = [w.add(path, mask)]
+    for root, dirs, names in os.walk(path, topdown=False):
+        for d in dirs:
+            try:
+                watches.append(w.add(root + '/' + d, submask))
+            except OSError as err:
+                if err.errno not in w.ignored_errors:
+                    raise
+    return watches
+
+
+def measure(add_all, root):
+    w = watcher.Watcher()
+    try:
+        start = time.time()
+        n = len(add_all(w, root, inotify.IN_ALL_EVENTS))
+        return n, time.time() - start
+    finally:
+        w.close()
+
+
+def main(ndirs=10000, fanout=10):
+    root = tempfile.mkdtemp(prefix='inotify-bench-')
+    try:
+        make_tree(root, ndirs, fanout)
+        for name, add_all in [('legacy', legacy_add_all),
+                              ('add_all', watcher.Watcher.add_all)]:
+            n, elapsed = measure(add_all, root)
+            print('{:8} {:8d} watches {:8.3f}s {:10.0f} watches/s'.format(
+                name, n, elapsed, n / elapsed))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
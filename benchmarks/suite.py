@@ -0,0 +1,311 @@
+# Benchmark suite for python-inotify.
+
+# Generates synthetic filesystem churn in a temporary directory and measures
+# read throughput, add_all startup time, Python memory per watch and per
+# event, and the queue overflow threshold. Read throughput is also measured
+# on the simulated backend, without the kernel's cost, as is the peak memory
+# of reading a large queue at once or streaming it. Results are printed as
+# a table, or as JSON with --json so runs can be compared with --compare.
+
+# Usage: python benchmarks/suite.py [--quick] [--json FILE] [--compare FILE]
+
+from __future__ import print_function, division
+
+import inotify
+from inotify import _inotify, watcher
+from inotify.backend import SimulatedBackend
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+# The scripts in this directory are run directly, so it is on sys.path
+from add_all import make_tree
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+_clock = getattr(time, 'perf_counter', time.time)
+
+# Events per churn round, kept below the default max_queued_events of 16384
+# so the rounds measure reading and not overflowing.
+ROUND_EVENTS = 12000
+
+
+def package_version():
+    '''Return the version of the installed python-inotify distribution,
+    or None if there is no package metadata, e.g. in a source tree.'''
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+    try:
+        return version('python-inotify')
+    except PackageNotFoundError:
+        return None
+
+
+def churn(directory, nevents):
+    '''Generate about nevents IN_OPEN/IN_CLOSE_WRITE events in directory.'''
+    for i in range(nevents // 2):
+        os.close(os.open(os.path.join(directory, 'f%d' % (i % 64)),
+                         os.O_WRONLY | os.O_CREAT))
+
+
+def max_queued_events():
+    try:
+        with open('/proc/sys/fs/inotify/max_queued_events') as f:
+            return int(f.read())
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def bench_read(tmp, rounds):
+    '''Events per second read through _inotify.read and Watcher.read.'''
+    results = {}
+    mask = inotify.IN_OPEN | inotify.IN_CLOSE_WRITE
+
+    fd = _inotify.init()
+    try:
+        _inotify.add_watch(fd, tmp, mask)
+        buf = bytearray(64 * 1024)
+        count = elapsed = 0
+        for i in range(rounds):
+            churn(tmp, ROUND_EVENTS)
+            start = _clock()
+            while True:
+                events = _inotify.read(fd, block=False, buffer=buf)
+                if not events:
+                    break
+                count += len(events)
+            elapsed += _clock() - start
+        results['raw_read_events_per_s'] = count / elapsed
+    finally:
+        os.close(fd)
+
+    w = watcher.Watcher()
+    try:
+        w.add(tmp, mask)
+        count = elapsed = 0
+        for i in range(rounds):
+            churn(tmp, ROUND_EVENTS)
+            start = _clock()
+            while True:
+                events = w.read(block=False)
+                if not events:
+                    break
+                count += len(events)
+            elapsed += _clock() - start
+        results['watcher_read_events_per_s'] = count / elapsed
+    finally:
+        w.close()
+    return results
+
+
+def bench_add_all(tmp, sizes):
+    '''add_all wall time for trees of several sizes.'''
+    results = {}
+    for ndirs in sizes:
+        root = tempfile.mkdtemp(dir=tmp)
+        try:
+            make_tree(root, ndirs)
+            w = watcher.Watcher()
+            try:
+                start = _clock()
+                w.add_all(root, inotify.IN_ALL_EVENTS)
+                results[str(ndirs)] = _clock() - start
+            finally:
+                w.close()
+        finally:
+            shutil.rmtree(root)
+    return {'add_all_seconds': results}
+
+
+def bench_memory(tmp, ndirs):
+    '''Bytes of Python memory allocated per watch and per event.'''
+    if tracemalloc is None:
+        return {}
+    results = {}
+    root = tempfile.mkdtemp(dir=tmp)
+    make_tree(root, ndirs)
+    w = watcher.Watcher()
+    try:
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        w.add_all(root, inotify.IN_OPEN | inotify.IN_CLOSE_WRITE)
+        results['bytes_per_watch'] = \
+            (tracemalloc.get_traced_memory()[0] - before) / w.num_watches()
+
+        churn(root, ROUND_EVENTS)
+        kept = []
+        before = tracemalloc.get_traced_memory()[0]
+        while True:
+            events = w.read(block=False)
+            if not events:
+                break
+            kept.extend(events)
+        results['bytes_per_event'] = \
+            (tracemalloc.get_traced_memory()[0] - before) / len(kept)
+        del kept
+    finally:
+        tracemalloc.stop()
+        w.close()
+        shutil.rmtree(root)
+    return results
+
+
+def bench_overflow(tmp):
+    '''Number of events queued before the kernel reports an overflow.'''
+    limit = max_queued_events()
+    results = {'max_queued_events': limit}
+    if limit is None:
+        return results
+    w = watcher.Watcher()
+    try:
+        w.add(tmp, inotify.IN_OPEN | inotify.IN_CLOSE_WRITE)
+        churn(tmp, limit + 1000)
+        received = 0
+        overflowed = False
+        while not overflowed:
+            events = w.read(block=False)
+            if not events:
+                break
+            for evt in events:
+                if evt.q_overflow:
+                    overflowed = True
+                    break
+                received += 1
+        results['events_before_overflow'] = received if overflowed else None
+    finally:
+        w.close()
+    return results
+
+
+def bench_simulated(rounds):
+    '''Events per second read by Watcher and AutoWatcher from the simulated
+    backend, which measures the library's own overhead without the cost of
+    the kernel and the filesystem.'''
+    results = {}
+    for cls in (watcher.Watcher, watcher.AutoWatcher):
+        sim = SimulatedBackend(seed=0)
+        sim.make_tree('root', depth=3, fanout=4, files=4)
+        w = cls(backend=sim)
+        try:
+            w.add_all('root', inotify.IN_MODIFY | inotify.IN_MOVE)
+            count = elapsed = 0
+            for i in range(rounds):
+                sim.churn(ROUND_EVENTS, renames=0.01)
+                start = _clock()
+                count += len(w.read(block=False))
+                elapsed += _clock() - start
+            key = 'simulated_{}_read_events_per_s'.format(cls.__name__.lower())
+            results[key] = count / elapsed
+        finally:
+            w.close()
+    return results
+
+
+def bench_streaming(nevents):
+    '''Peak Python memory and time to the first event when nevents events
+    are queued, for read() and iter_events() on the simulated backend.'''
+    if tracemalloc is None:
+        return {}
+    results = {}
+    for method in ('read', 'iter_events'):
+        sim = SimulatedBackend(max_queued_events=nevents + 1)
+        sim.mkdir('root')
+        w = watcher.Watcher(backend=sim)
+        try:
+            w.add('root', inotify.IN_CREATE)
+            for i in range(nevents):
+                sim.create('root/f%d' % i)
+            tracemalloc.start()
+            start = _clock()
+            first = None
+            if method == 'read':
+                for evt in w.read(block=False):
+                    if first is None:
+                        first = _clock() - start
+            else:
+                for evt in w.iter_events(block=False):
+                    if first is None:
+                        first = _clock() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            results[method + '_peak_bytes'] = peak
+            results[method + '_first_event_seconds'] = first
+        finally:
+            w.close()
+    return {'streaming': results}
+
+
+def run(quick=False):
+    tmp = tempfile.mkdtemp(prefix='inotify-bench-')
+    try:
+        results = {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'inotify': package_version(),
+            }
+        results.update(bench_read(tmp, 2 if quick else 10))
+        results.update(bench_add_all(
+            tmp, [100, 1000] if quick else [100, 1000, 10000, 50000]))
+        results.update(bench_memory(tmp, 1000 if quick else 10000))
+        results.update(bench_overflow(tmp))
+        results.update(bench_simulated(2 if quick else 10))
+        results.update(bench_streaming(100000 if quick else 1000000))
+        return results
+    finally:
+        shutil.rmtree(tmp)
+
+
+def flatten(results, prefix=''):
+    for key, value in sorted(results.items()):
+        if isinstance(value, dict):
+            for item in flatten(value, prefix + key + '.'):
+                yield item
+        else:
+            yield prefix + key, value
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark python-inotify.')
+    parser.add_argument('--quick', action='store_true',
+                        help='run smaller workloads')
+    parser.add_argument('--json', metavar='FILE',
+                        help="write the results as JSON to FILE, '-' for stdout")
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare with the results in a JSON file')
+    args = parser.parse_args()
+
+    results = run(args.quick)
+    old = {}
+    if args.compare:
+        with open(args.compare) as f:
+            old = dict(flatten(json.load(f)))
+
+    if args.json:
+        if args.json == '-':
+            json.dump(results, sys.stdout, indent=2, sort_keys=True)
+            print()
+        else:
+            with open(args.json, 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+    if args.json != '-':
+        for key, value in flatten(results):
+            line = '{:40} {}'.format(key, value)
+            if isinstance(value, (int, float)) and \
+                    isinstance(old.get(key), (int, float)) and old[key]:
+                line += '  ({:+.1%})'.format(value / old[key] - 1)
+            print(line)
+
+
+if __name__ == '__main__':
+    main()
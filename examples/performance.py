@@ -13,9 +13,8 @@
 
 from __future__ import print_function
 
-from inotify import watcher
+from inotify import watcher, stages
 import inotify
-import select
 import sys
 
 w = watcher.AutoWatcher()
@@ -35,40 +34,21 @@ for path in paths:
 if not w.num_watches():
     sys.exit(1)
 
-poll = select.poll()
-poll.register(w, select.POLLIN)
+# Coalesce similar events before passing them up to a higher level.
 
-timeout = None
+# For example, it's overwhelmingly common to have a stream of inotify
+# events contain a creation, followed by multiple modifications of the
+# created file. The Coalescer recognises this pattern (and others) and
+# folds these events into a single creation event, which reduces the
+# number of trips into our app's presumably more computationally
+# expensive upper layers.
 
-threshold = watcher.Threshold(w, 512)
+coalescer = stages.Coalescer(w)
 
-while True:
-    events = poll.poll(timeout)
-    nread = 0
-    if threshold() or not events:
-        print('reading,', threshold.readable(), 'bytes available')
-        for evt in w.read(0):
-            nread += 1
+# iter_batches waits until 512 bytes of events are queued, or until a
+# second has passed since the first event arrived, before it reads.
 
-            # The last thing to do to improve efficiency here would be
-            # to coalesce similar events before passing them up to a
-            # higher level.
-
-            # For example, it's overwhelmingly common to have a stream
-            # of inotify events contain a creation, followed by
-            # multiple modifications of the created file.
-
-            # Recognising this pattern (and others) and coalescing
-            # these events into a single creation event would reduce
-            # the number of trips into our app's presumably more
-            # computationally expensive upper layers.
-
-            print(repr(evt.fullpath), ' | '.join(inotify.decode_mask(evt.mask)))
-    if nread:
-        print('plugging back in')
-        timeout = None
-        poll.register(w, select.POLLIN)
-    else:
-        print('unplugging,', threshold.readable(), 'bytes available')
-        timeout = 1000
-        poll.unregister(w)
+for events in w.iter_batches(min_bytes=512, max_latency=1.0):
+    print('read', len(events), 'events')
+    for evt in coalescer.process(events):
+        print(repr(evt.fullpath), ' | '.join(inotify.decode_mask(evt.mask)))
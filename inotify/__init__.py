@@ -50,7 +50,15 @@ max_user_watches = _read_procfs_value('max_user_watches')
 
 from . import _inotify as inotify
 from .in_constants import constants, event_properties, watch_properties, decode_mask
-from .watcher import Watcher, AutoWatcher, Threshold, NoFilesException
+from .watcher import (Watcher, AutoWatcher, AsyncWatcher, ShardedWatcher,
+                      BufferedWatcher, Threshold, NoFilesException,
+                      InotifyWatcherException)
+from .stages import (Stage, Coalescer, MoveEvent, MovePairer, MergedEvent,
+                     Debouncer)
+from .budget import WatchBudget
+from .backend import KernelBackend, SimulatedBackend
+# inotify.dispatch and inotify.journal are not imported here, as they load
+# multiprocessing and pickle. Import them explicitly to use them.
 globals().update(constants)
 
 
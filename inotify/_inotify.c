@@ -13,15 +13,25 @@
  * License greater than 2.1. 
  */
 
+#define PY_SSIZE_T_CLEAN
 #include <Python.h>
+#include <structmember.h>
 #include <alloca.h>
+#include <limits.h>
 #include <sys/inotify.h>
 #include <stdint.h>
 #include <sys/ioctl.h>
+#include <sys/stat.h>
+#include <dirent.h>
+#include <errno.h>
+#include <fnmatch.h>
+#include <poll.h>
+#include <stdlib.h>
+#include <string.h>
+#include <time.h>
 #include <unistd.h>
 
-/* This should be at least large enough to hold a single
- * inotify_event, otherwise crashes can occur. */
+/* Size of the buffer read() allocates if the caller does not pass one in. */
 #define READ_BUF_SIZE 64*1024
 
 /* for older pythons */
@@ -40,8 +50,36 @@
 		 __typeof__ (b) _b = (b); \
 	 _a < _b ? _a : _b; })
 
+#define max(a,b) \
+ ({ __typeof__ (a) _a = (a); \
+		 __typeof__ (b) _b = (b); \
+	 _a > _b ? _a : _b; })
+
 #define INE_SIZE sizeof(struct inotify_event)
 
+/* A read buffer must be able to hold the largest possible inotify_event,
+ * otherwise the kernel refuses to return it. */
+#define MIN_BUF_SIZE (INE_SIZE + NAME_MAX + 1)
+
+/* Layout of the array of unsigned 64 bit counters that read() updates */
+enum {
+	STAT_SYSCALLS,		/* read system calls */
+	STAT_BYTES,			/* bytes read */
+	STAT_EVENTS,		/* events returned */
+	STAT_BLOCK_NS,		/* nanoseconds spent in ioctl and read */
+	STAT_DECODE_NS,		/* nanoseconds spent creating events */
+	STAT_MASK_BITS,		/* 32 counters of returned events per mask bit */
+	READ_STATS_SIZE = STAT_MASK_BITS + 32
+};
+
+static uint64_t clock_ns(void)
+{
+	struct timespec ts;
+
+	clock_gettime(CLOCK_MONOTONIC, &ts);
+	return (uint64_t) ts.tv_sec * 1000000000 + ts.tv_nsec;
+}
+
 
 static PyObject *init(PyObject *self, PyObject *args)
 {
@@ -169,6 +207,238 @@ PyDoc_STRVAR(
 	"Removing a watch causes an IN_IGNORED event to be generated for this\n"
 	"watch descriptor.");
 
+/* Growable array of (path, value) pairs, used by add_tree() to collect its
+ * results while the GIL is released. */
+struct path_list {
+	struct path_item {
+		char *path;
+		int value;
+		int walk;
+	} *items;
+	size_t len, cap;
+};
+
+static int path_list_append(struct path_list *l, char *path, int value, int walk)
+{
+	if (l->len == l->cap) {
+		size_t cap = l->cap ? l->cap * 2 : 64;
+		struct path_item *items = realloc(l->items, cap * sizeof(*items));
+		if (items == NULL)
+			return -1;
+		l->items = items;
+		l->cap = cap;
+	}
+	l->items[l->len].path = path;
+	l->items[l->len].value = value;
+	l->items[l->len].walk = walk;
+	l->len++;
+	return 0;
+}
+
+static void path_list_free(struct path_list *l)
+{
+	size_t i;
+
+	for (i = 0; i < l->len; i++)
+		free(l->items[i].path);
+	free(l->items);
+}
+
+static char *join_path(const char *dir, const char *name)
+{
+	size_t dlen = strlen(dir), nlen = strlen(name);
+	char *path = malloc(dlen + nlen + 2);
+
+	if (path == NULL)
+		return NULL;
+	memcpy(path, dir, dlen);
+	if (dlen == 0 || dir[dlen - 1] != '/')
+		path[dlen++] = '/';
+	memcpy(path + dlen, name, nlen + 1);
+	return path;
+}
+
+/*
+ * Walk the directory tree below root and add a watch for every directory
+ * found. Runs without the GIL. Symbolic links to directories are watched
+ * but not descended into. The watched paths and their watch descriptors are
+ * appended to added, failures to errors. Returns -1 if memory runs out.
+ */
+static int walk_tree(int fd, const char *root, uint32_t mask,
+					 struct path_list *added, struct path_list *errors)
+{
+	struct path_list stack = {NULL, 0, 0};
+	char *dir;
+	int ret = 0;
+
+	dir = strdup(root);
+	if (dir == NULL || path_list_append(&stack, dir, 0, 0) == -1) {
+		free(dir);
+		return -1;
+	}
+
+	while (stack.len) {
+		DIR *d;
+		struct dirent *ent;
+
+		dir = stack.items[--stack.len].path;
+		d = opendir(dir);
+		if (d == NULL) {
+			if (path_list_append(errors, dir, errno, 1) == -1)
+				goto nomem;
+			continue;
+		}
+
+		while ((ent = readdir(d)) != NULL) {
+			struct stat st;
+			char *path;
+			int descend, wd;
+
+			if (ent->d_name[0] == '.' && (ent->d_name[1] == '\0' ||
+					(ent->d_name[1] == '.' && ent->d_name[2] == '\0')))
+				continue;
+			if (ent->d_type != DT_DIR && ent->d_type != DT_LNK &&
+					ent->d_type != DT_UNKNOWN)
+				continue;
+
+			path = join_path(dir, ent->d_name);
+			if (path == NULL) {
+				closedir(d);
+				goto nomem;
+			}
+
+			descend = ent->d_type == DT_DIR;
+			if (ent->d_type != DT_DIR) {
+				if (lstat(path, &st) == 0 && S_ISDIR(st.st_mode))
+					descend = 1;
+				else if (stat(path, &st) != 0 || !S_ISDIR(st.st_mode)) {
+					free(path);
+					continue;
+				}
+			}
+
+			wd = inotify_add_watch(fd, path, mask);
+			if (wd == -1) {
+				if (path_list_append(errors, path, errno, 0) == -1) {
+					free(path);
+					closedir(d);
+					goto nomem;
+				}
+				continue;
+			}
+			if (path_list_append(added, path, wd, 0) == -1) {
+				free(path);
+				closedir(d);
+				goto nomem;
+			}
+			if (descend) {
+				char *copy = strdup(path);
+				if (copy == NULL || path_list_append(&stack, copy, 0, 0) == -1) {
+					free(copy);
+					closedir(d);
+					goto nomem;
+				}
+			}
+		}
+		closedir(d);
+		free(dir);
+	}
+	goto done;
+
+nomem:
+	free(dir);
+	ret = -1;
+
+done:
+	path_list_free(&stack);
+	return ret;
+}
+
+static PyObject *path_list_to_python(struct path_list *l, int with_walk)
+{
+	PyObject *ret = PyList_New(l->len);
+	size_t i;
+
+	if (ret == NULL)
+		return NULL;
+
+	for (i = 0; i < l->len; i++) {
+		PyObject *item;
+
+		if (with_walk)
+			item = Py_BuildValue("sii", l->items[i].path, l->items[i].value,
+								 l->items[i].walk);
+		else
+			item = Py_BuildValue("si", l->items[i].path, l->items[i].value);
+		if (item == NULL) {
+			Py_DECREF(ret);
+			return NULL;
+		}
+		PyList_SET_ITEM(ret, i, item);
+	}
+	return ret;
+}
+
+static PyObject *add_tree(PyObject *self, PyObject *args)
+{
+	PyObject *ret = NULL, *pyadded = NULL, *pyerrors = NULL;
+	struct path_list added = {NULL, 0, 0}, errors = {NULL, 0, 0};
+	uint32_t mask;
+	char *path;
+	int fd, r;
+
+	if (!PyArg_ParseTuple(args, "isI:add_tree", &fd, &path, &mask))
+		goto bail;
+
+	Py_BEGIN_ALLOW_THREADS
+	r = walk_tree(fd, path, mask, &added, &errors);
+	Py_END_ALLOW_THREADS
+
+	if (r == -1) {
+		PyErr_NoMemory();
+		goto bail;
+	}
+
+	pyadded = path_list_to_python(&added, 0);
+	if (pyadded == NULL)
+		goto bail;
+	pyerrors = path_list_to_python(&errors, 1);
+	if (pyerrors == NULL)
+		goto bail;
+
+	ret = PyTuple_Pack(2, pyadded, pyerrors);
+	goto done;
+
+bail:
+	Py_CLEAR(ret);
+
+done:
+	Py_XDECREF(pyadded);
+	Py_XDECREF(pyerrors);
+	path_list_free(&added);
+	path_list_free(&errors);
+
+	return ret;
+}
+
+PyDoc_STRVAR(
+	add_tree_doc,
+	"add_tree(fd, path, mask) -> (added, errors)\n"
+	"\n"
+	"Add watches for all directories below path, but not for path itself.\n"
+	"\n"
+	"        fd: file descriptor returned by init()\n"
+	"        path: root of the directory tree to walk\n"
+	"        mask: mask of events to watch for\n"
+	"\n"
+	"The tree is walked and the watches are added without holding the GIL.\n"
+	"Symbolic links to directories are watched, but not descended into.\n"
+	"\n"
+	"Return a list of (path, wd) tuples for the added watches, and a list of\n"
+	"(path, errno, walk) tuples for failures, where walk is true if the\n"
+	"directory could not be listed and false if the watch could not be\n"
+	"added.");
+
 #define bit_name(x) {x, #x}
 
 static struct {
@@ -266,6 +536,14 @@ bail:
 
 static void define_consts(PyObject *dict)
 {
+	define_const(dict, "READ_STATS_SIZE", READ_STATS_SIZE);
+	define_const(dict, "STAT_SYSCALLS", STAT_SYSCALLS);
+	define_const(dict, "STAT_BYTES", STAT_BYTES);
+	define_const(dict, "STAT_EVENTS", STAT_EVENTS);
+	define_const(dict, "STAT_BLOCK_NS", STAT_BLOCK_NS);
+	define_const(dict, "STAT_DECODE_NS", STAT_DECODE_NS);
+	define_const(dict, "STAT_MASK_BITS", STAT_MASK_BITS);
+
 	define_const(dict, "IN_ACCESS", IN_ACCESS);
 	define_const(dict, "IN_MODIFY", IN_MODIFY);
 	define_const(dict, "IN_ATTRIB", IN_ATTRIB);
@@ -295,79 +573,166 @@ static void define_consts(PyObject *dict)
 	define_const(dict, "IN_ALL_EVENTS", IN_ALL_EVENTS);
 }
 
-// the event struct is not really doing anything that couldn't be done with a
-// python named tuple, it should probably be replaced.
+/*
+ * The event type stores the fields of an inotify_event natively, so reading
+ * an event needs a single allocation (plus one for its name, if any). The
+ * watch field is filled in by the higher level watcher.
+ *
+ * Events take part in garbage collection, as the watch refers to its watcher,
+ * which may hold on to events itself, and subclasses may add more references.
+ */
 struct event {
 	PyObject_HEAD
-	PyObject *wd;
-	PyObject *mask;
-	PyObject *cookie;
+	int wd;
+	uint32_t mask;
+	uint32_t cookie;
 	PyObject *name;
+	PyObject *watch;
 };
 
-static PyObject *event_wd(PyObject *self, void *x)
+static PyObject *event_cookie(PyObject *self, void *x)
 {
 	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->wd);
-	return evt->wd;
+	if (!(evt->mask & IN_MOVE))
+		Py_RETURN_NONE;
+	return PyLong_FromUnsignedLong(evt->cookie);
 }
 
-static PyObject *event_mask(PyObject *self, void *x)
+static int event_set_cookie(PyObject *self, PyObject *value, void *x)
 {
 	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->mask);
-	return evt->mask;
-}
+	unsigned long cookie = 0;
 
-static PyObject *event_cookie(PyObject *self, void *x)
-{
-	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->cookie);
-	return evt->cookie;
+	if (value == NULL) {
+		PyErr_SetString(PyExc_AttributeError, "cannot delete cookie");
+		return -1;
+	}
+	if (value != Py_None) {
+		cookie = PyLong_AsUnsignedLong(value);
+		if (cookie == (unsigned long) -1 && PyErr_Occurred())
+			return -1;
+	}
+	evt->cookie = cookie;
+	return 0;
 }
 
-static PyObject *event_name(PyObject *self, void *x)
+static PyObject *event_flag(PyObject *self, void *bit)
 {
 	struct event *evt = (struct event *) self;
-	Py_INCREF(evt->name);
-	return evt->name;
+	return PyLong_FromUnsignedLong(evt->mask & (uint32_t) (uintptr_t) bit);
 }
 
+#define event_flag(name, bit, doc) \
+	{name, event_flag, NULL, doc, (void *) (uintptr_t) (bit)}
+
 static struct PyGetSetDef event_getsets[] = {
-	{"wd", event_wd, NULL,
+	{"cookie", event_cookie, event_set_cookie,
+	 "rename cookie, if rename-related event"},
+	event_flag("access", IN_ACCESS, "File was accessed"),
+	event_flag("modify", IN_MODIFY, "File was modified"),
+	event_flag("attrib", IN_ATTRIB, "Attribute of a directory entry was changed"),
+	event_flag("close", IN_CLOSE, "File was closed"),
+	event_flag("close_write", IN_CLOSE_WRITE,
+			   "File was closed after being written to"),
+	event_flag("close_nowrite", IN_CLOSE_NOWRITE,
+			   "File was closed without being written to"),
+	event_flag("open", IN_OPEN, "File was opened"),
+	event_flag("move", IN_MOVE, "Directory entry was renamed"),
+	event_flag("moved_from", IN_MOVED_FROM,
+			   "Directory entry was renamed from this name"),
+	event_flag("moved_to", IN_MOVED_TO,
+			   "Directory entry was renamed to this name"),
+	event_flag("create", IN_CREATE, "Directory entry was created"),
+	event_flag("delete", IN_DELETE, "Directory entry was deleted"),
+	event_flag("delete_self", IN_DELETE_SELF,
+			   "The watched directory entry was deleted"),
+	event_flag("move_self", IN_MOVE_SELF,
+			   "The watched directory entry was renamed"),
+	event_flag("unmount", IN_UNMOUNT,
+			   "Directory was unmounted, and can no longer be watched"),
+	event_flag("q_overflow", IN_Q_OVERFLOW,
+			   "Kernel dropped events due to queue overflow"),
+	event_flag("ignored", IN_IGNORED,
+			   "Directory entry is no longer being watched"),
+	event_flag("isdir", IN_ISDIR, "Event occurred on a directory"),
+	{NULL}
+};
+
+static struct PyMemberDef event_members[] = {
+	{"wd", T_INT, offsetof(struct event, wd), 0,
 	 "watch descriptor"},
-	{"mask", event_mask, NULL,
+	{"mask", T_UINT, offsetof(struct event, mask), 0,
 	 "event mask"},
-	{"cookie", event_cookie, NULL,
-	 "rename cookie, if rename-related event"},
-	{"name", event_name, NULL,
-	 "file name"},
+	{"name", T_OBJECT, offsetof(struct event, name), 0,
+	 "file name, or None if the event occurred on the watched entry itself"},
+	{"watch", T_OBJECT, offsetof(struct event, watch), 0,
+	 "the watch that generated this event, if known"},
 	{NULL}
 };
 
 PyDoc_STRVAR(
 	event_doc,
-	"event: Structure describing an inotify event.");
+	"event(wd, mask, cookie=None, name=None, watch=None)\n"
+	"\n"
+	"Structure describing an inotify event.");
 
-static PyObject *event_new(PyTypeObject *t, PyObject *a, PyObject *k)
+static PyObject *event_new(PyTypeObject *t, PyObject *args, PyObject *kwds)
 {
-	return (*t->tp_alloc)(t, 0);
+	struct event *evt;
+	PyObject *cookie = Py_None, *name = Py_None, *watch = Py_None;
+	int wd;
+	unsigned int mask;
+
+	static char *kwlist[] = {"wd", "mask", "cookie", "name", "watch", NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "iI|OOO:event", kwlist,
+									 &wd, &mask, &cookie, &name, &watch))
+		return NULL;
+
+	evt = (struct event *) (*t->tp_alloc)(t, 0);
+	if (evt == NULL)
+		return NULL;
+
+	evt->wd = wd;
+	evt->mask = mask;
+	if (event_set_cookie((PyObject *) evt, cookie, NULL) == -1) {
+		Py_DECREF(evt);
+		return NULL;
+	}
+	Py_INCREF(name);
+	evt->name = name;
+	Py_INCREF(watch);
+	evt->watch = watch;
+
+	return (PyObject *) evt;
+}
+
+static int event_traverse(struct event *evt, visitproc visit, void *arg)
+{
+	Py_VISIT(evt->name);
+	Py_VISIT(evt->watch);
+	return 0;
+}
+
+static int event_clear(struct event *evt)
+{
+	Py_CLEAR(evt->name);
+	Py_CLEAR(evt->watch);
+	return 0;
 }
 
 static void event_dealloc(struct event *evt)
 {
-	Py_XDECREF(evt->wd);
-	Py_XDECREF(evt->mask);
-	Py_XDECREF(evt->cookie);
-	Py_XDECREF(evt->name);
+	PyObject_GC_UnTrack(evt);
+	event_clear(evt);
 
 	(Py_TYPE(evt)->tp_free)(evt);
 }
 
 static PyObject *event_repr(struct event *evt)
 {
-	int wd = PyLong_AsLong(evt->wd);
-	uint32_t cookie = evt->cookie == Py_None ? 0 : PyLong_AsLong(evt->cookie);
+	int wd = evt->wd;
+	uint32_t cookie = evt->mask & IN_MOVE ? evt->cookie : 0;
 	PyObject *ret = NULL, *pymasks = NULL, *pymask = NULL;
 	PyObject *join = NULL;
 
@@ -375,7 +740,7 @@ static PyObject *event_repr(struct event *evt)
 	if (join == NULL)
 		goto bail;
 
-	pymasks = decode_mask(PyLong_AsLong(evt->mask));
+	pymasks = decode_mask(evt->mask);
 	if (pymasks == NULL)
 		goto bail;
 
@@ -383,7 +748,7 @@ static PyObject *event_repr(struct event *evt)
 	if (pymask == NULL)
 		goto bail;
 
-	if (evt->name != Py_None) {
+	if (evt->name != NULL && evt->name != Py_None) {
 		PyObject *pyname = PyObject_Repr(evt->name);
 
 #if PY_MAJOR_VERSION < 3
@@ -445,16 +810,16 @@ static PyTypeObject event_type = {
 	0,                         /*tp_getattro*/
 	0,                         /*tp_setattro*/
 	0,                         /*tp_as_buffer*/
-	Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE, /*tp_flags*/
+	Py_TPFLAGS_DEFAULT | Py_TPFLAGS_BASETYPE | Py_TPFLAGS_HAVE_GC, /*tp_flags*/
 	event_doc,           /* tp_doc */
-	0,                         /* tp_traverse */
-	0,                         /* tp_clear */
+	(traverseproc)event_traverse, /* tp_traverse */
+	(inquiry)event_clear,      /* tp_clear */
 	0,                         /* tp_richcompare */
 	0,                         /* tp_weaklistoffset */
 	0,                         /* tp_iter */
 	0,                         /* tp_iternext */
 	0,                         /* tp_methods */
-	0,                         /* tp_members */
+	event_members,             /* tp_members */
 	event_getsets,      /* tp_getset */
 	0,                         /* tp_base */
 	0,                         /* tp_dict */
@@ -466,22 +831,586 @@ static PyTypeObject event_type = {
 	event_new,          /* tp_new */
 };
 	
+/*
+ * namecache: a bounded cache mapping raw event names to str objects, so that
+ * repeated events for the same file share a single name object and only
+ * decode the name once. Least recently used entries are evicted when the
+ * cache is full.
+ */
+struct name_entry {
+	struct name_entry *chain;   /* next entry in the same hash bucket */
+	struct name_entry *newer, *older;   /* LRU list */
+	PyObject *value;
+	size_t hash;
+	size_t len;
+	char key[1];
+};
+
+struct namecache {
+	PyObject_HEAD
+	struct name_entry **buckets;
+	size_t mask;   /* number of buckets - 1 */
+	Py_ssize_t size;
+	Py_ssize_t maxsize;
+	struct name_entry *newest, *oldest;
+	unsigned long hits;
+	unsigned long misses;
+};
+
+static size_t name_hash(const char *name, size_t len)
+{
+	/* FNV-1a */
+	size_t hash = 2166136261u;
+	size_t i;
+
+	for (i = 0; i < len; i++) {
+		hash ^= (unsigned char) name[i];
+		hash *= 16777619u;
+	}
+	return hash;
+}
+
+static void namecache_unlink(struct namecache *nc, struct name_entry *e)
+{
+	if (e->newer)
+		e->newer->older = e->older;
+	else
+		nc->newest = e->older;
+	if (e->older)
+		e->older->newer = e->newer;
+	else
+		nc->oldest = e->newer;
+}
+
+static void namecache_push(struct namecache *nc, struct name_entry *e)
+{
+	e->newer = NULL;
+	e->older = nc->newest;
+	if (nc->newest)
+		nc->newest->newer = e;
+	nc->newest = e;
+	if (nc->oldest == NULL)
+		nc->oldest = e;
+}
+
+static void namecache_evict(struct namecache *nc)
+{
+	struct name_entry *e = nc->oldest;
+	struct name_entry **p = &nc->buckets[e->hash & nc->mask];
+
+	while (*p != e)
+		p = &(*p)->chain;
+	*p = e->chain;
+
+	namecache_unlink(nc, e);
+	Py_DECREF(e->value);
+	PyMem_Free(e);
+	nc->size--;
+}
+
+/* Return a new reference to the str object for name, or NULL on error */
+static PyObject *namecache_get(struct namecache *nc, const char *name,
+							   size_t len)
+{
+	size_t hash = name_hash(name, len);
+	struct name_entry **bucket = &nc->buckets[hash & nc->mask];
+	struct name_entry *e;
+	PyObject *value;
+
+	for (e = *bucket; e != NULL; e = e->chain) {
+		if (e->hash == hash && e->len == len && memcmp(e->key, name, len) == 0) {
+			nc->hits++;
+			if (nc->newest != e) {
+				namecache_unlink(nc, e);
+				namecache_push(nc, e);
+			}
+			Py_INCREF(e->value);
+			return e->value;
+		}
+	}
+
+	nc->misses++;
+	value = PyUnicode_FromStringAndSize(name, len);
+	if (value == NULL)
+		return NULL;
+
+	e = PyMem_Malloc(offsetof(struct name_entry, key) + len);
+	if (e == NULL)
+		/* Caching is optional, return the value anyway */
+		return value;
+
+	e->hash = hash;
+	e->len = len;
+	memcpy(e->key, name, len);
+	Py_INCREF(value);
+	e->value = value;
+	e->chain = *bucket;
+	*bucket = e;
+	namecache_push(nc, e);
+	if (++nc->size > nc->maxsize)
+		namecache_evict(nc);
+
+	return value;
+}
+
+static PyObject *namecache_new(PyTypeObject *t, PyObject *args, PyObject *kwds)
+{
+	struct namecache *nc;
+	Py_ssize_t maxsize;
+	size_t nbuckets = 8;
+
+	static char *kwlist[] = {"maxsize", NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "n:namecache", kwlist,
+									 &maxsize))
+		return NULL;
+
+	if (maxsize < 1) {
+		PyErr_SetString(PyExc_ValueError, "maxsize must be at least 1");
+		return NULL;
+	}
+
+	while (nbuckets < (size_t) maxsize)
+		nbuckets *= 2;
+
+	nc = (struct namecache *) (*t->tp_alloc)(t, 0);
+	if (nc == NULL)
+		return NULL;
+
+	nc->buckets = PyMem_Malloc(nbuckets * sizeof(struct name_entry *));
+	if (nc->buckets == NULL) {
+		Py_DECREF(nc);
+		return PyErr_NoMemory();
+	}
+	memset(nc->buckets, 0, nbuckets * sizeof(struct name_entry *));
+	nc->mask = nbuckets - 1;
+	nc->maxsize = maxsize;
+
+	return (PyObject *) nc;
+}
+
+static PyObject *namecache_clear(struct namecache *nc)
+{
+	while (nc->size)
+		namecache_evict(nc);
+	Py_RETURN_NONE;
+}
+
+static void namecache_dealloc(struct namecache *nc)
+{
+	if (nc->buckets) {
+		while (nc->size)
+			namecache_evict(nc);
+		PyMem_Free(nc->buckets);
+	}
+
+	(Py_TYPE(nc)->tp_free)(nc);
+}
+
+static Py_ssize_t namecache_len(struct namecache *nc)
+{
+	return nc->size;
+}
+
+static PyObject *namecache_lookup(struct namecache *nc, PyObject *args)
+{
+	const char *name;
+	Py_ssize_t len;
+
+	if (!PyArg_ParseTuple(args, "s#:get", &name, &len))
+		return NULL;
+
+	return namecache_get(nc, name, len);
+}
+
+static PyMethodDef namecache_methods[] = {
+	{"get", (PyCFunction) namecache_lookup, METH_VARARGS,
+	 "get(name) -> str\n\nReturn the cached str object for name, adding it "
+	 "to the cache if needed."},
+	{"clear", (PyCFunction) namecache_clear, METH_NOARGS,
+	 "Remove all entries from the cache."},
+	{NULL}
+};
+
+static struct PyMemberDef namecache_members[] = {
+	{"maxsize", T_PYSSIZET, offsetof(struct namecache, maxsize), READONLY,
+	 "maximum number of cached names"},
+	{"hits", T_ULONG, offsetof(struct namecache, hits), READONLY,
+	 "number of lookups that found a cached name"},
+	{"misses", T_ULONG, offsetof(struct namecache, misses), READONLY,
+	 "number of lookups that had to decode the name"},
+	{NULL}
+};
+
+static PySequenceMethods namecache_as_sequence = {
+	(lenfunc) namecache_len,   /* sq_length */
+};
+
+PyDoc_STRVAR(
+	namecache_doc,
+	"namecache(maxsize)\n"
+	"\n"
+	"Bounded cache of event names, to pass to read(). Repeated events for the\n"
+	"same name share one str object. When more than maxsize names are\n"
+	"cached, the least recently used name is evicted.");
+
+static PyTypeObject namecache_type = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"_inotify.namecache",      /*tp_name*/
+	sizeof(struct namecache),  /*tp_basicsize*/
+	0,                         /*tp_itemsize*/
+	(destructor)namecache_dealloc, /*tp_dealloc*/
+	0,                         /*tp_print*/
+	0,                         /*tp_getattr*/
+	0,                         /*tp_setattr*/
+	0,                         /*tp_compare*/
+	0,                         /*tp_repr*/
+	0,                         /*tp_as_number*/
+	&namecache_as_sequence,    /*tp_as_sequence*/
+	0,                         /*tp_as_mapping*/
+	0,                         /*tp_hash */
+	0,                         /*tp_call*/
+	0,                         /*tp_str*/
+	0,                         /*tp_getattro*/
+	0,                         /*tp_setattro*/
+	0,                         /*tp_as_buffer*/
+	Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+	namecache_doc,             /* tp_doc */
+	0,                         /* tp_traverse */
+	0,                         /* tp_clear */
+	0,                         /* tp_richcompare */
+	0,                         /* tp_weaklistoffset */
+	0,                         /* tp_iter */
+	0,                         /* tp_iternext */
+	namecache_methods,         /* tp_methods */
+	namecache_members,         /* tp_members */
+	0,                         /* tp_getset */
+	0,                         /* tp_base */
+	0,                         /* tp_dict */
+	0,                         /* tp_descr_get */
+	0,                         /* tp_descr_set */
+	0,                         /* tp_dictoffset */
+	0,                         /* tp_init */
+	0,                         /* tp_alloc */
+	namecache_new,             /* tp_new */
+};
+
+/*
+ * filter: an event filter that read() applies to the raw inotify_event
+ * records, so no Python objects are created for events that are filtered
+ * out.
+ */
+struct filter {
+	PyObject_HEAD
+	uint32_t mask;
+	uint32_t dirmask;
+	char **prefixes;
+	char **suffixes;
+	char **globs;
+	unsigned long long passed;
+	unsigned long long filtered;
+};
+
+/* Events the watcher needs for its own bookkeeping are never filtered */
+#define FILTER_ALWAYS (IN_IGNORED | IN_Q_OVERFLOW | IN_UNMOUNT)
+
+static void free_strings(char **strings)
+{
+	char **s;
+
+	if (strings == NULL)
+		return;
+	for (s = strings; *s; s++)
+		PyMem_Free(*s);
+	PyMem_Free(strings);
+}
+
+/* Convert an iterable of str to a NULL terminated array of UTF-8 strings */
+static int parse_strings(PyObject *seq, char ***out)
+{
+	PyObject *fast = PySequence_Fast(seq, "expected a sequence of strings");
+	char **strings = NULL;
+	Py_ssize_t i, n;
+
+	if (fast == NULL)
+		return -1;
+
+	n = PySequence_Fast_GET_SIZE(fast);
+	if (n == 0) {
+		Py_DECREF(fast);
+		*out = NULL;
+		return 0;
+	}
+
+	strings = PyMem_Malloc((n + 1) * sizeof(char *));
+	if (strings == NULL) {
+		PyErr_NoMemory();
+		goto bail;
+	}
+	memset(strings, 0, (n + 1) * sizeof(char *));
+
+	for (i = 0; i < n; i++) {
+		const char *s;
+
+		if (!PyArg_Parse(PySequence_Fast_GET_ITEM(fast, i), "s", &s))
+			goto bail;
+		strings[i] = PyMem_Malloc(strlen(s) + 1);
+		if (strings[i] == NULL) {
+			PyErr_NoMemory();
+			goto bail;
+		}
+		strcpy(strings[i], s);
+	}
+
+	Py_DECREF(fast);
+	*out = strings;
+	return 0;
+
+bail:
+	Py_DECREF(fast);
+	free_strings(strings);
+	return -1;
+}
+
+static int filter_names(struct filter *f, const char *name, size_t len)
+{
+	char **s;
+
+	if (!f->prefixes && !f->suffixes && !f->globs)
+		return 1;
+
+	if (f->prefixes)
+		for (s = f->prefixes; *s; s++)
+			if (strncmp(name, *s, strlen(*s)) == 0)
+				return 1;
+	if (f->suffixes)
+		for (s = f->suffixes; *s; s++) {
+			size_t slen = strlen(*s);
+			if (slen <= len && memcmp(name + len - slen, *s, slen) == 0)
+				return 1;
+		}
+	if (f->globs)
+		for (s = f->globs; *s; s++)
+			if (fnmatch(*s, name, 0) == 0)
+				return 1;
+	return 0;
+}
+
+/* Return whether an event passes the filter, and update the counters */
+static int filter_test(struct filter *f, uint32_t mask, const char *name,
+		size_t len)
+{
+	int pass;
+
+	if (mask & FILTER_ALWAYS)
+		pass = 1;
+	else if (mask & IN_ISDIR)
+		pass = (mask & f->dirmask) != 0;
+	else
+		pass = (mask & f->mask) != 0 && (len == 0 ||
+				filter_names(f, name, len));
+
+	if (pass)
+		f->passed++;
+	else
+		f->filtered++;
+	return pass;
+}
+
+static int filter_event(struct filter *f, struct inotify_event *in)
+{
+	return filter_test(f, in->mask, in->name,
+			in->len ? strnlen(in->name, in->len) : 0);
+}
+
+static PyObject *filter_match(struct filter *f, PyObject *args)
+{
+	unsigned int mask;
+	const char *name = NULL;
+	Py_ssize_t len = 0;
+
+	if (!PyArg_ParseTuple(args, "I|z#:match", &mask, &name, &len))
+		return NULL;
+
+	return PyBool_FromLong(filter_test(f, mask, name, name ? len : 0));
+}
+
+static PyMethodDef filter_methods[] = {
+	{"match", (PyCFunction) filter_match, METH_VARARGS,
+	 "match(mask, name=None) -> bool\n\nReturn whether an event with mask "
+	 "and name passes the filter, and count it."},
+	{NULL}
+};
+
+static PyObject *filter_new(PyTypeObject *t, PyObject *args, PyObject *kwds)
+{
+	struct filter *f;
+	unsigned int mask = IN_ALL_EVENTS, dirmask = IN_ALL_EVENTS;
+	PyObject *prefixes = NULL, *suffixes = NULL, *globs = NULL;
+
+	static char *kwlist[] = {"mask", "dirmask", "prefixes", "suffixes",
+							 "globs", NULL};
+
+	if (!PyArg_ParseTupleAndKeywords(args, kwds, "|IIOOO:filter", kwlist,
+									 &mask, &dirmask, &prefixes, &suffixes,
+									 &globs))
+		return NULL;
+
+	f = (struct filter *) (*t->tp_alloc)(t, 0);
+	if (f == NULL)
+		return NULL;
+
+	f->mask = mask;
+	f->dirmask = dirmask;
+	if ((prefixes && parse_strings(prefixes, &f->prefixes) == -1) ||
+			(suffixes && parse_strings(suffixes, &f->suffixes) == -1) ||
+			(globs && parse_strings(globs, &f->globs) == -1)) {
+		Py_DECREF(f);
+		return NULL;
+	}
+
+	return (PyObject *) f;
+}
+
+static void filter_dealloc(struct filter *f)
+{
+	free_strings(f->prefixes);
+	free_strings(f->suffixes);
+	free_strings(f->globs);
+
+	(Py_TYPE(f)->tp_free)(f);
+}
+
+static struct PyMemberDef filter_members[] = {
+	{"mask", T_UINT, offsetof(struct filter, mask), 0,
+	 "events on files pass if they have any of these bits set"},
+	{"dirmask", T_UINT, offsetof(struct filter, dirmask), 0,
+	 "events on directories pass if they have any of these bits set"},
+	{"passed", T_ULONGLONG, offsetof(struct filter, passed), 0,
+	 "number of events that passed the filter"},
+	{"filtered", T_ULONGLONG, offsetof(struct filter, filtered), 0,
+	 "number of events that were filtered out"},
+	{NULL}
+};
+
+PyDoc_STRVAR(
+	filter_doc,
+	"filter(mask=IN_ALL_EVENTS, dirmask=IN_ALL_EVENTS, prefixes=(),\n"
+	"       suffixes=(), globs=())\n"
+	"\n"
+	"Event filter to pass to read(), which applies it before creating event\n"
+	"objects.\n"
+	"\n"
+	"Events on files pass if their mask has a bit of mask set and, if any\n"
+	"name patterns are given and the event has a name, the name starts with\n"
+	"one of prefixes, ends with one of suffixes or matches one of the shell\n"
+	"style globs. Events on directories pass if their mask has a bit of\n"
+	"dirmask set, name patterns do not apply to them. IN_IGNORED,\n"
+	"IN_Q_OVERFLOW and IN_UNMOUNT events always pass.");
+
+static PyTypeObject filter_type = {
+	PyVarObject_HEAD_INIT(NULL, 0)
+	"_inotify.filter",         /*tp_name*/
+	sizeof(struct filter),     /*tp_basicsize*/
+	0,                         /*tp_itemsize*/
+	(destructor)filter_dealloc, /*tp_dealloc*/
+	0,                         /*tp_print*/
+	0,                         /*tp_getattr*/
+	0,                         /*tp_setattr*/
+	0,                         /*tp_compare*/
+	0,                         /*tp_repr*/
+	0,                         /*tp_as_number*/
+	0,                         /*tp_as_sequence*/
+	0,                         /*tp_as_mapping*/
+	0,                         /*tp_hash */
+	0,                         /*tp_call*/
+	0,                         /*tp_str*/
+	0,                         /*tp_getattro*/
+	0,                         /*tp_setattro*/
+	0,                         /*tp_as_buffer*/
+	Py_TPFLAGS_DEFAULT,        /*tp_flags*/
+	filter_doc,                /* tp_doc */
+	0,                         /* tp_traverse */
+	0,                         /* tp_clear */
+	0,                         /* tp_richcompare */
+	0,                         /* tp_weaklistoffset */
+	0,                         /* tp_iter */
+	0,                         /* tp_iternext */
+	filter_methods,            /* tp_methods */
+	filter_members,            /* tp_members */
+	0,                         /* tp_getset */
+	0,                         /* tp_base */
+	0,                         /* tp_dict */
+	0,                         /* tp_descr_get */
+	0,                         /* tp_descr_set */
+	0,                         /* tp_dictoffset */
+	0,                         /* tp_init */
+	0,                         /* tp_alloc */
+	filter_new,                /* tp_new */
+};
+
+static PyObject *event_from_raw(PyTypeObject *type, struct inotify_event *in,
+							   struct namecache *names)
+{
+	struct event *evt = (struct event *) (*type->tp_alloc)(type, 0);
+
+	if (evt == NULL)
+		return NULL;
+
+	evt->wd = in->wd;
+	evt->mask = in->mask;
+	evt->cookie = in->cookie;
+	if (in->len) {
+		if (names)
+			evt->name = namecache_get(names, in->name,
+									  strnlen(in->name, in->len));
+		else
+			evt->name = PyUnicode_FromString(in->name);
+		if (evt->name == NULL) {
+			Py_DECREF(evt);
+			return NULL;
+		}
+	} else {
+		Py_INCREF(Py_None);
+		evt->name = Py_None;
+	}
+	Py_INCREF(Py_None);
+	evt->watch = Py_None;
+
+	return (PyObject *) evt;
+}
+
 static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 {
-	static char buffer[READ_BUF_SIZE];
-	PyObject *ctor_args = NULL;
 	PyObject *ret = NULL;
+	PyObject *pybuffer = Py_None;
+	PyObject *pynames = Py_None;
+	PyObject *pyfilter = Py_None;
+	PyObject *pystats = Py_None;
+	struct namecache *names = NULL;
+	struct filter *filter = NULL;
+	PyTypeObject *type = &event_type;
+	Py_buffer view = {NULL};
+	Py_buffer statsview = {NULL};
+	uint64_t *stats = NULL;
+	uint64_t t0 = 0, t1;
+	char *buffer = NULL;
+	int bufsize = READ_BUF_SIZE;
 	int block = 1;
 	int readable = 0;
 	int pos, read_total, ioctl_retval;
 	int fd;
+	Py_ssize_t max_events = 0;
+	int max_bytes = 0;
 
-	static char *kwlist[] = {"fd", "block", NULL};
+	static char *kwlist[] = {"fd", "block", "buffer", "event_type", "names",
+							 "filter", "stats", "max_events", "max_bytes",
+							 NULL};
 
 #if PY_MAJOR_VERSION >= 3 && PY_MINOR_VERSION >= 3
-	const char *format = "i|$p:read";
+	const char *format = "i|$pOO!OOOni:read";
 #else
-	const char* format = "i|i:read";
+	const char* format = "i|iOO!OOOni:read";
 	Py_ssize_t argc = PyTuple_Size(args);
 	if (argc == -1)
 		goto bail;
@@ -491,27 +1420,114 @@ static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 	}
 #endif
 
-	if (!PyArg_ParseTupleAndKeywords(args, keywds, format, kwlist, &fd, &block))
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, format, kwlist, &fd, &block,
+									 &pybuffer, &PyType_Type, &type, &pynames,
+									 &pyfilter, &pystats, &max_events,
+									 &max_bytes))
 		goto bail;
 
+	if (pystats != Py_None) {
+		if (PyObject_GetBuffer(pystats, &statsview, PyBUF_WRITABLE) == -1)
+			goto bail;
+		if (statsview.len < (Py_ssize_t) (READ_STATS_SIZE * sizeof(uint64_t))) {
+			PyErr_Format(PyExc_ValueError, "stats buffer must hold at least "
+						 "%d 64 bit counters", (int) READ_STATS_SIZE);
+			goto bail;
+		}
+		stats = statsview.buf;
+	}
+
+	if (pyfilter != Py_None) {
+		if (!PyObject_TypeCheck(pyfilter, &filter_type)) {
+			PyErr_SetString(PyExc_TypeError,
+							"filter must be a _inotify.filter or None");
+			goto bail;
+		}
+		filter = (struct filter *) pyfilter;
+	}
+
+	if (pynames != Py_None) {
+		if (!PyObject_TypeCheck(pynames, &namecache_type)) {
+			PyErr_SetString(PyExc_TypeError,
+							"names must be a _inotify.namecache or None");
+			goto bail;
+		}
+		names = (struct namecache *) pynames;
+	}
+
+	if (!PyType_IsSubtype(type, &event_type)) {
+		PyErr_SetString(PyExc_TypeError,
+						"event_type must be a subclass of _inotify.event");
+		goto bail;
+	}
+
+	if (pybuffer != Py_None) {
+		if (PyObject_GetBuffer(pybuffer, &view, PyBUF_WRITABLE) == -1)
+			goto bail;
+		if (view.len < (Py_ssize_t) MIN_BUF_SIZE) {
+			PyErr_Format(PyExc_ValueError, "read buffer must be at least %d "
+						 "bytes", (int) MIN_BUF_SIZE);
+			goto bail;
+		}
+		buffer = view.buf;
+		bufsize = view.len > INT_MAX ? INT_MAX : (int) view.len;
+	} else {
+		buffer = PyMem_Malloc(bufsize);
+		if (buffer == NULL) {
+			PyErr_NoMemory();
+			goto bail;
+		}
+	}
+
 	ret = PyList_New(0);
 	if (ret == NULL)
 		goto bail;
-	
-	ctor_args = PyTuple_New(0);
-	if (ctor_args == NULL)
-		goto bail;
+
+	// Start timing here, so the argument checks and allocations above are
+	// not counted as decoding time
+	if (stats)
+		t0 = clock_ns();
 
 	Py_BEGIN_ALLOW_THREADS;
 	ioctl_retval = ioctl(fd, FIONREAD, &readable);
 	Py_END_ALLOW_THREADS;
 
+	// The reads below are sized by the number of queued bytes, and a read
+	// of 0 bytes fails, so wait until there is something to read.
+	while (ioctl_retval == 0 && readable == 0 && block) {
+		struct pollfd pfd = { fd, POLLIN, 0 };
+		int poll_retval;
+
+		Py_BEGIN_ALLOW_THREADS;
+		poll_retval = poll(&pfd, 1, -1);
+		Py_END_ALLOW_THREADS;
+
+		if (poll_retval < 0) {
+			if (errno != EINTR || PyErr_CheckSignals() == -1) {
+				if (!PyErr_Occurred())
+					PyErr_SetFromErrno(PyExc_OSError);
+				goto bail;
+			}
+			continue;
+		}
+
+		Py_BEGIN_ALLOW_THREADS;
+		ioctl_retval = ioctl(fd, FIONREAD, &readable);
+		Py_END_ALLOW_THREADS;
+	}
+
+	if (stats) {
+		t1 = clock_ns();
+		stats[STAT_BLOCK_NS] += t1 - t0;
+		t0 = t1;
+	}
+
 	if (ioctl_retval < 0) {
 		PyErr_SetFromErrno(PyExc_OSError);
 		goto bail;
 	}
 
-	if (block == 0 && readable == 0) {
+	if (readable == 0) {
 		goto done;
 	}
 
@@ -520,17 +1536,40 @@ static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 
 	do {
 		int nread, size;
-		int toread = min(readable - read_total, READ_BUF_SIZE - pos);
+		int toread = min(readable - read_total, bufsize - pos);
+
+		if (max_bytes > 0) {
+			// The kernel refuses reads that are too small for the next
+			// event, so never ask for less than the largest event.
+			int room = max(max_bytes - read_total, (int) MIN_BUF_SIZE - pos);
+			toread = min(toread, room);
+		}
+
+		if (stats) {
+			t1 = clock_ns();
+			stats[STAT_DECODE_NS] += t1 - t0;
+			t0 = t1;
+		}
 
 		Py_BEGIN_ALLOW_THREADS
 		nread = read(fd, buffer + pos, toread);
 		Py_END_ALLOW_THREADS;
 
+		if (stats) {
+			t1 = clock_ns();
+			stats[STAT_BLOCK_NS] += t1 - t0;
+			t0 = t1;
+			stats[STAT_SYSCALLS]++;
+		}
+
 		if (nread == -1) {
 			PyErr_SetFromErrno(PyExc_OSError);
 			goto bail;
 		}
 
+		if (stats)
+			stats[STAT_BYTES] += nread;
+
 		read_total += nread;
 		size = nread + pos;
 
@@ -540,7 +1579,7 @@ static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 			// order these comparisons so there won't be an overflow if in->len is very large
 			if (size - pos < INE_SIZE || size - pos - INE_SIZE < in->len) {
 				if (pos == 0 ||
-						in->len > READ_BUF_SIZE - INE_SIZE ||
+						in->len > bufsize - INE_SIZE ||
 						in->len >= readable - (read_total - nread + pos + INE_SIZE)) {
 					// This is not supposed to happen, unless we are reading
 					// garbage. Maybe the fd wasn't an inotify fd?
@@ -550,58 +1589,49 @@ static PyObject *read_events(PyObject *self, PyObject *args, PyObject *keywds)
 					goto bail;
 				}
 				// we read a partial message
-				memcpy(buffer, buffer + pos, size - pos);
+				memmove(buffer, buffer + pos, size - pos);
 				pos = size - pos;
 				goto nextread;
 			}
 			
-			struct event *evt;
 			PyObject *obj;
 
-			obj = PyObject_CallObject((PyObject *) &event_type, ctor_args);
+			if (filter && !filter_event(filter, in)) {
+				pos += sizeof(struct inotify_event) + in->len;
+				continue;
+			}
+
+			obj = event_from_raw(type, in, names);
 
 			if (obj == NULL)
 				goto bail;
 
-			evt = (struct event *) obj;
-
-			evt->wd = PyLong_FromLong(in->wd);
-			evt->mask = PyLong_FromLong(in->mask);
-			if (in->mask & IN_MOVE)
-				evt->cookie = PyLong_FromLong(in->cookie);
-			else {
-				Py_INCREF(Py_None);
-				evt->cookie = Py_None;
-			}
-			if (in->len)
-				evt->name = PyUnicode_FromString(in->name);
-			else {
-				Py_INCREF(Py_None);
-				evt->name = Py_None;
+			if (PyList_Append(ret, obj) == -1) {
+				Py_DECREF(obj);
+				goto bail;
 			}
 
-			if (!evt->wd || !evt->mask || !evt->cookie || !evt->name)
-				goto mybail;
+			if (stats) {
+				uint32_t mask = in->mask;
+				int bit;
 
-			if (PyList_Append(ret, obj) == -1)
-				goto mybail;
+				stats[STAT_EVENTS]++;
+				for (bit = 0; mask; bit++, mask >>= 1)
+					if (mask & 1)
+						stats[STAT_MASK_BITS + bit]++;
+			}
 
 			pos += sizeof(struct inotify_event) + in->len;
 			Py_DECREF(obj);
-			continue;
-
-		mybail:
-			Py_CLEAR(evt->wd);
-			Py_CLEAR(evt->mask);
-			Py_CLEAR(evt->cookie);
-			Py_CLEAR(evt->name);
-			Py_DECREF(obj);
-
-			goto bail;
 		}
 
 		pos = 0;
 
+		// Only stop between whole events, a partial one must be completed
+		if ((max_bytes > 0 && read_total >= max_bytes) ||
+				(max_events > 0 && PyList_GET_SIZE(ret) >= max_events))
+			break;
+
 	nextread:
 		;
 
@@ -613,30 +1643,246 @@ bail:
 	Py_CLEAR(ret);
 	
 done:
-	Py_XDECREF(ctor_args);
+	if (view.buf != NULL)
+		PyBuffer_Release(&view);
+	else
+		PyMem_Free(buffer);
+	if (statsview.buf != NULL) {
+		if (stats && t0)
+			stats[STAT_DECODE_NS] += clock_ns() - t0;
+		PyBuffer_Release(&statsview);
+	}
 
 	return ret;
 }
 
 PyDoc_STRVAR(
 	read_doc,
-	"read(fd, *, block=True) -> list_of_events\n"
+	"read(fd, *, block=True, buffer=None) -> list_of_events\n"
 	"\n"
 	"Read inotify events from a file descriptor.\n"
 	"\n"
 	"        fd: file descriptor returned by init()\n"
 	"        block: If true, block if no events are available immediately.\n"
+	"        buffer: writable buffer (e.g. a bytearray) to read into. Larger\n"
+	"            buffers need fewer read system calls. It must be at least\n"
+	"            sizeof(struct inotify_event) + NAME_MAX + 1 bytes large. If\n"
+	"            None, a 64 KiB buffer is allocated for this call. A buffer\n"
+	"            must not be used by two concurrent read() calls.\n"
+	"        event_type: subclass of event to create the events as.\n"
+	"        names: namecache to look up event names in, or None.\n"
+	"        filter: filter to apply to the events, or None.\n"
+	"        stats: writable buffer of at least READ_STATS_SIZE unsigned 64\n"
+	"            bit integers (e.g. an array('Q')) to add counters to, or\n"
+	"            None. The counters are, at the indices STAT_SYSCALLS,\n"
+	"            STAT_BYTES, STAT_EVENTS, STAT_BLOCK_NS and STAT_DECODE_NS:\n"
+	"            read system calls, bytes read, events returned, nanoseconds\n"
+	"            spent in system calls and nanoseconds spent creating\n"
+	"            events. From index STAT_MASK_BITS on follow the number of\n"
+	"            returned events that had each of the 32 mask bits set.\n"
+	"        max_events, max_bytes: if larger than 0, stop making read system\n"
+	"            calls once this many events were returned or this many bytes\n"
+	"            were read. Read system calls are made for at most max_bytes\n"
+	"            bytes in total, or for one event if that is larger. The\n"
+	"            events of the last read system call are all returned, so more\n"
+	"            than max_events events may be returned.\n"
 	"\n"
-	"Return a list of event objects. read() will always return as many events as "
-	"are available for reading at the moment the call to read() is made. \n"
+	"Return a list of event objects. Unless limited by max_events or\n"
+	"max_bytes, read() will always return as many events as are available\n"
+	"for reading at the moment the call to read() is made. \n"
 	"\n");
 
 
+static PyObject *readinto(PyObject *self, PyObject *args, PyObject *keywds)
+{
+	PyObject *ret = NULL;
+	PyObject *pybuffer;
+	Py_buffer view = {NULL};
+	int block = 1;
+	int readable = 0;
+	int ioctl_retval = 0;
+	ssize_t nread;
+	int fd;
+
+	static char *kwlist[] = {"fd", "buffer", "block", NULL};
+
+#if PY_MAJOR_VERSION >= 3 && PY_MINOR_VERSION >= 3
+	const char *format = "iO|$p:readinto";
+#else
+	const char* format = "iO|i:readinto";
+	Py_ssize_t argc = PyTuple_Size(args);
+	if (argc == -1)
+		goto bail;
+	if (argc > 2) {
+		PyErr_Format(PyExc_TypeError, "readinto() takes exactly 2 positional arguments but %zd were given", argc);
+		goto bail;
+	}
+#endif
+
+	if (!PyArg_ParseTupleAndKeywords(args, keywds, format, kwlist, &fd,
+									 &pybuffer, &block))
+		goto bail;
+
+	if (PyObject_GetBuffer(pybuffer, &view, PyBUF_WRITABLE) == -1)
+		goto bail;
+
+	if (view.len < (Py_ssize_t) MIN_BUF_SIZE) {
+		PyErr_Format(PyExc_ValueError, "read buffer must be at least %d bytes",
+					 (int) MIN_BUF_SIZE);
+		goto bail;
+	}
+
+	if (!block) {
+		Py_BEGIN_ALLOW_THREADS;
+		ioctl_retval = ioctl(fd, FIONREAD, &readable);
+		Py_END_ALLOW_THREADS;
+
+		if (ioctl_retval < 0) {
+			PyErr_SetFromErrno(PyExc_OSError);
+			goto bail;
+		}
+		if (readable == 0) {
+			ret = PyLong_FromLong(0);
+			goto done;
+		}
+	}
+
+	Py_BEGIN_ALLOW_THREADS
+	nread = read(fd, view.buf, view.len);
+	Py_END_ALLOW_THREADS
+
+	if (nread == -1) {
+		PyErr_SetFromErrno(PyExc_OSError);
+		goto bail;
+	}
+
+	ret = PyLong_FromSsize_t(nread);
+	goto done;
+
+bail:
+	Py_CLEAR(ret);
+
+done:
+	if (view.buf != NULL)
+		PyBuffer_Release(&view);
+
+	return ret;
+}
+
+PyDoc_STRVAR(
+	readinto_doc,
+	"readinto(fd, buffer, *, block=True) -> nbytes\n"
+	"\n"
+	"Read raw inotify_event records from a file descriptor into a buffer.\n"
+	"\n"
+	"        fd: file descriptor returned by init()\n"
+	"        buffer: writable buffer (e.g. a bytearray) of at least\n"
+	"            sizeof(struct inotify_event) + NAME_MAX + 1 bytes\n"
+	"        block: If true, block if no events are available immediately.\n"
+	"\n"
+	"Issue a single read system call and return the number of bytes read.\n"
+	"The buffer only ever contains whole records, which can be decoded with\n"
+	"decode(). Return 0 if block is false and no events are available.\n");
+
+static PyObject *decode_events(PyObject *self, PyObject *args)
+{
+	PyObject *ret = NULL;
+	PyObject *pybuffer;
+	PyObject *wds = NULL, *masks = NULL, *cookies = NULL;
+	PyObject *offsets = NULL, *lengths = NULL;
+	Py_buffer view = {NULL};
+	Py_ssize_t nbytes = -1, pos, count = 0, i;
+	uint32_t mask_union = 0;
+	const char *buffer;
+
+	if (!PyArg_ParseTuple(args, "O|n:decode", &pybuffer, &nbytes))
+		goto bail;
+
+	if (PyObject_GetBuffer(pybuffer, &view, PyBUF_SIMPLE) == -1)
+		goto bail;
+
+	if (nbytes < 0 || nbytes > view.len)
+		nbytes = view.len;
+	buffer = view.buf;
+
+	// First pass: validate the records and count them
+	for (pos = 0; pos < nbytes; count++) {
+		struct inotify_event *in = (struct inotify_event *) (buffer + pos);
+
+		if (nbytes - pos < (Py_ssize_t) INE_SIZE ||
+				(size_t) (nbytes - pos) - INE_SIZE < in->len) {
+			PyErr_Format(PyExc_ValueError, "buffer does not contain whole "
+						 "inotify events: record at offset %zd is truncated", pos);
+			goto bail;
+		}
+		pos += INE_SIZE + in->len;
+	}
+
+	wds = PyBytes_FromStringAndSize(NULL, count * sizeof(int32_t));
+	masks = PyBytes_FromStringAndSize(NULL, count * sizeof(uint32_t));
+	cookies = PyBytes_FromStringAndSize(NULL, count * sizeof(uint32_t));
+	offsets = PyBytes_FromStringAndSize(NULL, count * sizeof(uint32_t));
+	lengths = PyBytes_FromStringAndSize(NULL, count * sizeof(uint32_t));
+	if (!wds || !masks || !cookies || !offsets || !lengths)
+		goto bail;
+
+	for (pos = 0, i = 0; i < count; i++) {
+		struct inotify_event *in = (struct inotify_event *) (buffer + pos);
+
+		((int32_t *) PyBytes_AS_STRING(wds))[i] = in->wd;
+		((uint32_t *) PyBytes_AS_STRING(masks))[i] = in->mask;
+		((uint32_t *) PyBytes_AS_STRING(cookies))[i] = in->cookie;
+		((uint32_t *) PyBytes_AS_STRING(offsets))[i] = pos + INE_SIZE;
+		((uint32_t *) PyBytes_AS_STRING(lengths))[i] =
+			in->len ? strnlen(in->name, in->len) : 0;
+		mask_union |= in->mask;
+		pos += INE_SIZE + in->len;
+	}
+
+	ret = Py_BuildValue("nkOOOOO", count, (unsigned long) mask_union, wds,
+						masks, cookies, offsets, lengths);
+	goto done;
+
+bail:
+	Py_CLEAR(ret);
+
+done:
+	Py_XDECREF(wds);
+	Py_XDECREF(masks);
+	Py_XDECREF(cookies);
+	Py_XDECREF(offsets);
+	Py_XDECREF(lengths);
+	if (view.buf != NULL)
+		PyBuffer_Release(&view);
+
+	return ret;
+}
+
+PyDoc_STRVAR(
+	decode_doc,
+	"decode(buffer, nbytes=-1) -> (count, mask_union, wds, masks, cookies,\n"
+	"                              name_offsets, name_lengths)\n"
+	"\n"
+	"Decode raw inotify_event records, as filled in by readinto(), into\n"
+	"columns without creating an object per event.\n"
+	"\n"
+	"        buffer: buffer containing the records\n"
+	"        nbytes: number of bytes of buffer to decode, all if negative\n"
+	"\n"
+	"wds, masks, cookies, name_offsets and name_lengths are bytes objects\n"
+	"holding count native 32 bit integers each. Names are referenced by their\n"
+	"offset into buffer and their length, which is 0 if the event has no\n"
+	"name. mask_union is the bitwise or of all masks.");
+
+
 static PyMethodDef methods[] = {
 	{"init", init, METH_VARARGS, init_doc},
 	{"add_watch", add_watch, METH_VARARGS, add_watch_doc},
 	{"remove_watch", remove_watch, METH_VARARGS, remove_watch_doc},
+	{"add_tree", add_tree, METH_VARARGS, add_tree_doc},
 	{"read", (PyCFunction) read_events, METH_VARARGS | METH_KEYWORDS, read_doc},
+	{"readinto", (PyCFunction) readinto, METH_VARARGS | METH_KEYWORDS, readinto_doc},
+	{"decode", decode_events, METH_VARARGS, decode_doc},
 	{"decode_mask", pydecode_mask, METH_VARARGS, decode_mask_doc},
 	{NULL},
 };
@@ -651,8 +1897,21 @@ PyMODINIT_FUNC PyInit__inotify(void)
 
 	if (PyType_Ready(&event_type) == -1)
 		return NULL;
+	if (PyType_Ready(&namecache_type) == -1)
+		return NULL;
+	if (PyType_Ready(&filter_type) == -1)
+		return NULL;
 
 	mod = PyModule_Create(&moduledef);
+	if (mod == NULL)
+		return NULL;
+
+	Py_INCREF(&event_type);
+	PyModule_AddObject(mod, "event", (PyObject *) &event_type);
+	Py_INCREF(&namecache_type);
+	PyModule_AddObject(mod, "namecache", (PyObject *) &namecache_type);
+	Py_INCREF(&filter_type);
+	PyModule_AddObject(mod, "filter", (PyObject *) &filter_type);
 
 	dict = PyModule_GetDict(mod);
 	
@@ -669,8 +1928,21 @@ void init_inotify(void)
 
 	if (PyType_Ready(&event_type) == -1)
 		return;
+	if (PyType_Ready(&namecache_type) == -1)
+		return;
+	if (PyType_Ready(&filter_type) == -1)
+		return;
 
 	mod = Py_InitModule3("_inotify", methods, doc);
+	if (mod == NULL)
+		return;
+
+	Py_INCREF(&event_type);
+	PyModule_AddObject(mod, "event", (PyObject *) &event_type);
+	Py_INCREF(&namecache_type);
+	PyModule_AddObject(mod, "namecache", (PyObject *) &namecache_type);
+	Py_INCREF(&filter_type);
+	PyModule_AddObject(mod, "filter", (PyObject *) &filter_type);
 
 	dict = PyModule_GetDict(mod);
 	
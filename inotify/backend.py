@@ -0,0 +1,560 @@
+# backend.py - the system interface used by watchers, and a simulation of it
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2.1 of the GNU Lesser General Public
+# License, incorporated herein by reference.
+
+'''Backends provide the inotify system calls to a Watcher.
+
+A backend has the methods init(), add_watch(), remove_watch(), add_tree(),
+read(), readinto(), readable() and close(). All but readable() and close()
+take the same arguments as the functions of the _inotify module with the
+same name. readable(fd) returns the number of bytes of events queued, and
+close(fd) closes an instance.
+
+KernelBackend uses the kernel's inotify, and is what watchers use by
+default. SimulatedBackend keeps a simulated filesystem and event queues in
+memory. Watchers created with it can be driven by calling its mkdir(),
+write(), rename(), etc. methods, without touching a real filesystem, which
+makes it possible to test and benchmark the library deterministically. The
+simulation is written in Python: on one core churn() generates about
+300,000 events per second, and a Watcher reads them at about 800,000 events
+per second, so it measures the library's overhead rather than exceeding the
+kernel's event rates. Features that look at the filesystem themselves, like
+overflow recovery, WatchBudget polling and load_state(), still look at the
+real filesystem.'''
+
+from . import _inotify as inotify
+import array
+import collections
+import errno
+import fcntl
+import os
+import select
+import struct
+import termios
+
+
+class KernelBackend(object):
+    '''Backend that uses the kernel's inotify.'''
+
+    init = staticmethod(inotify.init)
+    add_watch = staticmethod(inotify.add_watch)
+    remove_watch = staticmethod(inotify.remove_watch)
+    add_tree = staticmethod(inotify.add_tree)
+    read = staticmethod(inotify.read)
+    readinto = staticmethod(inotify.readinto)
+    close = staticmethod(os.close)
+
+    def readable(self, fd):
+        buf = array.array('i', [0])
+        fcntl.ioctl(fd, termios.FIONREAD, buf, True)
+        return buf[0]
+
+
+kernel = KernelBackend()
+
+
+_EVENT = struct.Struct('<iIII')
+
+# Writes of at most this many bytes to a pipe are atomic
+_PIPE_BUF = getattr(select, 'PIPE_BUF', 512)
+
+
+def _error(code, path=None):
+    return OSError(code, os.strerror(code), path)
+
+
+def _pack(wd, mask, cookie, name):
+    '''Return an event as a struct inotify_event record'''
+    if not name:
+        return _EVENT.pack(wd, mask, cookie, 0)
+    name = name.encode('utf-8')
+    # The name is NUL terminated and padded to a multiple of 16 bytes
+    length = (len(name) // 16 + 1) * 16
+    return _EVENT.pack(wd, mask, cookie, length) + \
+        name + b'\0' * (length - len(name))
+
+
+_OVERFLOW = _pack(-1, inotify.IN_Q_OVERFLOW, 0, None)
+
+
+class _Instance(object):
+    '''A simulated inotify instance.
+
+    Queued events are written as struct inotify_event records to a pipe,
+    whose read end is the instance's file descriptor. So select and poll
+    work on it, and the _inotify functions decode the events the same as
+    for the kernel. Records are written in whole records at a time, so the
+    pipe never contains a partial record. Records that do not fit in the
+    pipe, or that are not written yet to save system calls, wait in
+    pending.'''
+
+    __slots__ = (
+        'rfd',
+        'wfd',
+        'pending',
+        'pending_sizes',
+        'sizes',
+        'count',
+        'last',
+        'overflowed',
+        'full',
+        'watches',
+        'paths',
+        'next_wd',
+        )
+
+    def __init__(self):
+        self.rfd, self.wfd = os.pipe()
+        flags = fcntl.fcntl(self.wfd, fcntl.F_GETFL)
+        fcntl.fcntl(self.wfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        self.pending = bytearray()
+        # The sizes of the records in pending and in the pipe
+        self.pending_sizes = collections.deque()
+        self.sizes = collections.deque()
+        # Number of queued events, and the last one queued
+        self.count = 0
+        self.last = None
+        self.overflowed = False
+        # Whether the pipe was found full since the last read
+        self.full = False
+        # wd -> [path, mask]
+        self.watches = {}
+        # path -> wd
+        self.paths = {}
+        self.next_wd = 1
+
+    def push(self, record, limit):
+        if self.count >= limit:
+            if not self.overflowed:
+                self.overflowed = True
+                self._append(_OVERFLOW)
+            return
+        # Like the kernel, drop an event identical to the last queued one
+        if record == self.last:
+            return
+        self._append(record)
+
+    def _append(self, record):
+        self.last = record
+        self.count += 1
+        self.pending += record
+        self.pending_sizes.append(len(record))
+        # Write the first event right away so the descriptor becomes
+        # readable, and later ones in chunks.
+        if not self.sizes or \
+                (len(self.pending) >= _PIPE_BUF and not self.full):
+            self.flush()
+
+    def flush(self):
+        '''Write as many pending records to the pipe as fit.'''
+        pending = self.pending
+        sizes = self.pending_sizes
+        written = 0
+        while sizes:
+            n = 0
+            count = 0
+            for size in sizes:
+                if n + size > _PIPE_BUF:
+                    break
+                n += size
+                count += 1
+            try:
+                os.write(self.wfd, bytes(pending[written:written+n]))
+            except OSError as err:
+                if err.errno == errno.EAGAIN:
+                    self.full = True
+                    break
+                raise
+            written += n
+            for i in range(count):
+                self.sizes.append(sizes.popleft())
+        del pending[:written]
+
+    def consumed(self, nbytes, empty):
+        '''Update the state after nbytes were read from the pipe, and
+        whether that emptied it'''
+        sizes = self.sizes
+        if empty:
+            count = len(sizes)
+            sizes.clear()
+        else:
+            count = 0
+            while nbytes > 0:
+                nbytes -= sizes.popleft()
+                count += 1
+        self.taken(count)
+
+    def taken(self, count):
+        '''Update the state after count records were read from the pipe'''
+        self.count -= count
+        self.full = False
+        if not self.count:
+            self.last = None
+            self.overflowed = False
+
+
+class SimulatedBackend(object):
+    '''Backend that simulates inotify on an in-memory filesystem.
+
+    The filesystem starts out with only the directories '.' and '/'. It is
+    changed with mkdir(), create(), write(), modify(), remove() and
+    rename(), which queue the same events the kernel would for the watches
+    of all instances. Paths are normalized with os.path.normpath, there are
+    no symbolic links. churn() generates a random workload that is
+    deterministic for a given seed.
+
+    Like the kernel, each instance queues at most max_queued_events events
+    before it queues an IN_Q_OVERFLOW event, and adding more than
+    max_user_watches watches over all instances fails with ENOSPC.
+
+    This class is not thread-safe. Reading with block=True from an instance
+    without queued events waits until another thread queues events.'''
+
+    def __init__(self, max_queued_events=16384, max_user_watches=8192,
+                 seed=0):
+        self.max_queued_events = max_queued_events
+        self.max_user_watches = max_user_watches
+        # Only needed for simulations, so not imported with the package
+        import random
+        self.random = random.Random(seed)
+        # path -> whether it is a directory
+        self._entries = {'.': True, '/': True}
+        # directory path -> set of names
+        self._children = collections.defaultdict(set)
+        self._instances = {}
+        self._num_watches = 0
+        self._cookie = 0
+        # The files, for churn(), and path -> index in that list
+        self._files = []
+        self._file_index = {}
+
+    # The backend interface
+
+    def init(self):
+        instance = _Instance()
+        self._instances[instance.rfd] = instance
+        return instance.rfd
+
+    def close(self, fd):
+        instance = self._instances.pop(fd)
+        self._num_watches -= len(instance.watches)
+        os.close(instance.rfd)
+        os.close(instance.wfd)
+
+    def add_watch(self, fd, path, mask):
+        instance = self._instances[fd]
+        path = os.path.normpath(path)
+        isdir = self._entries.get(path)
+        if isdir is None:
+            raise _error(errno.ENOENT, path)
+        if mask & inotify.IN_ONLYDIR and not isdir:
+            raise _error(errno.ENOTDIR, path)
+        wd = instance.paths.get(path)
+        if wd is None:
+            if self._num_watches >= self.max_user_watches:
+                raise _error(errno.ENOSPC, path)
+            self._num_watches += 1
+            wd = instance.next_wd
+            instance.next_wd += 1
+            instance.paths[path] = wd
+            instance.watches[wd] = [path, 0]
+        watch = instance.watches[wd]
+        if mask & inotify.IN_MASK_ADD:
+            watch[1] |= mask & ~inotify.IN_MASK_ADD
+        else:
+            watch[1] = mask
+        return wd
+
+    def remove_watch(self, fd, wd):
+        instance = self._instances[fd]
+        if wd not in instance.watches:
+            raise _error(errno.EINVAL)
+        self._unwatch(instance, wd)
+
+    def add_tree(self, fd, path, mask):
+        added = []
+        errors = []
+        stack = [os.path.normpath(path)]
+        while stack:
+            parent = stack.pop()
+            for name in sorted(self._children.get(parent, ())):
+                sub = self._join(parent, name)
+                if not self._entries[sub]:
+                    continue
+                try:
+                    added.append((sub, self.add_watch(fd, sub, mask)))
+                except OSError as err:
+                    errors.append((sub, err.errno, False))
+                stack.append(sub)
+        return added, errors
+
+    def _wait(self, instance, block):
+        instance.flush()
+        if block and not instance.sizes:
+            select.select([instance.rfd], [], [])
+            instance.flush()
+
+    def read(self, fd, block=True, max_events=0, max_bytes=0, **kwargs):
+        instance = self._instances[fd]
+        self._wait(instance, block)
+        events = []
+        nbytes = 0
+        while True:
+            before = kernel.readable(fd)
+            events.extend(inotify.read(
+                fd, block=False, max_events=max_events - len(events)
+                if max_events else 0, max_bytes=max_bytes - nbytes
+                if max_bytes else 0, **kwargs))
+            left = kernel.readable(fd)
+            instance.consumed(before - left, not left)
+            nbytes += before - left
+            # Keep reading if more events were queued than fit in the pipe
+            if left or not instance.pending or \
+                    (max_events and len(events) >= max_events) or \
+                    (max_bytes and nbytes >= max_bytes):
+                break
+            instance.flush()
+        return events
+
+    def readinto(self, fd, buffer, block=True):
+        instance = self._instances[fd]
+        self._wait(instance, block)
+        sizes = instance.sizes
+        nbytes = 0
+        count = 0
+        while sizes and nbytes + sizes[0] <= len(buffer):
+            nbytes += sizes.popleft()
+            count += 1
+        if nbytes:
+            buffer[:nbytes] = os.read(fd, nbytes)
+        instance.taken(count)
+        return nbytes
+
+    def readable(self, fd):
+        instance = self._instances[fd]
+        instance.flush()
+        return kernel.readable(fd) + len(instance.pending)
+
+    # Generating events
+
+    @staticmethod
+    def _join(parent, name):
+        if parent == '.':
+            return name
+        if parent == '/':
+            return '/' + name
+        return parent + '/' + name
+
+    @staticmethod
+    def _split(path):
+        parent, _, name = path.rpartition('/')
+        if not parent:
+            parent = '/' if path.startswith('/') else '.'
+        return parent, name
+
+    def _emit(self, path, mask, cookie=0, isdir=False, entry=False):
+        '''Queue the events for a change of mask to path, for the watches
+        on its parent directory and, unless entry is True because the
+        change is to the directory entry, on path itself.'''
+        limit = self.max_queued_events
+        parent, name = self._split(path)
+        dirmask = inotify.IN_ISDIR if isdir else 0
+        for instance in self._instances.values():
+            wd = instance.paths.get(parent)
+            if wd is not None and instance.watches[wd][1] & mask:
+                instance.push(_pack(wd, mask | dirmask, cookie, name), limit)
+            if entry:
+                continue
+            wd = instance.paths.get(path)
+            if wd is not None and instance.watches[wd][1] & mask:
+                instance.push(_pack(wd, mask | dirmask, cookie, None), limit)
+
+    def _emit_self(self, path, mask):
+        limit = self.max_queued_events
+        for instance in self._instances.values():
+            wd = instance.paths.get(path)
+            if wd is not None and instance.watches[wd][1] & mask:
+                instance.push(_pack(wd, mask, 0, None), limit)
+
+    def _unwatch(self, instance, wd):
+        path, mask = instance.watches.pop(wd)
+        del instance.paths[path]
+        self._num_watches -= 1
+        instance.push(_pack(wd, inotify.IN_IGNORED, 0, None),
+                      self.max_queued_events)
+
+    def _add_entry(self, path, isdir):
+        path = os.path.normpath(path)
+        if path in self._entries:
+            raise _error(errno.EEXIST, path)
+        parent, name = self._split(path)
+        if not self._entries.get(parent):
+            raise _error(errno.ENOENT, path)
+        self._entries[path] = isdir
+        self._children[parent].add(name)
+        if not isdir:
+            self._file_index[path] = len(self._files)
+            self._files.append(path)
+        self._emit(path, inotify.IN_CREATE, isdir=isdir, entry=True)
+        return path
+
+    def exists(self, path):
+        return os.path.normpath(path) in self._entries
+
+    def isdir(self, path):
+        return self._entries.get(os.path.normpath(path), False)
+
+    def listdir(self, path):
+        return sorted(self._children.get(os.path.normpath(path), ()))
+
+    def mkdir(self, path, parents=False):
+        '''Create a directory. If parents is True, also create its missing
+        parent directories, and do not fail if it exists.'''
+        path = os.path.normpath(path)
+        if parents:
+            parent = self._split(path)[0]
+            if parent not in self._entries:
+                self.mkdir(parent, parents=True)
+            if self._entries.get(path):
+                return
+        self._add_entry(path, True)
+
+    def create(self, path):
+        '''Create an empty file.'''
+        self._add_entry(path, False)
+        self._emit(path, inotify.IN_OPEN)
+        self._emit(path, inotify.IN_CLOSE_WRITE)
+
+    def write(self, path, times=1):
+        '''Open a file, create it if needed, write to it times times and
+        close it.'''
+        path = os.path.normpath(path)
+        if path not in self._entries:
+            self._add_entry(path, False)
+        self._emit(path, inotify.IN_OPEN)
+        for i in range(times):
+            self._emit(path, inotify.IN_MODIFY)
+        self._emit(path, inotify.IN_CLOSE_WRITE)
+
+    def modify(self, path):
+        '''Generate a single modify event for a file.'''
+        self._emit(os.path.normpath(path), inotify.IN_MODIFY)
+
+    def remove(self, path):
+        '''Remove a file, or a directory with everything below it.'''
+        path = os.path.normpath(path)
+        isdir = self._entries.get(path)
+        if isdir is None:
+            raise _error(errno.ENOENT, path)
+        for name in list(self._children.get(path, ())):
+            self.remove(self._join(path, name))
+        self._children.pop(path, None)
+        del self._entries[path]
+        if not isdir:
+            index = self._file_index.pop(path)
+            last = self._files.pop()
+            if last != path:
+                self._files[index] = last
+                self._file_index[last] = index
+        parent, name = self._split(path)
+        self._children[parent].discard(name)
+        self._emit_self(path, inotify.IN_DELETE_SELF)
+        for instance in self._instances.values():
+            wd = instance.paths.get(path)
+            if wd is not None:
+                self._unwatch(instance, wd)
+        self._emit(path, inotify.IN_DELETE, isdir=isdir, entry=True)
+
+    def rename(self, src, dst):
+        '''Rename src to dst, replacing dst if it exists.'''
+        src = os.path.normpath(src)
+        dst = os.path.normpath(dst)
+        isdir = self._entries.get(src)
+        if isdir is None:
+            raise _error(errno.ENOENT, src)
+        if dst in self._entries:
+            self.remove(dst)
+        self._cookie += 1
+        cookie = self._cookie
+        srcparent, srcname = self._split(src)
+        dstparent, dstname = self._split(dst)
+        self._emit(src, inotify.IN_MOVED_FROM, cookie, isdir, entry=True)
+        # Move the entries below src, and the watches on them
+        stack = [src]
+        while stack:
+            p = stack.pop()
+            newpath = dst + p[len(src):]
+            self._entries[newpath] = self._entries.pop(p)
+            names = self._children.pop(p, None)
+            if names is not None:
+                self._children[newpath] = names
+                stack.extend(self._join(p, name) for name in names)
+            index = self._file_index.pop(p, None)
+            if index is not None:
+                self._files[index] = newpath
+                self._file_index[newpath] = index
+            for instance in self._instances.values():
+                wd = instance.paths.pop(p, None)
+                if wd is not None:
+                    instance.paths[newpath] = wd
+                    instance.watches[wd][0] = newpath
+        self._children[srcparent].discard(srcname)
+        self._children[dstparent].add(dstname)
+        self._emit(dst, inotify.IN_MOVED_TO, cookie, isdir, entry=True)
+        self._emit_self(dst, inotify.IN_MOVE_SELF)
+
+    def overflow(self):
+        '''Make the queue of every instance overflow.'''
+        for instance in self._instances.values():
+            instance.push(_OVERFLOW, 0)
+
+    def make_tree(self, root, depth, fanout, files=0):
+        '''Create a tree of directories below root, fanout subdirectories
+        per directory and depth levels deep, with files files in every
+        directory. Return the number of directories created.'''
+        self.mkdir(root, parents=True)
+        count = 0
+        level = [os.path.normpath(root)]
+        for d in range(depth + 1):
+            nextlevel = []
+            for parent in level:
+                for i in range(files):
+                    self.create('{}/f{}'.format(parent, i))
+                if d == depth:
+                    continue
+                for i in range(fanout):
+                    path = '{}/d{}'.format(parent, i)
+                    self.mkdir(path)
+                    nextlevel.append(path)
+                    count += 1
+            level = nextlevel
+        return count
+
+    def churn(self, count, hot_files=0.1, hot_share=0.9, renames=0.0,
+              overflow_every=None):
+        '''Generate count modify events on existing files.
+
+        A hot_files fraction of the files receives a hot_share fraction of
+        the events. A renames fraction of the events are renames of the
+        chosen file to a new name in the same directory instead, and every
+        overflow_every events the queues are made to overflow.'''
+        files = self._files
+        if not files:
+            raise ValueError("there are no files to churn")
+        rnd = self.random
+        nhot = max(1, int(len(files) * hot_files))
+        for i in range(count):
+            if rnd.random() < hot_share:
+                index = rnd.randrange(nhot)
+            else:
+                index = rnd.randrange(len(files))
+            path = files[index]
+            if renames and rnd.random() < renames:
+                parent, name = self._split(path)
+                self.rename(path, self._join(parent, 'r{}'.format(self._cookie)))
+            else:
+                self._emit(path, inotify.IN_MODIFY)
+            if overflow_every and (i + 1) % overflow_every == 0:
+                self.overflow()
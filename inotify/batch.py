@@ -0,0 +1,118 @@
+# batch.py - columnar access to raw inotify event buffers
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2.1 of the GNU Lesser General Public
+# License, incorporated herein by reference.
+
+'''Columnar access to raw inotify event buffers.
+
+Reading events with inotify.read() creates a Python object for every event.
+Consumers that only look at a few fields of each event can instead read raw
+records with inotify.readinto() and decode them into an EventBatch, which
+stores the fields of all events in a handful of arrays.'''
+
+from . import _inotify as inotify
+import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def _column(typecode, data):
+    '''Return the bytes object data as a sequence of native integers,
+    without copying it.'''
+    if hasattr(memoryview, 'cast'):
+        return memoryview(data).cast(typecode)
+    # Python 2 memoryviews cannot be cast
+    return array.array(typecode, data)
+
+
+class EventBatch(object):
+    '''A batch of raw inotify events, decoded into columns.
+
+    The following fields are available. The columns are read-only memoryviews
+    of native integers over the decoded data, or arrays on Python 2.
+
+    wd: the watch descriptors, signed
+
+    mask: the event masks, unsigned
+
+    cookie: the rename cookies, 0 for events that are not rename-related
+
+    name_offset, name_length: the offset and length of each event's name
+    within buffer. The length is 0 if the event has no name.
+
+    mask_union: bitwise or of all masks in the batch
+
+    buffer: the buffer the events were decoded from. Names are decoded from
+    this buffer on request, so they are only valid as long as the buffer is
+    not overwritten.
+    '''
+
+    __slots__ = (
+        'buffer',
+        'wd',
+        'mask',
+        'cookie',
+        'name_offset',
+        'name_length',
+        'mask_union',
+        )
+
+    def __init__(self, buffer, nbytes=-1):
+        '''Decode the first nbytes bytes of buffer, or all of it if nbytes is
+        negative.'''
+        self.buffer = buffer
+        (count, self.mask_union, wd, mask, cookie, offset,
+            length) = inotify.decode(buffer, nbytes)
+        self.wd = _column('i', wd)
+        self.mask = _column('I', mask)
+        self.cookie = _column('I', cookie)
+        self.name_offset = _column('I', offset)
+        self.name_length = _column('I', length)
+
+    def __len__(self):
+        return len(self.wd)
+
+    def name(self, i):
+        '''Return the name of the i'th event, or None if it has no name.'''
+        length = self.name_length[i]
+        if not length:
+            return None
+        offset = self.name_offset[i]
+        return bytes(self.buffer[offset:offset+length]).decode('utf-8')
+
+    def names(self):
+        '''Return a list of the names of all events.'''
+        return [self.name(i) for i in range(len(self))]
+
+    def select(self, mask):
+        '''Return a list of the indices of the events that have any of the
+        bits in mask set.'''
+        if not self.mask_union & mask:
+            return []
+        return [i for i, m in enumerate(self.mask) if m & mask]
+
+    def numpy(self):
+        '''Return the wd, mask and cookie columns as numpy arrays, which share
+        memory with this batch, for vectorized filtering.
+
+        Raises ImportError if numpy is not installed.'''
+        if numpy is None:
+            raise ImportError("EventBatch.numpy() requires numpy")
+        return (numpy.frombuffer(self.wd, dtype=numpy.int32),
+                numpy.frombuffer(self.mask, dtype=numpy.uint32),
+                numpy.frombuffer(self.cookie, dtype=numpy.uint32))
+
+    def __repr__(self):
+        return '{}.EventBatch({} events)'.format(__name__, len(self))
+
+
+def read_batch(fd, buffer, block=True):
+    '''Read raw events from fd into buffer with a single read system call, and
+    return them as an EventBatch.
+
+    If block is False and no events are available, return an empty batch.'''
+    return EventBatch(buffer, inotify.readinto(fd, buffer, block=block))
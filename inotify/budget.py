@@ -0,0 +1,277 @@
+# budget.py - keep the number of watches within the kernel limit
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2.1 of the GNU Lesser General Public
+# License, incorporated herein by reference.
+
+'''Watch trees that need more watches than the kernel allows.
+
+The kernel limits the number of watches per user (see max_user_watches()).
+When adding a watch would exceed the limit, inotify_add_watch fails with
+ENOSPC. A WatchBudget instead gives up the watches on the directories that
+have been quiet the longest, and polls those directories for changes until
+they become active again.'''
+
+from . import _inotify as inotify
+from .watcher import AutoWatcher, Event, _DirSnapshot, _clock
+from .stages import Stage, _min_timeout
+import collections
+import errno
+import os
+
+
+class WatchBudget(Stage):
+    '''Stage that keeps the number of watches of a watcher within a budget.
+
+    Watches must be added through the budget's add() and add_all() methods.
+    The budget tracks when each watch last had an event. When more than
+    limit watches would be in use, or the kernel refuses to add a watch
+    because the per-user limit is reached, the least recently active watches
+    on directories without watched subdirectories are removed until
+    low_water * limit watches remain. Evicted directories are polled every
+    poll_interval seconds: only those whose mtime changed are listed and
+    their entries (name, inode and mtime) compared with a snapshot. When a
+    change is found, the directory is watched again and create, delete and
+    modify events for the differences are returned. If it cannot be watched
+    again, the changes are reported on the watch of its nearest watched
+    parent directory, if there is one. A file that is modified in an evicted
+    directory is only noticed once an entry of the directory changes.
+
+    The source must be a Watcher or AutoWatcher. The directories an
+    AutoWatcher adds by itself count against the budget once their create
+    event is read, but the AutoWatcher raises ENOSPC errors itself.
+
+    limit defaults to max_user_watches(), which is shared by all inotify
+    instances of the user. When the kernel refuses a watch before limit is
+    reached, limit is lowered to the number of watches in use.
+
+    The number of evictions and of evicted directories that were watched
+    again are available as the evictions and rearms attributes.'''
+
+    def __init__(self, source, limit=None, low_water=0.9, poll_interval=5.0):
+        super(WatchBudget, self).__init__(source)
+        if limit is None:
+            from . import max_user_watches
+            limit = max_user_watches()
+        self.limit = limit
+        self.low_water = low_water
+        self.poll_interval = poll_interval
+        # wd -> watch, least recently active first
+        self._lru = collections.OrderedDict()
+        # Watch descriptors whose IN_IGNORED event is not passed on
+        self._evicting = set()
+        # path -> (mask, _DirSnapshot) of evicted directories
+        self._evicted = {}
+        self._next_poll = None
+        self.evictions = 0
+        self.rearms = 0
+
+    def num_watches(self):
+        '''Return the number of watches in use.'''
+        return len(self._lru)
+
+    def polled(self):
+        '''Return a list of the evicted directories that are polled.'''
+        return list(self._evicted)
+
+    def _touch(self, watch):
+        self._lru.pop(watch.wd, None)
+        self._lru[watch.wd] = watch
+
+    def _add_or_poll(self, path, mask):
+        '''Add a watch on path, making room if the kernel refuses. Return the
+        watch, or None if path is polled instead.'''
+        try:
+            watch = self.source.add(path, mask)
+        except OSError as err:
+            if err.errno != errno.ENOSPC:
+                raise
+            # Other inotify instances use part of the per-user limit
+            self.limit = min(self.limit, len(self._lru))
+            if not self._evict(int(self.limit * self.low_water)):
+                self._poll_path(path, mask)
+                return None
+            try:
+                watch = self.source.add(path, mask)
+            except OSError as err:
+                if err.errno != errno.ENOSPC:
+                    raise
+                self._poll_path(path, mask)
+                return None
+        self._touch(watch)
+        return watch
+
+    def add(self, path, mask):
+        '''Add or modify a watch. Return the watch, or None if path could
+        not be watched and is polled instead.'''
+        watch = self._add_or_poll(os.path.normpath(path), mask)
+        self._trim()
+        return watch
+
+    def add_all(self, path, mask, onerror=None):
+        '''Add or modify watches over path and its subdirectories, polling
+        the directories that cannot be watched.
+
+        Return a list of the added or modified watches. Errors other than
+        ENOSPC are passed to onerror as for Watcher.add_all().'''
+        failed = []
+
+        def handle(err):
+            if err.errno == errno.ENOSPC:
+                failed.append(err.filename)
+            elif onerror:
+                onerror(err)
+
+        path = os.path.normpath(path)
+        watches = self.source.add_all(path, mask, onerror=handle)
+        for watch in watches:
+            self._touch(watch)
+        for subpath in failed:
+            try:
+                watch = self._add_or_poll(
+                    subpath,
+                    mask if subpath == path else mask | inotify.IN_ONLYDIR)
+            except OSError as err:
+                # The directory may have been removed in the meantime
+                if err.errno in self.source.ignored_errors:
+                    continue
+                if not onerror:
+                    raise
+                onerror(err)
+                continue
+            if watch is not None:
+                watches.append(watch)
+        self._trim()
+        return watches
+
+    def _poll_path(self, path, mask):
+        '''Poll path instead of watching it, unless it is gone or not a
+        directory.'''
+        try:
+            snapshot = _DirSnapshot(path)
+        except OSError as err:
+            if err.errno not in self.source.ignored_errors:
+                raise
+            return
+        self._poll_later(path, mask, snapshot)
+
+    def _poll_later(self, path, mask, snapshot):
+        self._evicted[path] = (mask, snapshot)
+        if self._next_poll is None:
+            self._next_poll = _clock() + self.poll_interval
+
+    def _trim(self):
+        if len(self._lru) > self.limit:
+            self._evict(int(self.limit * self.low_water))
+
+    def _evict(self, target):
+        '''Evict quiet leaf directory watches until at most target are in
+        use. Return the number evicted.'''
+        source = self.source
+        evicted = 0
+        for wd, watch in list(self._lru.items()):
+            if len(self._lru) <= target:
+                break
+            if not source.is_leaf(watch):
+                continue
+            path = watch.path
+            if path is None:
+                continue
+            try:
+                snapshot = _DirSnapshot(path)
+            except OSError:
+                # Not a directory, or gone and an IN_IGNORED will follow
+                continue
+            mask = watch.mask
+            try:
+                source.remove_watch(watch)
+            except OSError:
+                continue
+            del self._lru[wd]
+            self._evicting.add(wd)
+            self._poll_later(path, mask, snapshot)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    def _nearest_watch(self, path):
+        '''Return the watch of the nearest watched parent of path and the
+        path relative to it, or (None, None).'''
+        parent = path
+        while True:
+            parent, _, name = parent.rpartition('/')
+            if not parent:
+                return None, None
+            try:
+                watch = self.source.get_watch(parent)
+            except KeyError:
+                continue
+            return watch, path[len(parent)+1:]
+
+    def _poll(self):
+        '''Rescan the evicted directories, and watch the changed ones
+        again. Return events for the changes.'''
+        events = []
+        for path, (mask, snapshot) in list(self._evicted.items()):
+            try:
+                # Only directories whose mtime changed are listed again
+                changes = list(snapshot.rescan(path))
+            except OSError:
+                del self._evicted[path]
+                continue
+            if not changes:
+                continue
+            del self._evicted[path]
+            watch = self._add_or_poll(path, mask | inotify.IN_ONLYDIR)
+            if watch is not None:
+                self.rearms += 1
+                prefix = ''
+            else:
+                self._evicted[path] = (mask, snapshot)
+                watch, prefix = self._nearest_watch(path)
+                if watch is None:
+                    continue
+                prefix += '/'
+            for change, name in changes:
+                if mask & change & inotify.IN_ALL_EVENTS:
+                    events.append(Event(watch.wd, change, name=prefix + name,
+                                        watch=watch))
+                if change & inotify.IN_CREATE and change & inotify.IN_ISDIR \
+                        and isinstance(self.source, AutoWatcher):
+                    self.add_all(path + '/' + name, mask | inotify.IN_ONLYDIR)
+        self._next_poll = _clock() + self.poll_interval \
+            if self._evicted else None
+        return events
+
+    def process(self, events):
+        out = []
+        lru = self._lru
+        for evt in events:
+            mask = evt.mask
+            if mask & inotify.IN_IGNORED:
+                if evt.wd in self._evicting:
+                    self._evicting.discard(evt.wd)
+                    continue
+                lru.pop(evt.wd, None)
+            elif evt.wd in lru:
+                self._touch(evt.watch)
+            if mask & inotify.IN_ISDIR and evt.name and evt.watch is not None:
+                path = os.path.normpath(evt.fullpath)
+                if mask & inotify.IN_CREATE:
+                    # Directories added by an AutoWatcher
+                    for subpath, watch in self.source.subtree_watches(path):
+                        if watch.wd not in lru:
+                            self._touch(watch)
+                elif mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+                    self._evicted.pop(path, None)
+            out.append(evt)
+        if self._next_poll is not None and _clock() >= self._next_poll:
+            out.extend(self._poll())
+        self._trim()
+        return out
+
+    def timeout(self):
+        own = None
+        if self._next_poll is not None:
+            own = max(0, self._next_poll - _clock())
+        return _min_timeout(own, super(WatchBudget, self).timeout())
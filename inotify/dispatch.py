@@ -0,0 +1,427 @@
+# dispatch.py - fan inotify events out to a pool of worker processes
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2.1 of the GNU Lesser General Public
+# License, incorporated herein by reference.
+
+'''Handle inotify events in a pool of worker processes.
+
+A Dispatcher reads events from a watcher in the calling process, and sends
+them to worker processes that call a handler function for each event. Events
+are partitioned over the workers by a hash of their path, so all events for
+the same path are handled by the same worker, in the order they occurred.
+
+Dispatcher notices dead workers through their process sentinels, so it
+requires Python 3.3 or later.'''
+
+from . import _inotify as inotify
+from . import event_properties
+from .watcher import InotifyWatcherException, _make_getter, _clock
+import collections
+import errno
+import fcntl
+import multiprocessing
+import os
+import pickle
+import select
+import struct
+import traceback
+import zlib
+
+
+class DispatchedEvent(object):
+    '''An event as received by a Dispatcher's handler.
+
+    The following fields are available: wd, mask, cookie, name and
+    fullpath, as on Event. The event flags (modify, isdir, etc.) are
+    available as properties that test the corresponding bit in mask.'''
+
+    __slots__ = (
+        'wd',
+        'mask',
+        'cookie',
+        'name',
+        'fullpath',
+        )
+
+    def __init__(self, wd, mask, cookie, name, fullpath):
+        self.wd = wd
+        self.mask = mask
+        self.cookie = cookie
+        self.name = name
+        self.fullpath = fullpath
+
+    def __repr__(self):
+        return 'DispatchedEvent(fullpath={!r}, mask={})'.format(
+            self.fullpath, '|'.join(inotify.decode_mask(self.mask)))
+
+
+for name, doc in event_properties.items():
+    setattr(DispatchedEvent, name, property(_make_getter(name, doc), doc=doc))
+
+
+# Events are sent to a worker as a pickled list of event tuples, prefixed
+# with its length
+_FRAME = struct.Struct('<I')
+
+
+def _read_exactly(fd, n):
+    '''Read n bytes from fd, or return None at the end of the file.'''
+    chunks = []
+    while n:
+        data = os.read(fd, n)
+        if not data:
+            return None
+        chunks.append(data)
+        n -= len(data)
+    return b''.join(chunks)
+
+
+def _worker(conn, replies, handler):
+    '''Main function of a worker process. Receives lists of event tuples
+    on conn, and replies to each on replies with the number of events
+    handled and a list of formatted tracebacks of the handler's
+    exceptions. Stops at an empty message or when conn is closed.'''
+    fd = conn.fileno()
+    while True:
+        header = _read_exactly(fd, _FRAME.size)
+        if header is None:
+            break
+        length, = _FRAME.unpack(header)
+        data = _read_exactly(fd, length) if length else None
+        if data is None:
+            break
+        batch = pickle.loads(data)
+        errors = []
+        for record in batch:
+            try:
+                handler(DispatchedEvent(*record))
+            except Exception:
+                errors.append(traceback.format_exc())
+        replies.send((len(batch), errors))
+    replies.close()
+
+
+class Dispatcher(object):
+    '''Read events from a watcher and handle them in worker processes.
+
+    handler is called in a worker process with a DispatchedEvent for every
+    event. Events are assigned to a worker by the CRC32 of their fullpath,
+    or by their watch descriptor if key is 'wd', or by the result of key if
+    it is a function of the event. Events without a path, like queue
+    overflows, are sent to all workers. The two events of a rename have
+    different paths, so they may be handled by different workers.
+
+    Events are sent to a worker in one message per batch, over a
+    non-blocking pipe, so a busy worker never stops the dispatcher from
+    reading the kernel queue. At most max_in_flight events are sent to a
+    worker that it has not finished handling yet. The rest wait in the
+    dispatcher, as do batches the worker's pipe has no room for. When more
+    than backlog events are waiting, the policy decides what happens, as
+    for BufferedWatcher: 'block' stops reading until the workers catch up,
+    so events queue up in the kernel again, 'drop_newest' discards new
+    events and 'drop_oldest' discards the oldest waiting events.
+
+    Exceptions raised by the handler are passed to onerror as formatted
+    tracebacks, or raised as an InotifyWatcherException from step(),
+    drain() and run() if onerror is None. If a worker process dies, the
+    events waiting for it are assigned to the remaining workers, and the
+    number of events it had been sent but not finished is reported the
+    same way. The events of a path keep their order, unless they were
+    reassigned because their worker died.
+
+    If the source has a timeout() method, like pipeline stages that hold
+    events back for some time, it is also read when the timeout expires.
+
+    Requires Python 3.3 or later.'''
+
+    policies = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, source, handler, workers=None, key='path',
+                 max_in_flight=4096, backlog=65536, policy='block',
+                 onerror=None, context=None):
+        if not hasattr(multiprocessing.Process, 'sentinel'):
+            raise ImportError("Dispatcher requires Python 3.3 or later")
+        if policy not in self.policies:
+            raise ValueError("policy must be one of {}".format(self.policies))
+        self.source = source
+        self.key = key
+        self.max_in_flight = max_in_flight
+        self.backlog = backlog
+        self.policy = policy
+        self.onerror = onerror
+        self.dispatched = 0
+        self.handled = 0
+        self.dropped = 0
+        ctx = context or multiprocessing
+        # Per worker: the connection events are sent on, the connection
+        # replies are received on, and the process
+        self._conns = []
+        self._replies = []
+        self._processes = []
+        for i in range(workers or ctx.cpu_count()):
+            events_r, events_w = ctx.Pipe(duplex=False)
+            replies_r, replies_w = ctx.Pipe(duplex=False)
+            p = ctx.Process(target=_worker, args=(events_r, replies_w, handler),
+                            name='inotify-worker-{}'.format(i))
+            p.daemon = True
+            p.start()
+            events_r.close()
+            replies_w.close()
+            fd = events_w.fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+            self._conns.append(events_w)
+            self._replies.append(replies_r)
+            self._processes.append(p)
+        n = len(self._conns)
+        # Per worker: (partition hash or None, event tuple) items that are
+        # not sent yet, the unsent rest of a partially written message, the
+        # number of events sent and not finished, and whether it is alive
+        self._pending = [collections.deque() for i in range(n)]
+        self._unsent = [b''] * n
+        self._in_flight = [0] * n
+        self._alive = [True] * n
+        self._live = list(range(n))
+        self._waiting = 0
+        self._errors = []
+
+    def _hash(self, evt, path):
+        key = self.key
+        if key == 'wd':
+            return evt.wd
+        if key != 'path':
+            path = key(evt)
+        if not isinstance(path, bytes):
+            path = str(path).encode('utf-8')
+        return zlib.crc32(path) & 0xffffffff
+
+    def _queue(self, events):
+        for evt in events:
+            path = evt.fullpath
+            record = (evt.wd, evt.mask, evt.cookie, evt.name, path)
+            h = None if path is None else self._hash(evt, path)
+            self._queue_record(h, record)
+
+    def _queue_record(self, h, record):
+        if h is None:
+            targets = self._live
+        else:
+            targets = [self._live[h % len(self._live)]]
+        for i in targets:
+            if self._waiting >= self.backlog and self.policy != 'block':
+                if self.policy == 'drop_newest':
+                    self.dropped += 1
+                    continue
+                self._drop_oldest()
+            self._pending[i].append((h, record))
+            self._waiting += 1
+
+    def _drop_oldest(self):
+        # Drop from the longest queue, its oldest event is likely among the
+        # oldest overall and it is the worker that is furthest behind.
+        pending = max(self._pending, key=len)
+        pending.popleft()
+        self._waiting -= 1
+        self.dropped += 1
+
+    def _write(self, i, data):
+        '''Write as much of data to worker i as its pipe accepts, and
+        return the number of bytes written.'''
+        try:
+            return os.write(self._conns[i].fileno(), data)
+        except OSError as err:
+            if err.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return 0
+            if err.errno == errno.EPIPE:
+                self._died(i)
+                return 0
+            raise
+
+    def _send_one(self, i):
+        '''Send data to worker i. Return whether all of it was accepted,
+        so there may be room for more.'''
+        unsent = self._unsent[i]
+        if unsent:
+            n = self._write(i, unsent)
+            self._unsent[i] = unsent[n:]
+            return n == len(unsent)
+        pending = self._pending[i]
+        room = self.max_in_flight - self._in_flight[i]
+        if not pending or room <= 0:
+            return False
+        count = min(room, len(pending))
+        batch = [pending[j][1] for j in range(count)]
+        data = pickle.dumps(batch, pickle.HIGHEST_PROTOCOL)
+        data = _FRAME.pack(len(data)) + data
+        n = self._write(i, data)
+        if not n:
+            # The events stay pending until the pipe has room
+            return False
+        for j in range(count):
+            pending.popleft()
+        self._unsent[i] = data[n:]
+        self._in_flight[i] += count
+        self._waiting -= count
+        self.dispatched += count
+        return n == len(data)
+
+    def _send(self):
+        for i in list(self._live):
+            while self._alive[i] and self._send_one(i):
+                pass
+
+    def _sendable(self):
+        '''Return the connections of the workers there is data for'''
+        return [self._conns[i] for i in self._live if self._unsent[i] or
+                (self._pending[i] and
+                 self._in_flight[i] < self.max_in_flight)]
+
+    def _receive(self, conn):
+        i = self._replies.index(conn)
+        self._receive_from(i)
+
+    def _exited(self, sentinel):
+        i = [p.sentinel for p in self._processes].index(sentinel)
+        # Handle the replies it sent before it exited first
+        conn = self._replies[i]
+        while self._alive[i] and conn.poll():
+            self._receive_from(i)
+        self._died(i)
+
+    def _receive_from(self, i):
+        conn = self._replies[i]
+        try:
+            handled, errors = conn.recv()
+        except (EOFError, OSError):
+            self._died(i)
+            return
+        self._in_flight[i] -= handled
+        self.handled += handled
+        for error in errors:
+            self._report(error)
+
+    def _report(self, error):
+        if self.onerror is not None:
+            self.onerror(error)
+        else:
+            self._errors.append(error)
+
+    def _died(self, i):
+        '''Stop using worker i, which died, and give its events to the
+        others.'''
+        if not self._alive[i]:
+            return
+        self._alive[i] = False
+        self._live.remove(i)
+        lost = self._in_flight[i]
+        self._in_flight[i] = 0
+        self._unsent[i] = b''
+        pending, self._pending[i] = self._pending[i], collections.deque()
+        self._waiting -= len(pending)
+        self._report("worker {} died with {} unfinished events".format(
+            self._processes[i].name, lost))
+        if not self._live:
+            self.dropped += len(pending)
+            raise InotifyWatcherException("all worker processes died")
+        for h, record in pending:
+            # Events for all workers were already given to the others
+            if h is not None:
+                self._queue_record(h, record)
+
+    def pending(self):
+        '''Return the number of events that are waiting in the dispatcher or
+        are being handled by a worker.'''
+        return self._waiting + sum(self._in_flight)
+
+    def _wait(self, timeout, read_source):
+        '''Wait up to timeout seconds for replies, room in the workers'
+        pipes, or new events if read_source is True, and handle what is
+        ready. Return the number of new events read.'''
+        # A worker that dies is noticed by its process sentinel, as forked
+        # workers hold copies of each other's reply pipes.
+        rlist = [self._replies[i] for i in self._live]
+        sentinels = [self._processes[i].sentinel for i in self._live]
+        rlist.extend(sentinels)
+        # A source that holds events back releases them when its timeout
+        # expires, without its file descriptor becoming readable.
+        source_timeout = None
+        if read_source:
+            rlist.append(self.source)
+            source_timeout = getattr(self.source, 'timeout', None)
+            if source_timeout is not None:
+                source_timeout = source_timeout()
+        if source_timeout is not None and \
+                (timeout is None or source_timeout < timeout):
+            timeout = source_timeout
+        ready, writable = select.select(rlist, self._sendable(), [],
+                                        timeout)[:2]
+        count = 0
+        if source_timeout is not None or self.source in ready:
+            events = self.source.read(block=False)
+            count = len(events)
+            self._queue(events)
+        for obj in ready:
+            if obj is self.source:
+                continue
+            elif obj in sentinels:
+                self._exited(obj)
+            elif self._alive[self._replies.index(obj)]:
+                self._receive(obj)
+        self._send()
+        self._raise_errors()
+        return count
+
+    def step(self, timeout=None):
+        '''Wait up to timeout seconds (forever if None) for new events or
+        for workers to finish events, and dispatch what can be dispatched.
+        Return the number of new events read.'''
+        return self._wait(timeout, self.policy != 'block' or
+                          self._waiting < self.backlog)
+
+    def _raise_errors(self):
+        if self._errors:
+            errors, self._errors = self._errors, []
+            raise InotifyWatcherException(
+                "handler raised an exception:\n" + '\n'.join(errors))
+
+    def run(self):
+        '''Dispatch events until an exception is raised.'''
+        while True:
+            self.step()
+
+    def drain(self, timeout=None):
+        '''Dispatch until all waiting events have been handled, or until
+        timeout seconds have passed. Return whether all were handled.'''
+        deadline = None if timeout is None else _clock() + timeout
+        while self.pending():
+            remaining = None if deadline is None else deadline - _clock()
+            if remaining is not None and remaining <= 0:
+                return False
+            self._wait(remaining, False)
+        return True
+
+    def close(self):
+        '''Stop the worker processes after they handled the events sent to
+        them. Events still waiting in the dispatcher are discarded. This
+        does not close the source.'''
+        # Finish the message being sent, then send the empty message that
+        # stops a worker
+        for i in self._live:
+            fd = self._conns[i].fileno()
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags & ~os.O_NONBLOCK)
+            try:
+                os.write(fd, self._unsent[i] + _FRAME.pack(0))
+            except OSError:
+                pass
+        for conn in self._conns:
+            conn.close()
+        for p in self._processes:
+            p.join()
+        for conn in self._replies:
+            conn.close()
+        self._conns = []
+        self._replies = []
+        self._processes = []
+        self._live = []
@@ -0,0 +1,256 @@
+# journal.py - record inotify events to disk and replay them
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2.1 of the GNU Lesser General Public
+# License, incorporated herein by reference.
+
+'''An append-only binary journal of inotify events.
+
+A Journal stage appends every batch of events that passes through it to a
+file. A JournalReader memory-maps that file and returns the recorded batches
+as Event objects again, so they can be fed to the same stages and handlers
+as live events: to reproduce a burst of events offline, to benchmark
+handlers against recorded traffic, or to let a slow consumer read events
+from disk instead of keeping them in memory.
+
+The file starts with an 8 byte magic string, followed by records. Every
+record has a header with a one byte kind and the length of its payload:
+
+b'B': the start of a batch, with the time it was read in nanoseconds since
+the epoch and the number of events in it
+
+b'P': the path of a watch descriptor, written before the first event of a
+watch and whenever its path changes
+
+b'E': an event, in the kernel's struct inotify_event layout'''
+
+from . import _inotify as inotify
+from .watcher import Event
+from .stages import Stage
+import mmap
+import os
+import struct
+import time
+
+_MAGIC = b'PYINOTJ1'
+_HEADER = struct.Struct('<cxxxI')
+_BATCH = struct.Struct('<qI')
+_WD = struct.Struct('<i')
+_EVENT = struct.Struct('<iIII')
+
+
+class Journal(Stage):
+    '''Stage that appends all events it passes on to a journal file.
+
+    Each batch is written with a single write system call. If the file
+    already exists, the batches are appended to it.'''
+
+    def __init__(self, source, path):
+        super(Journal, self).__init__(source)
+        self.path = path
+        self._file = open(path, 'ab', buffering=0)
+        if self._file.tell() == 0:
+            self._file.write(_MAGIC)
+        # wd -> path written to the journal
+        self._paths = {}
+        self.written = 0
+
+    def process(self, events):
+        if not events:
+            return events
+        buf = bytearray()
+        buf += _HEADER.pack(b'B', _BATCH.size)
+        buf += _BATCH.pack(int(time.time() * 1e9), len(events))
+        paths = self._paths
+        for evt in events:
+            wd = evt.wd
+            watch = evt.watch
+            if watch is not None:
+                path = watch._path()
+                if path is not None and paths.get(wd) != path:
+                    paths[wd] = path
+                    path = path.encode('utf-8')
+                    buf += _HEADER.pack(b'P', _WD.size + len(path))
+                    buf += _WD.pack(wd)
+                    buf += path
+            name = evt.name.encode('utf-8') if evt.name else b''
+            if name:
+                # Pad like the kernel does, to keep records aligned
+                name += b'\0' * (16 - len(name) % 16)
+            buf += _HEADER.pack(b'E', _EVENT.size + len(name))
+            buf += _EVENT.pack(wd, evt.mask, evt.cookie or 0, len(name))
+            buf += name
+            if evt.mask & inotify.IN_IGNORED:
+                paths.pop(wd, None)
+        self._file.write(buf)
+        self.written += len(events)
+        return events
+
+    def close(self):
+        '''Close the journal file and the underlying watcher.'''
+        self._file.close()
+        super(Journal, self).close()
+
+
+class _JournalWatch(object):
+    '''The watch of a replayed event. Only knows the watch's path.'''
+
+    __slots__ = (
+        'wd',
+        'path',
+        )
+
+    def __init__(self, wd, path):
+        self.wd = wd
+        self.path = path
+
+    @property
+    def paths(self):
+        return {self.path}
+
+    def _path(self):
+        return self.path
+
+    def _generation(self):
+        # The path never changes
+        return 0
+
+    def __repr__(self):
+        return '{}.JournalWatch({}, {!r})'.format(__name__, self.wd, self.path)
+
+
+class JournalReader(object):
+    '''Read the batches recorded by a Journal.
+
+    The journal is memory-mapped, so it is not read into memory as a whole.
+    read() returns the events of the next batch, with the path information
+    of the watches at the time they were recorded. The time the batch was
+    recorded, in seconds since the epoch, is available as the time
+    attribute.
+
+    If follow is True, the reader waits for batches that are appended to
+    the journal after the end is reached, like tail -f. Else read() returns
+    an empty list, and iteration stops, at the end of the journal.'''
+
+    def __init__(self, path, follow=False, poll_interval=0.1):
+        self.path = path
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self._file = open(path, 'rb')
+        self._map = None
+        self._size = 0
+        self._pos = len(_MAGIC)
+        self._watches = {}
+        self.time = None
+        self._remap()
+        if self._size < len(_MAGIC) or self._map[:len(_MAGIC)] != _MAGIC:
+            self.close()
+            raise ValueError("{} is not an inotify journal".format(path))
+
+    def _remap(self):
+        '''Map the file again if it grew. Return whether it did.'''
+        size = os.fstat(self._file.fileno()).st_size
+        if size == self._size or size == 0:
+            return False
+        if self._map is not None:
+            self._map.close()
+        self._map = mmap.mmap(self._file.fileno(), size,
+                              access=mmap.ACCESS_READ)
+        self._size = size
+        return True
+
+    def _record(self, pos):
+        '''Return the kind, payload offset and end of the record at pos, or
+        None if it is not completely written yet.'''
+        if pos + _HEADER.size > self._size:
+            return None
+        kind, length = _HEADER.unpack_from(self._map, pos)
+        start = pos + _HEADER.size
+        if start + length > self._size:
+            return None
+        return kind, start, start + length
+
+    def _read_batch(self):
+        data = self._map
+        record = self._record(self._pos)
+        if record is None:
+            return None
+        kind, start, end = record
+        if kind != b'B':
+            raise ValueError("corrupt journal {} at offset {}".format(
+                self.path, self._pos))
+        timestamp, count = _BATCH.unpack_from(data, start)
+        pos = end
+        events = []
+        watches = self._watches
+        while len(events) < count:
+            record = self._record(pos)
+            if record is None:
+                # The batch is still being written
+                return None
+            kind, start, end = record
+            if kind == b'P':
+                wd, = _WD.unpack_from(data, start)
+                path = data[start+_WD.size:end].decode('utf-8')
+                watches[wd] = _JournalWatch(wd, path)
+            elif kind == b'E':
+                wd, mask, cookie, length = _EVENT.unpack_from(data, start)
+                name = None
+                if length:
+                    name = data[start+_EVENT.size:end].rstrip(b'\0')
+                    name = name.decode('utf-8')
+                events.append(Event(wd, mask, cookie=cookie, name=name,
+                                    watch=watches.get(wd)))
+            pos = end
+        self._pos = pos
+        self.time = timestamp / 1e9
+        return events
+
+    def read(self, block=True):
+        '''Return the events of the next batch.
+
+        If follow is True and block is True (the default), wait for a batch
+        to be appended when the end of the journal is reached. Else return
+        an empty list at the end of the journal.'''
+        while True:
+            events = self._read_batch()
+            if events is not None:
+                return events
+            if self._remap():
+                continue
+            if not (self.follow and block):
+                return []
+            time.sleep(self.poll_interval)
+
+    def __iter__(self):
+        while True:
+            events = self.read()
+            if not events:
+                return
+            for e in events:
+                yield e
+
+    def replay(self, speed=1.0):
+        '''Return an iterator of batches that waits between batches as long
+        as the time between their recording, divided by speed. If speed is
+        None, do not wait.'''
+        previous = None
+        start = None
+        while True:
+            events = self.read()
+            if not events:
+                return
+            if speed is not None:
+                now = time.time()
+                if previous is None:
+                    previous, start = self.time, now
+                delay = (self.time - previous) / speed - (now - start)
+                if delay > 0:
+                    time.sleep(delay)
+            yield events
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._file.close()
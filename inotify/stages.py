@@ -0,0 +1,415 @@
+# stages.py - pipeline stages that post-process inotify event batches
+
+# This library is free software; you can redistribute it and/or modify
+# it under the terms of version 2.1 of the GNU Lesser General Public
+# License, incorporated herein by reference.
+
+'''Pipeline stages for inotify event batches.
+
+A stage wraps a Watcher, AutoWatcher or another stage, and transforms each
+batch of events returned by the wrapped object's read() method before passing
+it on. Stages have the same read(), fileno() and iteration interface as a
+Watcher, so they can be stacked, polled with select/poll, and used with
+AsyncWatcher.'''
+
+from . import _inotify as inotify
+from . import event_properties
+from .watcher import AsyncWatcher, Event, _make_getter, _clock
+import collections
+import select
+
+
+def _min_timeout(*timeouts):
+    timeouts = [t for t in timeouts if t is not None]
+    return min(timeouts) if timeouts else None
+
+
+class Stage(object):
+    '''Base class for pipeline stages.
+
+    Subclasses override process(), which receives each batch of events read
+    from the source and returns the batch to pass on.'''
+
+    def __init__(self, source):
+        self.source = source
+
+    def fileno(self):
+        '''Return the file descriptor of the underlying watcher.'''
+        return self.source.fileno()
+
+    def process(self, events):
+        '''Transform a batch of events. The default passes it on unchanged.'''
+        return events
+
+    def timeout(self):
+        '''Return the number of seconds after which this stage may have events
+        to return even if no new inotify events arrive, or None if it only
+        produces events in response to new inotify events.'''
+        return self.source.timeout() if hasattr(self.source, 'timeout') else None
+
+    def read(self, block=True):
+        '''Read and process a batch of events.
+
+        If block is True (the default), block until the processed batch is
+        not empty. Else return an empty list if no events are available.'''
+
+        while True:
+            timeout = self.timeout() if block else None
+            if timeout is None:
+                events = self.process(self.source.read(block=block))
+            else:
+                # Wake up when this stage or a stage below it has timed
+                # events, even if there are no new inotify events.
+                select.select([self], [], [], timeout)
+                events = self.process(self.source.read(block=False))
+            if events or not block:
+                return events
+
+    def __iter__(self):
+        while True:
+            for e in self.read():
+                yield e
+
+    def aio(self, loop=None):
+        '''Return an AsyncWatcher that reads this stage's events on an
+        asyncio event loop.'''
+        return AsyncWatcher(self, loop)
+
+    def close(self):
+        '''Close the underlying watcher.'''
+        self.source.close()
+
+
+class Coalescer(Stage):
+    '''Stage that coalesces redundant events within each batch.
+
+    The following rules can be turned on or off individually, they are all
+    enabled by default:
+
+    collapse_modify: a modify event for a path is dropped if the previous
+    remaining event for the same path was also a modify event.
+
+    fold_create: open, modify and close_write events that follow a create
+    event for the same path are folded into the create event, which is
+    replaced by a MergedEvent with their masks or'ed into its mask. A file
+    that is created and written therefore results in a single event with
+    create, modify and close_write set. The events themselves are not
+    changed.
+
+    cancel_create_delete: if a path is created and deleted again within the
+    same batch, the create, the delete and all events in between for that
+    path are dropped.
+
+    Events are matched by their fullpath. Events are never reordered. A queue
+    overflow event resets the state of all rules, so nothing is coalesced
+    across an overflow.
+
+    The number of events dropped is available as the coalesced attribute.'''
+
+    _modify_only = inotify.IN_MODIFY
+    _foldable = inotify.IN_OPEN | inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE
+
+    def __init__(self, source, collapse_modify=True, fold_create=True,
+                 cancel_create_delete=True):
+        super(Coalescer, self).__init__(source)
+        self.collapse_modify = collapse_modify
+        self.fold_create = fold_create
+        self.cancel_create_delete = cancel_create_delete
+        self.coalesced = 0
+
+    def process(self, events):
+        out = []
+        # path -> index in out of the last remaining event for that path
+        last = {}
+        # path -> index in out of a create event that is still accepting folds
+        folding = {}
+        # path -> index in out of the create event for that path
+        created = {}
+        for evt in events:
+            if evt.q_overflow:
+                last.clear()
+                folding.clear()
+                created.clear()
+                out.append(evt)
+                continue
+            path = evt.fullpath
+            if path is None:
+                out.append(evt)
+                continue
+            kind = evt.mask & ~inotify.IN_ISDIR
+
+            if self.cancel_create_delete and kind == inotify.IN_DELETE \
+                    and path in created:
+                start = created.pop(path)
+                for i in range(start, len(out)):
+                    if out[i] is not None and out[i].fullpath == path:
+                        out[i] = None
+                last.pop(path, None)
+                folding.pop(path, None)
+                continue
+
+            if self.fold_create and path in folding and \
+                    kind & self._foldable and not kind & ~self._foldable:
+                i = folding[path]
+                create = out[i]
+                if isinstance(create, MergedEvent):
+                    create = create.event
+                out[i] = MergedEvent(create, out[i].mask | kind)
+                if kind & inotify.IN_CLOSE_WRITE:
+                    del folding[path]
+                continue
+            folding.pop(path, None)
+
+            if self.collapse_modify and kind == self._modify_only \
+                    and path in last:
+                prev = out[last[path]]
+                if prev is not None and \
+                        prev.mask & ~inotify.IN_ISDIR == self._modify_only:
+                    continue
+
+            if kind & inotify.IN_CREATE:
+                created[path] = len(out)
+                if self.fold_create:
+                    folding[path] = len(out)
+            elif kind & (inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO):
+                created.pop(path, None)
+            last[path] = len(out)
+            out.append(evt)
+
+        result = [e for e in out if e is not None]
+        self.coalesced += len(events) - len(result)
+        return result
+
+
+class MoveEvent(object):
+    '''A rename, combining an IN_MOVED_FROM and the matching IN_MOVED_TO
+    event.
+
+    The following fields and properties are available:
+
+    src, dst: the full paths the entry was moved from and to
+
+    from_event, to_event: the original events
+
+    mask: the combined mask of both events
+
+    The other Event properties (name, watch, fullpath, modify, isdir, ...)
+    refer to the destination.
+    '''
+
+    __slots__ = (
+        'src',
+        'dst',
+        'from_event',
+        'to_event',
+        )
+
+    def __init__(self, from_event, to_event):
+        self.from_event = from_event
+        self.to_event = to_event
+        self.src = from_event.fullpath
+        self.dst = to_event.fullpath
+
+    mask = property(lambda self: self.from_event.mask | self.to_event.mask)
+    cookie = property(lambda self: self.to_event.cookie)
+    wd = property(lambda self: self.to_event.wd)
+    name = property(lambda self: self.to_event.name)
+    watch = property(lambda self: self.to_event.watch)
+    paths = property(lambda self: self.to_event.paths)
+    fullpath = property(lambda self: self.dst)
+
+    def __repr__(self):
+        return 'MoveEvent(src={!r}, dst={!r}, mask={})'.format(
+            self.src, self.dst, '|'.join(inotify.decode_mask(self.mask)))
+
+
+for name, doc in event_properties.items():
+    setattr(MoveEvent, name, property(_make_getter(name, doc), doc=doc))
+
+
+class MovePairer(Stage):
+    '''Stage that combines the two halves of a rename into a MoveEvent.
+
+    IN_MOVED_FROM events are held back until the IN_MOVED_TO event with the
+    same cookie arrives, at which point a single MoveEvent is emitted in its
+    place. An IN_MOVED_TO event without a matching IN_MOVED_FROM (an entry
+    moved in from an unwatched directory) is emitted as a create event.
+
+    At most max_pending halves are held back. A half that has waited longer
+    than max_age seconds, or for max_batches batches if that is not None,
+    or that is pushed out by newer halves, is emitted as a delete event: the
+    entry was moved to an unwatched directory.'''
+
+    def __init__(self, source, max_pending=1024, max_age=1.0,
+                 max_batches=None):
+        super(MovePairer, self).__init__(source)
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self.max_batches = max_batches
+        # cookie -> (event, time received, batch number)
+        self._pending = collections.OrderedDict()
+        self._batch = 0
+
+    @staticmethod
+    def _convert(evt, mask):
+        return Event(evt.wd, mask | (evt.mask & inotify.IN_ISDIR),
+                     name=evt.name, watch=evt.watch)
+
+    def _expired(self, now):
+        if not self._pending:
+            return False
+        evt, t, batch = next(iter(self._pending.values()))
+        return len(self._pending) > self.max_pending or \
+            now - t >= self.max_age or \
+            (self.max_batches is not None and
+                self._batch - batch >= self.max_batches)
+
+    def process(self, events):
+        self._batch += 1
+        now = _clock()
+        out = []
+        for evt in events:
+            mask = evt.mask
+            if mask & inotify.IN_MOVED_FROM:
+                self._pending[evt.cookie] = (evt, now, self._batch)
+            elif mask & inotify.IN_MOVED_TO:
+                pending = self._pending.pop(evt.cookie, None)
+                if pending is None:
+                    out.append(self._convert(evt, inotify.IN_CREATE))
+                else:
+                    out.append(MoveEvent(pending[0], evt))
+            else:
+                out.append(evt)
+        while self._expired(now):
+            evt, t, batch = self._pending.popitem(last=False)[1]
+            out.append(self._convert(evt, inotify.IN_DELETE))
+        return out
+
+    def timeout(self):
+        own = None
+        if self._pending:
+            evt, t, batch = next(iter(self._pending.values()))
+            own = max(0, t + self.max_age - _clock())
+        return _min_timeout(own, super(MovePairer, self).timeout())
+
+
+class MergedEvent(object):
+    '''An event with the masks of later events for the same path added, as
+    emitted by Coalescer and Debouncer.
+
+    mask is the combined mask, event is the original event. All other
+    fields and properties are those of the original event.'''
+
+    __slots__ = (
+        'event',
+        'mask',
+        )
+
+    def __init__(self, event, mask):
+        self.event = event
+        self.mask = mask
+
+    def __getattr__(self, name):
+        return getattr(self.event, name)
+
+    def __repr__(self):
+        return 'MergedEvent({!r}, mask={})'.format(
+            self.event, '|'.join(inotify.decode_mask(self.mask)))
+
+
+for name, doc in event_properties.items():
+    setattr(MergedEvent, name, property(_make_getter(name, doc), doc=doc))
+
+
+class Debouncer(Stage):
+    '''Stage that emits a single event for a path once no new events have
+    arrived for it for quiet seconds.
+
+    Events are held back per fullpath. Every new event for a path restarts
+    its quiet period and its mask is or'ed into the mask of the held event.
+    The first event for the path is emitted, as a MergedEvent with the
+    masks of all later ones added if they added anything. The events
+    themselves are not changed. Events without a fullpath and queue
+    overflow events are passed on immediately.
+
+    Pending paths are kept on a timer wheel with slots of resolution
+    seconds, so scheduling and cancelling a path's timer is O(1). Events
+    are emitted up to resolution seconds after their quiet period ends.
+    Use the timeout() method to find out when to read again when polling,
+    read(block=True) and AsyncWatcher do this automatically.'''
+
+    def __init__(self, source, quiet=1.0, resolution=0.05):
+        super(Debouncer, self).__init__(source)
+        self.quiet = quiet
+        self.resolution = resolution
+        # All deadlines are at most quiet seconds ahead, so the wheel only
+        # needs to span that much time and never wraps around on itself.
+        self._slots = [collections.OrderedDict()
+                       for i in range(int(quiet / resolution) + 2)]
+        # path -> slot index. The slots map a path to its held event and the
+        # combined mask.
+        self._slot_of = {}
+        self._tick = self._ticks(_clock())
+
+    def _ticks(self, t):
+        return int(t / self.resolution)
+
+    def __len__(self):
+        '''Return the number of paths that are waiting to settle.'''
+        return len(self._slot_of)
+
+    def _schedule(self, path, evt, now):
+        mask = evt.mask
+        index = self._slot_of.pop(path, None)
+        if index is not None:
+            evt, held = self._slots[index].pop(path)
+            mask |= held
+        # Round up, so no event is emitted before its quiet period is over
+        index = (self._ticks(now + self.quiet) + 1) % len(self._slots)
+        self._slots[index][path] = (evt, mask)
+        self._slot_of[path] = index
+
+    @staticmethod
+    def _merged(evt, mask):
+        return evt if evt.mask == mask else MergedEvent(evt, mask)
+
+    def _expire(self, now, out):
+        tick = self._ticks(now)
+        steps = min(tick - self._tick, len(self._slots))
+        for i in range(steps):
+            slot = self._slots[(self._tick + 1 + i) % len(self._slots)]
+            for path, (evt, mask) in slot.items():
+                del self._slot_of[path]
+                out.append(self._merged(evt, mask))
+            slot.clear()
+        self._tick = max(tick, self._tick)
+
+    def process(self, events):
+        now = _clock()
+        out = []
+        self._expire(now, out)
+        for evt in events:
+            path = evt.fullpath
+            if path is None or evt.mask & inotify.IN_Q_OVERFLOW:
+                out.append(evt)
+            else:
+                self._schedule(path, evt, now)
+        return out
+
+    def flush(self):
+        '''Return all held events without waiting for them to settle.'''
+        out = []
+        for slot in self._slots:
+            out.extend(self._merged(evt, mask) for evt, mask in slot.values())
+            slot.clear()
+        self._slot_of.clear()
+        return out
+
+    def timeout(self):
+        own = None
+        if self._slot_of:
+            for i in range(1, len(self._slots) + 1):
+                if self._slots[(self._tick + i) % len(self._slots)]:
+                    own = max(0, (self._tick + i) * self.resolution - _clock())
+                    break
+        return _min_timeout(own, super(Debouncer, self).timeout())
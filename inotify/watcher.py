@@ -28,12 +28,30 @@ __author__ = "Jan Kanis <jan.code@jankanis.nl>"
 
 from . import constants
 from . import _inotify as inotify
-from . import event_properties, watch_properties
+from . import watch_properties
+from .backend import kernel
+from .batch import EventBatch
 import array
+import collections
 import errno
 import fcntl
+import mmap
 import os
+import select
+import stat
+import struct
+import sys
 import termios
+import threading
+import time
+import weakref
+import zlib
+
+try:
+    import asyncio
+except ImportError:
+    # Python 2 and Python < 3.4 lack asyncio, AsyncWatcher is not available
+    asyncio = None
 
 
 
@@ -46,7 +64,7 @@ def _make_getter(name, doc):
 
 
 
-class Event(object):
+class Event(inotify.event):
     '''Derived inotify event class.
 
     The following fields and properties are available:
@@ -66,53 +84,71 @@ class Event(object):
 
     wd: watch descriptor that triggered this event
 
+    watch: the watch that triggered this event, or None for events that do
+    not belong to a watch, such as queue overflows
+
+    The event flags (modify, isdir, etc.) are available as properties that
+    test the corresponding bit in mask.
     '''
 
     __slots__ = (
-        'cookie',
-        'mask',
-        'name',
-        'raw',
-        'watch',
+        # The watch generation fullpath was last computed for, and the
+        # result
+        '_fullgen',
+        '_fullpath',
+        # The same for paths
+        '_pathsgen',
+        '_paths',
         )
 
+    @property
+    def raw(self):
+        '''For backward compatibility. Events are no longer wrappers around
+        a raw event object.'''
+        return self
+
     @property
     def paths(self):
-        if self.watch:
-            return list(self.watch.paths)
-        return []
+        # Cached like fullpath
+        watch = self.watch
+        if not watch:
+            return []
+        gen = watch._generation()
+        # The slots are unset on a new event, and getattr with a default
+        # is much cheaper than catching the AttributeError
+        if gen == getattr(self, '_pathsgen', None):
+            return self._paths
+        self._pathsgen = gen
+        self._paths = list(watch.paths)
+        return self._paths
 
     @property
     def fullpath(self):
-        pts = self.paths
-        if pts:
-            p = pts[0]
-            if self.name:
-                p += '/' + self.name
-            return p
-        else:
+        # The watch's generation changes whenever its paths do, so the
+        # result is computed once per event and again only if the watch was
+        # moved in the meantime.
+        watch = self.watch
+        if not watch:
             return None
+        gen = watch._generation()
+        if gen == getattr(self, '_fullgen', None):
+            return self._fullpath
+        self._fullgen = gen
+        p = watch._path()
+        if p is not None and self.name:
+            p += '/' + self.name
+        self._fullpath = p
+        return p
 
     @property
     def mask_list(self):
-        return constants.decode_mask(self.mask)
-
-    def __init__(self, raw, watch):
-        self.raw = raw
-        self.watch = watch
-        self.mask = raw.mask
-        self.cookie = raw.cookie
-        self.name = raw.name
-    
+        return inotify.decode_mask(self.mask)
+
     def __repr__(self):
-        r = repr(self.raw)
+        r = super(Event, self).__repr__()
         return ('Event(paths={}, ' + r[r.find('(')+1:]).format(repr(self.paths))
 
 
-for name, doc in event_properties.items():
-    setattr(Event, name, property(_make_getter(name, doc), doc=doc))
-
-
 class _Watch(object):
     '''Represents a watch on a single file.
 
@@ -120,14 +156,22 @@ class _Watch(object):
 
       wd: The watch descriptor
       paths: A set of paths that this watch watches
+      path: One of those paths, or None if there are none
       mask: The the mask for this watch
+
+    The watcher stores its watches in a compact table, and creates _Watch
+    objects for them when they are asked for. Two _Watch objects are equal
+    if they represent the same watch. A watch that was removed keeps the
+    paths and mask it had when its IN_IGNORED event was read.
     '''
 
     __slots__ = (
         'wd',
-        'paths',
-        'mask',
         '_watcher',
+        # (path, paths, mask, generation) once the watch was removed, else
+        # None
+        '_removed',
+        '__weakref__',
         )
 
     def __init__(self, parent, wd):
@@ -135,22 +179,39 @@ class _Watch(object):
         parent'''
         self._watcher = parent
         self.wd = wd
-        self.paths = set()
-        self.mask = 0
+        self._removed = None
+
+    @property
+    def paths(self):
+        if self._removed is not None:
+            return set(self._removed[1])
+        return self._watcher._table.paths(self.wd)
+
+    @property
+    def path(self):
+        return self._path()
+
+    @property
+    def mask(self):
+        if self._removed is not None:
+            return self._removed[2]
+        return self._watcher._table.mask(self.wd)
+
+    def _path(self):
+        if self._removed is not None:
+            return self._removed[0]
+        return self._watcher._table.path(self.wd)
+
+    def _generation(self):
+        removed = self._removed
+        if removed is not None:
+            return removed[3]
+        return self._watcher._table._gen[self.wd]
 
     def watchno(self):
         '''Return the watch descriptor for this watch'''
         return self.wd
 
-    def _add(self, path, mask):
-        '''add another path to this watch, and update the mask'''
-        self.paths.add(path)
-        self._watcher._paths[path] = self
-        if mask & inotify.IN_MASK_ADD:
-            self.mask &= (mask & ~inotify.IN_MASK_ADD)
-        else:
-            self.mask = mask
-
     def remove_path(self, path):
         '''remove a path from the set of path aliases this watch describes.
         
@@ -158,14 +219,13 @@ class _Watch(object):
         inotify instance. The actual removal will only happen once the matching
         IN_IGNORE event is read from the inotify instance.
         '''
-        try:
-            self.paths.remove(path)
-            del self._watcher._paths[path]
-            if not self.paths:
-                self.remove()
-        except KeyError:
+        table = self._watcher._table
+        if table.get(path) != self.wd:
             raise InotifyWatcherException(
                 '{} does not watch {}'.format(self, path))
+        table.remove_path(path)
+        if table.path(self.wd) is None:
+            self.remove()
 
     def remove(self):
         '''Schedule this watch to be removed from the inotify instance. The
@@ -173,6 +233,16 @@ class _Watch(object):
         has been received.'''
         self._watcher.remove_watch(self)
 
+    def __eq__(self, other):
+        return isinstance(other, _Watch) and self.wd == other.wd and \
+            self._watcher is other._watcher
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((id(self._watcher), self.wd))
+
     def __repr__(self):
         return '{}.Watch({}, {})'.format(__name__, self._watcher, self.wd)
 
@@ -182,20 +252,452 @@ for name, doc in watch_properties.items():
 
 
 
+_IN_IGNORED = inotify.IN_IGNORED
+_IN_MOVE = inotify.IN_MOVE
+
+# time.monotonic is not available on Python 2
+_clock = getattr(time, 'monotonic', time.time)
+_intern = getattr(sys, 'intern', None) or intern
+
+# Layout of the files written by Watcher.save_state(): a header with the
+# number of records, a record per watched path, and the UTF-8 encoded names
+# the records refer to. A record holds the index of the record of the
+# nearest watched parent or -1, the watch mask, the offset and length of the
+# path relative to that parent, and the inode and mtime in nanoseconds.
+_STATE_MAGIC = b'PYINOTWS'
+_STATE_VERSION = 1
+_STATE_HEADER = struct.Struct('<8sII')
+_STATE_RECORD = struct.Struct('<iIIIQq')
+
+
+def _mtime(st):
+    '''Return the mtime of a stat result in nanoseconds.'''
+    mtime = getattr(st, 'st_mtime_ns', None)
+    if mtime is None:
+        # Python 2 only has the float
+        mtime = int(st.st_mtime * 1e9)
+    return mtime
+
+
+class _DirSnapshot(object):
+    '''The entries of a watched directory, used to find out what changed
+    while events were lost.
+
+    entries maps each name to an (inode, mtime, isdir) tuple.'''
+
+    __slots__ = (
+        'mtime',
+        'entries',
+        )
+
+    def __init__(self, path):
+        self.mtime = _mtime(os.stat(path))
+        self.entries = {}
+        for name in os.listdir(path):
+            self.update(path, name)
+
+    def update(self, path, name):
+        '''Refresh the entry for name, or forget it if it no longer
+        exists.'''
+        try:
+            st = os.lstat(path + '/' + name)
+        except OSError:
+            self.entries.pop(name, None)
+            return
+        self.entries[name] = (st.st_ino, _mtime(st), stat.S_ISDIR(st.st_mode))
+
+    def rescan(self, path, force=False):
+        '''If the directory was modified, or if force is True, compare it
+        with the snapshot and update the snapshot.
+
+        Yield (mask, name) tuples describing the differences.'''
+        mtime = _mtime(os.stat(path))
+        if mtime == self.mtime and not force:
+            return
+        self.mtime = mtime
+        old = self.entries
+        self.entries = {}
+        for name in os.listdir(path):
+            self.update(path, name)
+        for name, (ino, mtime, isdir) in self.entries.items():
+            dirmask = inotify.IN_ISDIR if isdir else 0
+            prev = old.pop(name, None)
+            if prev is None:
+                yield inotify.IN_CREATE | dirmask, name
+            elif prev[0] != ino:
+                yield inotify.IN_DELETE | (inotify.IN_ISDIR if prev[2] else 0), name
+                yield inotify.IN_CREATE | dirmask, name
+            elif prev[1] != mtime and not isdir:
+                # Changes inside subdirectories are found through their own
+                # snapshots
+                yield inotify.IN_MODIFY, name
+        for name, (ino, mtime, isdir) in old.items():
+            yield inotify.IN_DELETE | (inotify.IN_ISDIR if isdir else 0), name
+
+
+class _WatchTable(object):
+    '''Compact storage for the watches of a Watcher and their paths.
+
+    Watches are stored in arrays indexed by watch descriptor, holding the
+    watch's mask and the node of its path. The rare watches that have more
+    than one path keep the nodes of their further paths in a separate dict.
+
+    Paths are stored as a tree of nodes. A node is only a parent node, a
+    name and the watch descriptor watching it, stored in arrays indexed by
+    node id, so the directories above the watched paths are stored once and
+    path strings are only built when they are asked for. Nodes that have
+    children have a dict from name to child node, so a directory and
+    everything below it can be found, moved or removed in time proportional
+    to the size of that subtree.'''
+
+    # Node 0 is the root of the tree. It is never a path, so a watch whose
+    # path node is 0 is a watch that currently has no paths.
+    _ROOT = 0
+    # Number of path strings kept in the path cache
+    _PATH_CACHE_SIZE = 4096
+
+    def __init__(self):
+        # Last generation handed out, see generation()
+        self._generation = 0
+        self.clear()
+
+    def clear(self):
+        # Per node: parent node, name, and watch descriptor or -1
+        self._parent = array.array('i', [-1])
+        self._name = [None]
+        self._wd = array.array('i', [-1])
+        # node -> {name: child node}, for nodes that have children
+        self._children = {}
+        self._free = array.array('i')
+        # Per watch descriptor: node of its path or -1 if unused, mask, and
+        # generation
+        self._node = array.array('i')
+        self._mask = array.array('I')
+        self._gen = array.array('Q')
+        # wd -> set of the nodes of the further paths of that watch
+        self._aliases = {}
+        # wd -> path, for the watches whose path was asked for, oldest
+        # first. The entry is dropped whenever any path of the watch changes.
+        self._path_cache = collections.OrderedDict()
+        self._nwatches = 0
+        self._npaths = 0
+
+    # Nodes
+
+    def _new_node(self, parent, name):
+        name = _intern(name)
+        if self._free:
+            node = self._free.pop()
+            self._parent[node] = parent
+            self._name[node] = name
+            self._wd[node] = -1
+        else:
+            node = len(self._name)
+            self._parent.append(parent)
+            self._name.append(name)
+            self._wd.append(-1)
+        children = self._children.get(parent)
+        if children is None:
+            children = self._children[parent] = {}
+        children[name] = node
+        return node
+
+    def _detach(self, node):
+        '''Remove node from its parent's children'''
+        parent = self._parent[node]
+        children = self._children[parent]
+        del children[self._name[node]]
+        if not children:
+            del self._children[parent]
+        return parent
+
+    def _free_node(self, node):
+        self._name[node] = None
+        self._free.append(node)
+
+    def _find(self, path, create=False):
+        node = self._ROOT
+        for name in path.split('/'):
+            children = self._children.get(node)
+            child = children.get(name) if children else None
+            if child is None:
+                if not create:
+                    return -1
+                child = self._new_node(node, name)
+            node = child
+        return node
+
+    def _prune(self, node):
+        '''Remove node and its ancestors for as long as they are unused'''
+        while node != self._ROOT and self._wd[node] == -1 \
+                and node not in self._children:
+            parent = self._detach(node)
+            self._free_node(node)
+            node = parent
+
+    def _path(self, node):
+        names = []
+        while node != self._ROOT:
+            names.append(self._name[node])
+            node = self._parent[node]
+        names.reverse()
+        return '/'.join(names)
+
+    def _walk(self, node):
+        '''Yield the nodes below and including node that have a watch'''
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            if self._wd[node] != -1:
+                yield node
+            children = self._children.get(node)
+            if children:
+                stack.extend(children.values())
+
+    def is_leaf(self, wd):
+        '''Return whether no other watched path lies below the paths of
+        watch wd.'''
+        # Unwatched nodes only exist on the way to watched nodes
+        return not any(node in self._children for node in self._nodes(wd))
+
+    def _nodes(self, wd):
+        node = self._node[wd]
+        # Watches without paths point at the root, removed ones at -1
+        if node == self._ROOT or node == -1:
+            return []
+        return [node] + list(self._aliases.get(wd, ()))
+
+    def _unlink(self, wd, node):
+        '''Remove the path at node from watch wd'''
+        aliases = self._aliases.get(wd)
+        self._changed(wd)
+        if self._node[wd] == node:
+            self._node[wd] = aliases.pop() if aliases else self._ROOT
+        elif aliases:
+            aliases.discard(node)
+        if aliases is not None and not aliases:
+            del self._aliases[wd]
+        self._wd[node] = -1
+        self._npaths -= 1
+
+    # Watches
+
+    def has_watch(self, wd):
+        return 0 <= wd < len(self._node) and self._node[wd] != -1
+
+    def num_watches(self):
+        return self._nwatches
+
+    def num_paths(self):
+        return self._npaths
+
+    def wds(self):
+        return (wd for wd, node in enumerate(self._node) if node != -1)
+
+    def add(self, path, wd, mask):
+        '''Add path to watch wd and update its mask as _Watch._add did. The
+        watch is created if it does not exist yet, return whether it was.'''
+        node = self._find(path, create=True)
+        new = not self.has_watch(wd)
+        if new:
+            if wd >= len(self._node):
+                grow = wd + 1 - len(self._node)
+                self._node.extend(array.array('i', [-1]) * grow)
+                self._mask.extend(array.array('I', [0]) * grow)
+                self._gen.extend(array.array('Q', [0]) * grow)
+            self._node[wd] = self._ROOT
+            self._mask[wd] = 0
+            self._nwatches += 1
+        old = self._wd[node]
+        if old != wd:
+            # The path may have been taken over from a directory that was
+            # replaced by this one.
+            if old != -1:
+                self._unlink(old, node)
+            self._wd[node] = wd
+            self._npaths += 1
+            self._changed(wd)
+            if self._node[wd] == self._ROOT:
+                self._node[wd] = node
+            else:
+                self._aliases.setdefault(wd, set()).add(node)
+        if mask & inotify.IN_MASK_ADD:
+            self._mask[wd] &= (mask & ~inotify.IN_MASK_ADD)
+        else:
+            self._mask[wd] = mask
+        return new
+
+    def remove(self, wd):
+        '''Forget watch wd and all of its paths'''
+        for node in self._nodes(wd):
+            self._wd[node] = -1
+            self._npaths -= 1
+            self._prune(node)
+        self._aliases.pop(wd, None)
+        self._changed(wd)
+        self._node[wd] = -1
+        self._mask[wd] = 0
+        self._nwatches -= 1
+
+    def mask(self, wd):
+        return self._mask[wd]
+
+    def generation(self, wd):
+        '''Return a number that changes whenever a path of watch wd is
+        added, removed or moved, so callers can cache things derived from
+        the watch's paths for as long as it stays the same.'''
+        return self._gen[wd]
+
+    def _changed(self, wd):
+        self._generation += 1
+        self._gen[wd] = self._generation
+        self._path_cache.pop(wd, None)
+
+    def path(self, wd):
+        '''Return one of the paths of watch wd, or None if it has none.'''
+        cache = self._path_cache
+        path = cache.get(wd)
+        if path is None:
+            node = self._node[wd]
+            if node == self._ROOT or node == -1:
+                return None
+            path = self._path(node)
+            if len(cache) >= self._PATH_CACHE_SIZE:
+                cache.popitem(last=False)
+            cache[wd] = path
+        return path
+
+    def paths(self, wd):
+        if wd not in self._aliases:
+            path = self.path(wd)
+            return {path} if path is not None else set()
+        return set(self._path(node) for node in self._nodes(wd))
+
+    # Paths
+
+    def get(self, path):
+        '''Return the watch descriptor watching path, or -1.'''
+        node = self._find(path)
+        return self._wd[node] if node != -1 else -1
+
+    def remove_path(self, path):
+        '''Remove path from its watch. Return the watch descriptor, or -1 if
+        the path was not watched.'''
+        node = self._find(path)
+        wd = self._wd[node] if node != -1 else -1
+        if wd != -1:
+            self._unlink(wd, node)
+            self._prune(node)
+        return wd
+
+    def all_paths(self):
+        return (self._path(node) for node in self._walk(self._ROOT))
+
+    def subtree(self, path):
+        '''Return a list of (path, wd) tuples for path and all paths below
+        it.'''
+        node = self._find(path)
+        if node == -1:
+            return []
+        return [(self._path(n), self._wd[n]) for n in self._walk(node)]
+
+    def move(self, src, dst):
+        '''Move path src and all paths below it to dst. If dst was already
+        present, the paths in its subtree are removed from their watches.'''
+        node = self._find(src)
+        if node == -1 or src == dst:
+            return
+        old = self._find(dst)
+        if old != -1:
+            self._drop(old)
+        dirname, _, name = dst.rpartition('/')
+        if dirname or dst.startswith('/'):
+            parent = self._find(dirname, create=True)
+        else:
+            parent = self._ROOT
+        # Every path below the moved node changes
+        for n in self._walk(node):
+            self._changed(self._wd[n])
+        oldparent = self._detach(node)
+        name = self._name[node] = _intern(name)
+        self._parent[node] = parent
+        self._children.setdefault(parent, {})[name] = node
+        self._prune(oldparent)
+
+    def _drop(self, node):
+        '''Remove node and everything below it from the tree'''
+        self._detach(node)
+        stack = [node]
+        while stack:
+            node = stack.pop()
+            wd = self._wd[node]
+            if wd != -1:
+                self._unlink(wd, node)
+            children = self._children.pop(node, None)
+            if children:
+                stack.extend(children.values())
+            self._free_node(node)
+
+
 class Watcher(object):
     '''Provide a Pythonic interface to the low-level inotify API.
 
     Also adds derived information to each event that is not available
     through the normal inotify API, such as directory name.'''
 
-    def __init__(self):
-        '''Create a new inotify instance.'''
+    def __init__(self, buffer_size=64*1024, name_cache=0,
+                 recover_overflow=False, backend=None):
+        '''Create a new inotify instance.
 
-        self.fd = inotify.init()
-        # self._paths is managed from the Watch objects (except when the _Watch
-        # object is finally removed).
-        self._paths = {}
-        self._watches = {}
+        buffer_size is the size of the buffer events are read into. Each
+        watcher owns its buffer, so different watchers can safely be read
+        from different threads at the same time. Larger buffers need fewer
+        read system calls when many events are queued.
+
+        If name_cache is larger than 0, up to that many event names are
+        cached, so that repeated events for the same file share a single
+        name object instead of decoding the name again for every event.
+
+        If recover_overflow is True, the watcher keeps a snapshot of the
+        entries (name, inode and mtime) of every watched directory, updated
+        as events are read. When the kernel queue overflows, directories
+        whose mtime changed are compared against their snapshot, and
+        synthetic create, delete and modify events are added after the
+        overflow event for the differences found. Only directories whose
+        mtime changed are rescanned, so a modification of an existing file
+        is only detected if its directory was also changed. Keeping the
+        snapshots costs a directory listing per added watch and a stat per
+        event.
+
+        backend provides the inotify system calls, see the backend module.
+        The default uses the kernel.'''
+
+        self._backend = backend or kernel
+        self.fd = self._backend.init()
+        self._buffer = bytearray(buffer_size)
+        self._names = inotify.namecache(name_cache) if name_cache else None
+        self._table = _WatchTable()
+        # wd -> _Watch, for the _Watch objects that are still referenced
+        self._watch_objects = weakref.WeakValueDictionary()
+        # (cookie, path) of the last directory IN_MOVED_FROM event, waiting
+        # for its IN_MOVED_TO. The event itself is not kept, as it refers
+        # back to this watcher.
+        self._moved_from = None
+        # wd -> _DirSnapshot, if overflow recovery is enabled
+        self._snapshots = {} if recover_overflow else None
+        # Created by read_batch when needed
+        self._epoll = None
+        # An _inotify.filter applied to events before they are created
+        self.filter = None
+        # Counters updated by inotify.read(), see stats()
+        self._read_stats = array.array('Q', [0]) * inotify.READ_STATS_SIZE
+        self._counters = collections.Counter()
+        self._add_errors = collections.Counter()
+        # Called with the number of events and the time taken for each batch
+        self.on_batch = None
+        # Events read from the kernel but not yet returned by read(), when
+        # it was limited by max_events. They are processed when returned.
+        self._backlog = collections.deque()
 
     def fileno(self):
         '''Return the file descriptor this watcher uses.
@@ -211,90 +713,454 @@ class Watcher(object):
 
         path = os.path.normpath(path)
         # The path may already be watched, so add in the mask.
-        wd = inotify.add_watch(self.fd, path, mask | inotify.IN_MASK_ADD)
-        if not wd in self._watches:
-            self._watches[wd] = _Watch(self, wd)
-        watch = self._watches[wd]
-        watch._add(path, mask)
+        try:
+            wd = self._backend.add_watch(self.fd, path, mask | inotify.IN_MASK_ADD)
+        except OSError as err:
+            self._add_errors[err.errno] += 1
+            raise
+        return self._register(path, wd, mask)
+
+    def _register(self, path, wd, mask):
+        '''Record that the kernel added or modified watch wd for path'''
+        if self._table.add(path, wd, mask):
+            self._counters['watches_added'] += 1
+        if self._snapshots is not None and wd not in self._snapshots \
+                and os.path.isdir(path):
+            try:
+                self._snapshots[wd] = _DirSnapshot(path)
+            except OSError:
+                pass
+        return self._watch(wd)
+
+    def _watch(self, wd):
+        '''Return the _Watch object for watch descriptor wd'''
+        watch = self._watch_objects.get(wd)
+        if watch is None:
+            watch = self._watch_objects[wd] = _Watch(self, wd)
         return watch
 
+    def set_filter(self, mask=inotify.IN_ALL_EVENTS,
+                   dirmask=inotify.IN_ALL_EVENTS, prefixes=(), suffixes=(),
+                   globs=()):
+        '''Only return events that pass a filter from read().
+
+        The filter is applied to the raw events, so filtered events cost no
+        Python objects. Events on files pass if they have any bit of mask
+        set and, if any name patterns are given, their name starts with one
+        of prefixes, ends with one of suffixes, or matches one of the shell
+        style globs. Events on directories pass if they have any bit of
+        dirmask set, by default all of them pass so AutoWatcher still sees
+        new directories. IN_IGNORED, IN_Q_OVERFLOW and IN_UNMOUNT events
+        always pass.
+
+        The filter is stored in the filter attribute, its passed and
+        filtered attributes count the events. Set the filter attribute to
+        None to remove it. read_raw() does not apply the filter.
+
+        If overflow recovery is enabled, the filter is applied to the event
+        objects after the directory snapshots were updated, and to the
+        synthetic events added after an overflow.'''
+        self.filter = inotify.filter(mask, dirmask, prefixes, suffixes, globs)
+        return self.filter
+
     def remove_watch(self, watch):
         '''Remove the given watch. The watch is only forgotten from the
         internal datastructures once the corresponding IN_IGNORED event is 
         received from the OS.'''
 
-        inotify.remove_watch(self.fd, watch.wd)
+        self._backend.remove_watch(self.fd, watch.wd)
 
-    def remove_path(self, path):
-        '''Remove the watch for the given path.'''
-        try:
-            path = os.path.normpath(path)
-            self._paths[path].remove_path(path)
-        except KeyError:
+    def remove_path(self, path, recursive=False):
+        '''Remove the watch for the given path.
+
+        If recursive is True, also remove the watches for all watched paths
+        below path.'''
+        path = os.path.normpath(path)
+        if recursive:
+            for subpath, wd in self._table.subtree(path):
+                self._watch(wd).remove_path(subpath)
+            return
+        wd = self._table.get(path)
+        if wd == -1:
             raise InotifyWatcherException("{} is not a watched file".format(path))
+        self._watch(wd).remove_path(path)
 
     def _remove(self, wd):
         '''Actually remove a watch'''
-        try:
-            watch = self._watches.pop(wd)
-            for path in watch.paths:
-                self._paths.pop(path)
-        except KeyError:
+        table = self._table
+        if not table.has_watch(wd):
             raise InotifyWatcherException("watchdescriptor {} not known".format(wd))
-
-    def read(self, block=True):
+        # Events of this watch that were already read keep their paths, and
+        # a new watch that reuses the descriptor gets a new _Watch object.
+        watch = self._watch_objects.pop(wd, None)
+        if watch is not None:
+            watch._removed = (table.path(wd), frozenset(table.paths(wd)),
+                              table.mask(wd), table.generation(wd))
+        table.remove(wd)
+        self._counters['watches_removed'] += 1
+        if self._snapshots is not None:
+            self._snapshots.pop(wd, None)
+
+    def _move(self, src, dst):
+        '''Update the paths of the watches in a directory tree that was moved
+        from src to dst.'''
+        self._table.move(src, dst)
+
+    def _track_move(self, evt):
+        '''Pair up directory rename events, to keep the paths of watched
+        subdirectories up to date.'''
+        moved_from, self._moved_from = self._moved_from, None
+        if not evt.mask & inotify.IN_ISDIR or evt.watch is None:
+            return
+        if evt.mask & inotify.IN_MOVED_FROM:
+            src = evt.fullpath
+            if src is not None:
+                self._moved_from = (evt.cookie, src)
+        elif evt.mask & inotify.IN_MOVED_TO and moved_from is not None \
+                and moved_from[0] == evt.cookie:
+            dst = evt.fullpath
+            if dst is not None:
+                self._move(os.path.normpath(moved_from[1]),
+                           os.path.normpath(dst))
+
+    def read(self, block=True, max_events=None, max_bytes=None):
         '''Read a list of queued inotify events.
 
         If block is True (the default), block if no events are
         available immediately. Else return an empty list if no events
-        are available.'''
-
-        if not len(self._watches):
-            raise NoFilesException("There are no files to watch")
+        are available.
+
+        If max_events is not None, at most that many events are returned.
+        Events read from the kernel beyond that are kept, and returned by
+        the next calls to read() before any new events are read. If
+        max_bytes is not None, read system calls are made for about that
+        many bytes of events, instead of for all queued events.'''
+
+        if max_events is not None and max_events < 1:
+            raise ValueError("max_events must be at least 1")
+        table = self._table
+        stats = self._read_stats
+        decode_ns = stats[inotify.STAT_DECODE_NS]
+        backlog = self._backlog
+        if backlog:
+            count = len(backlog)
+            if max_events is not None:
+                count = min(count, max_events)
+            events = [backlog.popleft() for i in range(count)]
+        else:
+            if not table.num_watches():
+                raise NoFilesException("There are no files to watch")
+            # The snapshots must see the events the filter drops, so it is
+            # applied after they are updated if overflow recovery is on.
+            events = self._backend.read(
+                self.fd, block=block, buffer=self._buffer, event_type=Event,
+                names=self._names,
+                filter=self.filter if self._snapshots is None else None,
+                stats=stats, max_events=max_events or 0,
+                max_bytes=max_bytes or 0)
+            if max_events is not None and len(events) > max_events:
+                backlog.extend(events[max_events:])
+                del events[max_events:]
+        start = _clock()
+        self._counters['reads'] += 1
+        # The watch of each descriptor is looked up once per batch, and
+        # only removals and renames take the slow path.
+        watches = {}
+        get = watches.get
+        special = _IN_IGNORED | _IN_MOVE
+        moved_from = self._moved_from
+        for evt in events:
+            watch = get(evt.wd)
+            if watch is None:
+                wd = evt.wd
+                if table.has_watch(wd):
+                    watch = watches[wd] = self._watch(wd)
+            if watch is not None:
+                evt.watch = watch
+            if evt.mask & special or moved_from is not None:
+                if watch is not None and evt.mask & _IN_IGNORED:
+                    self._remove(evt.wd)
+                    del watches[evt.wd]
+                self._track_move(evt)
+                moved_from = self._moved_from
+        if self._snapshots is not None:
+            events = self._update_snapshots(events)
+            if self.filter is not None:
+                match = self.filter.match
+                events = [e for e in events if match(e.mask, e.name)]
+        if self.on_batch is not None and events:
+            self.on_batch(len(events),
+                          (stats[inotify.STAT_DECODE_NS] - decode_ns) / 1e9 + _clock() - start)
+        return events
 
+    def stats(self):
+        '''Return a dict of counters of this watcher's activity.
+
+        reads: calls to read()
+
+        read_syscalls, bytes_read: read system calls made by read(), and the
+        number of bytes they returned
+
+        events: events returned by the kernel and not filtered out
+
+        events_by_mask: dict of the number of events that had each mask bit
+        set, keyed by the bit's name, e.g. 'IN_CREATE'
+
+        overflows: number of IN_Q_OVERFLOW events
+
+        filtered: number of events removed by the filter
+
+        block_time, decode_time: seconds spent in system calls, which
+        includes waiting for events, and creating event objects
+
+        watches, watches_added, watches_removed: the number of active
+        watches, and the number of watches added and removed over the
+        watcher's lifetime
+
+        add_errors: dict of the number of failed watch additions, keyed by
+        errno name, e.g. 'ENOENT'
+
+        Events read with read_raw() are not counted. To measure each batch
+        as it is read, set the on_batch attribute to a function. It is
+        called with the number of events and the time in seconds spent
+        decoding and processing them, excluding any time spent waiting.'''
+
+        stats = self._read_stats
+        by_mask = {}
+        for bit, count in enumerate(stats[inotify.STAT_MASK_BITS:]):
+            if count:
+                for name in inotify.decode_mask(1 << bit):
+                    by_mask[name] = count
+        return {
+            'reads': self._counters['reads'],
+            'read_syscalls': stats[inotify.STAT_SYSCALLS],
+            'bytes_read': stats[inotify.STAT_BYTES],
+            'events': stats[inotify.STAT_EVENTS],
+            'events_by_mask': by_mask,
+            'overflows': by_mask.get('IN_Q_OVERFLOW', 0),
+            'filtered': self.filter.filtered if self.filter else 0,
+            'block_time': stats[inotify.STAT_BLOCK_NS] / 1e9,
+            'decode_time': stats[inotify.STAT_DECODE_NS] / 1e9,
+            'watches': self._table.num_watches(),
+            'watches_added': self._counters['watches_added'],
+            'watches_removed': self._counters['watches_removed'],
+            'add_errors': {errno.errorcode.get(err, str(err)): count
+                           for err, count in self._add_errors.items()},
+            }
+
+    _snapshot_events = (inotify.IN_CREATE | inotify.IN_DELETE |
+                        inotify.IN_MOVE | inotify.IN_MODIFY |
+                        inotify.IN_CLOSE_WRITE | inotify.IN_ATTRIB)
+
+    def _update_snapshots(self, events):
+        '''Keep the directory snapshots up to date with events, and add
+        synthetic events after a queue overflow.'''
+        snapshots = self._snapshots
+        result = events
+        for i, evt in enumerate(events):
+            if evt.mask & inotify.IN_Q_OVERFLOW:
+                if result is events:
+                    result = events[:i+1]
+                else:
+                    result.append(evt)
+                result.extend(self._rescan())
+                continue
+            elif result is not events:
+                result.append(evt)
+            snapshot = snapshots.get(evt.wd)
+            if snapshot is None or not evt.name or \
+                    not evt.mask & self._snapshot_events:
+                continue
+            path = self._table.path(evt.wd)
+            if path is None:
+                continue
+            # The directory's mtime is left alone: it may already include
+            # changes whose events were lost, which the next rescan must see
+            snapshot.update(path, evt.name)
+        return result
+
+    def _rescan(self):
+        '''Return synthetic events for the changes in all watched
+        directories that were modified since their snapshot.'''
         events = []
-        for evt in inotify.read(self.fd, block=block):
-            watch = None if evt.wd == -1 else self._watches[evt.wd]
-            event = Event(evt, watch)
-            events.append(event)
-            if event.ignored:
-                self._remove(event.watch.wd)
+        for wd, snapshot in list(self._snapshots.items()):
+            path = self._table.path(wd)
+            if path is None:
+                continue
+            watch = self._watch(wd)
+            try:
+                for mask, name in snapshot.rescan(path):
+                    if watch.mask & mask & inotify.IN_ALL_EVENTS:
+                        events.append(Event(wd, mask, name=name, watch=watch))
+            except OSError:
+                # The directory is gone, an IN_IGNORED event will follow
+                pass
         return events
 
+    def read_batch(self, min_bytes=4096, max_latency=1.0, block=True):
+        '''Wait until enough events are queued, then read them.
+
+        Events are read once at least min_bytes bytes of events are queued,
+        or max_latency seconds after the first event was queued, whichever
+        comes first. Waiting for events to accumulate greatly reduces the
+        number of read system calls on a busy filesystem. While waiting, the
+        watcher waits on its file descriptor with an edge-triggered epoll,
+        so it wakes up when new events arrive and checks how many bytes are
+        queued. The epoll timeout is the moment min_bytes is expected to be
+        reached at the rate events have been arriving since the first
+        check, so it adapts to the event rate instead of polling at a fixed
+        interval.
+
+        If block is True (the default), first block until any event is
+        available. Else return an empty list if no events are available.'''
+
+        if not self._table.num_watches():
+            raise NoFilesException("There are no files to watch")
+
+        # Events left over by read(max_events=...) are not in the kernel
+        # queue, so waiting on the fd would not see them
+        if self._backlog:
+            return self.read(block=False)
+
+        if self._epoll is None:
+            # Edge-triggered, so a wait only ends for events that arrive
+            # after older ones were seen.
+            self._epoll = select.epoll()
+            self._epoll.register(self.fd, select.EPOLLIN | select.EPOLLET)
+        backend = self._backend
+        queued = backend.readable(self.fd)
+        while not queued and block:
+            self._epoll.poll()
+            queued = backend.readable(self.fd)
+        if not queued:
+            return []
+        start = _clock()
+        first = queued
+        while queued < min_bytes:
+            now = _clock()
+            remaining = max_latency - (now - start)
+            if remaining <= 0:
+                break
+            if queued > first:
+                rate = (queued - first) / (now - start)
+                remaining = min(remaining, (min_bytes - queued) / rate)
+            self._epoll.poll(max(remaining, 0.001))
+            queued = backend.readable(self.fd)
+        return self.read(block=False)
+
+    def iter_events(self, max_events=None, max_bytes=None, block=True):
+        '''Return an iterator of events that reads them in bounded steps.
+
+        Events are read with read(max_events=max_events,
+        max_bytes=max_bytes), and max_bytes defaults to the size of the read
+        buffer. So the events of each kernel buffer are yielded as soon as
+        they are decoded, and the number of event objects alive at a time
+        stays bounded even when a large number of events is queued.
+
+        If block is False, the iterator stops when no more events are
+        queued.'''
+        if max_bytes is None:
+            max_bytes = len(self._buffer)
+        while True:
+            events = self.read(block=block, max_events=max_events,
+                               max_bytes=max_bytes)
+            if not events and not block:
+                return
+            for e in events:
+                yield e
+
+    def timeout(self):
+        '''Return 0 if read() has events to return that are not waiting in
+        the kernel queue, so select and poll do not report them, or None
+        otherwise. Stages and AsyncWatcher use this to not wait for new
+        events first.'''
+        return 0 if self._backlog else None
+
+    def iter_batches(self, min_bytes=4096, max_latency=1.0):
+        '''Return an iterator of event lists, as read by read_batch().'''
+        while True:
+            events = self.read_batch(min_bytes, max_latency)
+            if events:
+                yield events
+
+    def read_raw(self, block=True):
+        '''Read queued events into an EventBatch, without creating an object
+        per event.
+
+        The batch refers to this watcher's read buffer, so its names are only
+        valid until the next call to read() or read_raw(). One read system
+        call is made, so more events may still be queued afterwards.
+
+        If block is True (the default), block if no events are available
+        immediately. Else return an empty batch if no events are available.'''
+
+        if not self._table.num_watches():
+            raise NoFilesException("There are no files to watch")
+
+        batch = EventBatch(self._buffer, self._backend.readinto(
+            self.fd, self._buffer, block=block))
+        if batch.mask_union & inotify.IN_IGNORED:
+            for i in batch.select(inotify.IN_IGNORED):
+                self._remove(batch.wd[i])
+        return batch
+
     def __iter__(self):
         while True:
             for e in self.read():
                 yield e
 
+    def aio(self, loop=None):
+        '''Return an AsyncWatcher that reads this watcher's events on an
+        asyncio event loop.'''
+        return AsyncWatcher(self, loop)
+
     def close(self):
         '''Shut down this watcher.
 
         All subsequent method calls are likely to raise exceptions.'''
 
-        os.close(self.fd)
+        if self._epoll is not None:
+            self._epoll.close()
+            self._epoll = None
+        self._backend.close(self.fd)
         self.fd = None
-        self._paths.clear()
-        self._watches.clear()
+        self._backlog.clear()
+        self._table.clear()
+        self._watch_objects.clear()
 
     def num_paths(self):
         '''Return the number of explicitly watched paths.'''
-        return len(self._paths)
+        return self._table.num_paths()
 
     def num_watches(self):
         '''Return the number of active watches.'''
-        return len(self._watches)
+        return self._table.num_watches()
 
     def watches(self):
         '''Return an iterator of all the watches'''
-        return self._watches.values()
+        return [self._watch(wd) for wd in self._table.wds()]
 
     def paths(self):
         '''Return an iterator of all the watched paths.'''
-        return self._paths.keys()
+        return self._table.all_paths()
 
     def get_watch(self, path):
         'Return the watch for a given path'
-        return self._paths[path]
+        wd = self._table.get(path)
+        if wd == -1:
+            raise KeyError(path)
+        return self._watch(wd)
+
+    def subtree_watches(self, path):
+        '''Return a list of (path, watch) tuples for path and all watched
+        paths below it.'''
+        return [(p, self._watch(wd))
+                for p, wd in self._table.subtree(os.path.normpath(path))]
+
+    def is_leaf(self, watch):
+        '''Return whether no other watched path lies below the paths of
+        watch.'''
+        return self._table.is_leaf(watch.wd)
 
     def __del__(self):
         if self.fd is not None:
@@ -335,17 +1201,31 @@ class Watcher(object):
                 onerror(err)
             else:
                 raise
-        for root, dirs, names in os.walk(path, topdown=False, onerror=onerror):
-            for d in dirs:
-                try:
-                    yield self.add(root + '/' + d, submask)
-                except OSError as err:
-                    if err.errno in self.ignored_errors:
-                        continue
-                    if onerror:
-                        onerror(err)
-                    else:
-                        raise
+
+        # The subdirectories are found and watched in one go by add_tree,
+        # which does not hold the GIL. As the watches are already added by
+        # the time we see any errors, raising an error does not undo them.
+        # add_tree joins names onto path, so path '.' gives './a', which
+        # add() would have normalized to 'a'.
+        added, errors = self._backend.add_tree(
+            self.fd, os.path.normpath(path), submask | inotify.IN_MASK_ADD)
+        for subpath, wd in added:
+            yield self._register(os.path.normpath(subpath), wd, submask)
+        for subpath, err, walk in errors:
+            subpath = os.path.normpath(subpath)
+            if walk:
+                # os.walk semantics: listing errors are only reported
+                if onerror:
+                    onerror(OSError(err, os.strerror(err), subpath))
+                continue
+            self._add_errors[err] += 1
+            if err in self.ignored_errors:
+                continue
+            err = OSError(err, os.strerror(err), subpath)
+            if onerror:
+                onerror(err)
+            else:
+                raise err
 
     def add_all(self, path, mask, onerror=None):
         '''Add or modify watches over path and its subdirectories.
@@ -360,11 +1240,121 @@ class Watcher(object):
 
         return list(self._add_iter(path, mask, onerror))
 
+    def save_state(self, path):
+        '''Save the watched paths and their masks to a file, together with
+        the inode and mtime of each path, so that load_state() can restore
+        them after a restart without walking the whole tree again.
+
+        Paths are stored relative to their nearest watched parent, in a
+        binary format that load_state() reads through mmap.'''
+
+        table = self._table
+        paths = sorted(table.all_paths(), key=lambda p: p.split('/'))
+        index = {}
+        records = []
+        names = bytearray()
+        for p in paths:
+            try:
+                st = os.stat(p)
+            except OSError:
+                continue
+            parent = p
+            while True:
+                parent = parent.rpartition('/')[0]
+                if not parent or parent in index:
+                    break
+            if parent:
+                name = p[len(parent)+1:]
+                parent = index[parent]
+            else:
+                name = p
+                parent = -1
+            name = name.encode('utf-8')
+            index[p] = len(records)
+            records.append(_STATE_RECORD.pack(
+                parent, table.mask(table.get(p)), len(names), len(name),
+                st.st_ino, _mtime(st)))
+            names += name
+
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(_STATE_HEADER.pack(_STATE_MAGIC, _STATE_VERSION,
+                                       len(records)))
+            f.write(b''.join(records))
+            f.write(names)
+        os.rename(tmp, path)
+
+    def load_state(self, path, onerror=None):
+        '''Add the watches saved by save_state().
+
+        Each saved path is watched again directly. Only directories whose
+        inode or mtime changed since the state was saved are listed, and
+        their new subdirectories are added with add_all(). Return a list of
+        the saved paths that changed or no longer exist, so that the caller
+        can find out what happened while it was not watching.
+
+        Errors other than ENOENT and ENOTDIR are passed to onerror if it is
+        given, and ignored otherwise.'''
+
+        with open(path, 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count = _STATE_HEADER.unpack_from(data, 0)
+            if magic != _STATE_MAGIC or version != _STATE_VERSION:
+                raise InotifyWatcherException(
+                    "{} is not a watcher state file".format(path))
+            start = _STATE_HEADER.size
+            blob = start + count * _STATE_RECORD.size
+            paths = []
+            saved = set()
+            changed = []
+            for i in range(count):
+                parent, mask, offset, length, ino, mtime = \
+                    _STATE_RECORD.unpack_from(data, start + i * _STATE_RECORD.size)
+                name = data[blob+offset:blob+offset+length].decode('utf-8')
+                p = paths[parent] + '/' + name if parent != -1 else name
+                paths.append(p)
+                saved.add(p)
+                try:
+                    st = os.stat(p)
+                    wd = self._backend.add_watch(self.fd, p,
+                                                 mask | inotify.IN_MASK_ADD)
+                except OSError as err:
+                    if err.errno in (errno.ENOENT, errno.ENOTDIR):
+                        changed.append(p)
+                    else:
+                        self._add_errors[err.errno] += 1
+                        if onerror:
+                            onerror(err)
+                    continue
+                self._register(p, wd, mask)
+                if st.st_ino != ino or _mtime(st) != mtime:
+                    changed.append(p)
+        finally:
+            data.close()
+
+        # Pick up the subdirectories that were created in changed directories
+        for p in changed:
+            wd = self._table.get(p)
+            if wd == -1:
+                continue
+            submask = self._table.mask(wd) | inotify.IN_ONLYDIR
+            try:
+                names = os.listdir(p)
+            except OSError:
+                continue
+            for name in names:
+                sub = p + '/' + name
+                if sub not in saved and os.path.isdir(sub) \
+                        and not os.path.islink(sub):
+                    self.add_all(sub, submask, onerror=onerror)
+        return changed
+
 
 class AutoWatcher(Watcher):
     '''Watcher class that automatically watches newly created directories.'''
 
-    def __init__(self, addfilter=None):
+    def __init__(self, addfilter=None, **kwargs):
         '''Create a new inotify instance.
 
         This instance will automatically watch newly created
@@ -374,13 +1364,15 @@ class AutoWatcher(Watcher):
         callable that takes one parameter.  It will be called each time
         a directory is about to be automatically watched.  If it returns
         True, the directory will be watched if it still exists,
-        otherwise, it will be skipped.'''
+        otherwise, it will be skipped.
+
+        Other keyword arguments are passed on to Watcher.'''
 
-        super(AutoWatcher, self).__init__()
+        super(AutoWatcher, self).__init__(**kwargs)
         self.addfilter = addfilter
 
-    def read(self, block=False):
-        events = super(AutoWatcher, self).read(block)
+    def read(self, block=False, max_events=None, max_bytes=None):
+        events = super(AutoWatcher, self).read(block, max_events, max_bytes)
         for evt in events:
             if evt.mask & inotify.IN_ISDIR and evt.mask & inotify.IN_CREATE:
                 if self.addfilter is None or self.addfilter(evt):
@@ -394,6 +1386,510 @@ class AutoWatcher(Watcher):
         return events
 
 
+class AsyncWatcher(object):
+    '''Read events from a watcher on an asyncio event loop.
+
+    The inotify file descriptor is registered with the loop's add_reader, and
+    drained with non-blocking reads when it becomes readable, so no thread is
+    blocked waiting for events. Supports `async for event in asyncwatcher`,
+    and `await asyncwatcher.read()` to get a whole batch at once.
+
+    The file descriptor is only registered with the loop while a consumer is
+    waiting for events, so events that are not consumed stay queued in the
+    kernel.
+
+    If the wrapped object has a timeout() method, like pipeline stages that
+    hold events back for some time, it is also read when the timeout expires.
+
+    This class is not thread-safe, use it from the event loop thread only.'''
+
+    def __init__(self, watcher, loop=None):
+        '''Wrap watcher, which can be a Watcher or any other object with a
+        fileno() and a read(block) method. If loop is None, the event loop
+        that is running when events are first awaited is used.'''
+
+        if asyncio is None:
+            raise ImportError("AsyncWatcher requires asyncio, which is available "
+                              "on Python 3.4 and later")
+        self.watcher = watcher
+        self._loop = loop
+        self._pending = collections.deque()
+        self._waiter = None
+        self._batch = False
+        self._fd = None
+        self._timer = None
+
+    def fileno(self):
+        return self.watcher.fileno()
+
+    def _arm_timer(self):
+        timeout = getattr(self.watcher, 'timeout', None)
+        timeout = timeout() if timeout is not None else None
+        if timeout is not None:
+            self._timer = self._loop.call_later(timeout, self._on_readable)
+
+    def _cancel_timer(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+
+    def _get_loop(self):
+        if self._loop is None:
+            self._loop = asyncio.get_event_loop()
+        return self._loop
+
+    def _wait(self, batch):
+        if self._waiter is not None and not self._waiter.done():
+            raise RuntimeError("AsyncWatcher is already being awaited")
+        loop = self._get_loop()
+        fut = loop.create_future()
+        if self._pending:
+            fut.set_result(self._take(batch))
+            return fut
+        self._waiter = fut
+        self._batch = batch
+        fut.add_done_callback(self._waiter_done)
+        self._fd = self.watcher.fileno()
+        loop.add_reader(self._fd, self._on_readable)
+        self._arm_timer()
+        return fut
+
+    def _take(self, batch):
+        if batch:
+            events = list(self._pending)
+            self._pending.clear()
+            return events
+        return self._pending.popleft()
+
+    def _waiter_done(self, fut):
+        # Also called when the waiter is cancelled
+        if self._waiter is fut:
+            self._waiter = None
+            self._cancel_timer()
+            if self._fd is not None:
+                self._loop.remove_reader(self._fd)
+                self._fd = None
+
+    def _on_readable(self):
+        waiter = self._waiter
+        if waiter is None or waiter.done():
+            return
+        self._cancel_timer()
+        try:
+            self._pending.extend(self.watcher.read(block=False))
+        except Exception as err:
+            waiter.set_exception(err)
+            return
+        if self._pending:
+            waiter.set_result(self._take(self._batch))
+        else:
+            self._arm_timer()
+
+    def read(self):
+        '''Return an awaitable that resolves to a non-empty list of events.'''
+        return self._wait(True)
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        return self._wait(False)
+
+    def close(self):
+        '''Stop waiting for events. This does not close the wrapped
+        watcher.'''
+        if self._waiter is not None:
+            self._waiter.cancel()
+        self._pending.clear()
+
+
+class ShardedWatcher(object):
+    '''Spread watches over several inotify instances.
+
+    Each inotify instance has its own kernel event queue, limited to
+    max_queued_events() events, so spreading the watches of a busy tree over
+    several instances multiplies the number of events that can be queued.
+    The events of all instances are merged into one stream, the events and
+    watches are the same as those of a Watcher.
+
+    add_all() puts each top level subdirectory, with everything below it, in
+    the instance selected by a hash of its path. The shards attribute holds
+    the underlying watchers, each of them can also be drained from its own
+    thread, e.g. by wrapping it in a BufferedWatcher.
+
+    A watched directory that is renamed into a directory watched by another
+    shard produces its IN_MOVED_FROM and IN_MOVED_TO events in different
+    instances. read() pairs those events by their cookie to update the paths
+    of the moved subtree, so shards that are drained on their own only keep
+    track of the renames within them.
+
+    The file descriptor returned by fileno() is an epoll instance that is
+    readable when any of the shards is, so a ShardedWatcher can be used with
+    select/poll and AsyncWatcher.'''
+
+    def __init__(self, shards=4, auto=False, **kwargs):
+        '''Create shards inotify instances. If auto is True they are
+        AutoWatchers, else Watchers. Other keyword arguments are passed on to
+        each of them.'''
+        cls = AutoWatcher if auto else Watcher
+        self.shards = [cls(**kwargs) for i in range(shards)]
+        self._epoll = select.epoll()
+        self._byfd = {}
+        # cookie -> (shard, mask, path) of directory rename events whose other
+        # half was not read yet, oldest first
+        self._moves = collections.OrderedDict()
+        for shard in self.shards:
+            self._epoll.register(shard.fileno(), select.EPOLLIN)
+            self._byfd[shard.fileno()] = shard
+
+    def fileno(self):
+        '''Return a file descriptor that is readable when events are
+        available.'''
+        return self._epoll.fileno()
+
+    def shard(self, path):
+        '''Return the watcher that new watches for path are added to.'''
+        key = os.path.normpath(path).encode('utf-8')
+        return self.shards[(zlib.crc32(key) & 0xffffffff) % len(self.shards)]
+
+    def _owner(self, path):
+        path = os.path.normpath(path)
+        for shard in self.shards:
+            if shard._table.get(path) != -1:
+                return shard
+        raise InotifyWatcherException("{} is not a watched file".format(path))
+
+    def add(self, path, mask):
+        '''Add or modify a watch. Return the watch.'''
+        return self.shard(path).add(path, mask)
+
+    def add_all(self, path, mask, onerror=None):
+        '''Add or modify watches over path and its subdirectories.
+
+        Return a list of the added or modified watches. The arguments are the
+        same as for Watcher.add_all().'''
+        path = os.path.normpath(path)
+        try:
+            watches = [self.add(path, mask)]
+        except OSError as err:
+            if onerror:
+                onerror(err)
+                return []
+            raise
+        submask = mask | inotify.IN_ONLYDIR
+        try:
+            names = os.listdir(path)
+        except OSError as err:
+            if onerror:
+                onerror(err)
+            return watches
+        for name in names:
+            subpath = path + '/' + name if path != '/' else '/' + name
+            try:
+                mode = os.lstat(subpath).st_mode
+                # Symlinks to directories are watched but not walked, as
+                # Watcher.add_all() does
+                link = stat.S_ISLNK(mode) and os.path.isdir(subpath)
+            except OSError:
+                continue
+            if not link and not stat.S_ISDIR(mode):
+                continue
+            shard = self.shard(subpath)
+            try:
+                if link:
+                    watches.append(shard.add(subpath, submask))
+                else:
+                    watches.extend(shard.add_all(subpath, submask, onerror))
+            except OSError as err:
+                if err.errno in Watcher.ignored_errors:
+                    continue
+                if not link or not onerror:
+                    raise
+                onerror(err)
+        return watches
+
+    def remove_path(self, path, recursive=False):
+        '''Remove the watch for the given path, and with recursive=True also
+        for all watched paths below it.'''
+        if recursive:
+            for shard in self.shards:
+                shard.remove_path(path, recursive=True)
+        else:
+            self._owner(path).remove_path(path)
+
+    def read(self, block=True, timeout=None):
+        '''Read a list of queued inotify events from all instances.
+
+        If block is True (the default), block until events are available, or
+        until timeout seconds have passed if timeout is not None. Else return
+        an empty list if no events are available.'''
+
+        if not self.num_watches():
+            raise NoFilesException("There are no files to watch")
+
+        if not block:
+            timeout = 0
+        elif timeout is None:
+            timeout = -1
+        while True:
+            events = []
+            for fd, mask in self._epoll.poll(timeout):
+                shard = self._byfd[fd]
+                read = shard.read(block=False)
+                self._track_moves(shard, read)
+                events.extend(read)
+            if events or timeout >= 0:
+                return events
+
+    # Unpaired rename events that are remembered, the directories that are
+    # moved out of the watched tree only have an IN_MOVED_FROM event
+    _max_moves = 1024
+
+    def _track_moves(self, shard, events):
+        '''Pair up directory rename events that were read from different
+        shards, and update the paths of the moved watches.'''
+        moves = self._moves
+        for evt in events:
+            if not evt.mask & inotify.IN_MOVE or \
+                    not evt.mask & inotify.IN_ISDIR or evt.watch is None:
+                continue
+            path = os.path.normpath(evt.fullpath)
+            other = moves.pop(evt.cookie, None)
+            if other is None:
+                moves[evt.cookie] = (shard, evt.mask, path)
+                if len(moves) > self._max_moves:
+                    moves.popitem(last=False)
+                continue
+            othershard, othermask, otherpath = other
+            if othershard is shard or othermask & evt.mask & inotify.IN_MOVE:
+                # The shard paired a rename within it itself
+                continue
+            if evt.mask & inotify.IN_MOVED_TO:
+                src, dst = otherpath, path
+            else:
+                src, dst = path, otherpath
+            for s in self.shards:
+                s._move(src, dst)
+
+    def __iter__(self):
+        while True:
+            for e in self.read():
+                yield e
+
+    def aio(self, loop=None):
+        '''Return an AsyncWatcher that reads the merged events on an asyncio
+        event loop.'''
+        return AsyncWatcher(self, loop)
+
+    def close(self):
+        '''Close all inotify instances.'''
+        for shard in self.shards:
+            shard.close()
+        self._epoll.close()
+
+    def num_paths(self):
+        '''Return the number of explicitly watched paths.'''
+        return sum(shard.num_paths() for shard in self.shards)
+
+    def num_watches(self):
+        '''Return the number of active watches.'''
+        return sum(shard.num_watches() for shard in self.shards)
+
+    def watches(self):
+        '''Return an iterator of all the watches'''
+        return (w for shard in self.shards for w in shard.watches())
+
+    def paths(self):
+        '''Return an iterator of all the watched paths.'''
+        return (p for shard in self.shards for p in shard.paths())
+
+    def get_watch(self, path):
+        '''Return the watch for a given path'''
+        return self._owner(path).get_watch(os.path.normpath(path))
+
+    def stats(self):
+        '''Return the sum of the stats() of all shards.'''
+        total = {}
+        for shard in self.shards:
+            for key, value in shard.stats().items():
+                if isinstance(value, dict):
+                    counts = total.setdefault(key, {})
+                    for k, v in value.items():
+                        counts[k] = counts.get(k, 0) + v
+                else:
+                    total[key] = total.get(key, 0) + value
+        return total
+
+
+class BufferedWatcher(object):
+    '''Drain a watcher from a background thread into a bounded buffer.
+
+    A dedicated reader thread reads events from the watcher as soon as they
+    are available, and stores them in an in-process buffer from which
+    consumers read. This keeps the kernel queue drained even while the
+    consumer is busy handling earlier events.
+
+    When the buffer holds high_water events, the policy decides what
+    happens to new events:
+
+    'block': the reader thread waits until the consumer has made room.
+    Events then queue up in the kernel again.
+
+    'drop_newest': new events are discarded.
+
+    'drop_oldest': the oldest buffered events are discarded to make room.
+
+    Dropped events are counted, see stats(). The reader thread holds the
+    lock attribute while it reads from the watcher. Hold it while adding or
+    removing watches from other threads.
+
+    The file descriptor returned by fileno() is readable while events are
+    buffered, so a BufferedWatcher can be used with select/poll, as the
+    source of a pipeline stage and with AsyncWatcher.'''
+
+    policies = ('block', 'drop_newest', 'drop_oldest')
+
+    def __init__(self, watcher, high_water=65536, policy='block'):
+        if policy not in self.policies:
+            raise ValueError("policy must be one of {}".format(self.policies))
+        self.watcher = watcher
+        self.high_water = high_water
+        self.policy = policy
+        self.lock = threading.Lock()
+        self._buffer = collections.deque()
+        self._cond = threading.Condition()
+        self._error = None
+        self._stopped = False
+        self._received = 0
+        self._dropped = 0
+        self._peak = 0
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        # readable while the buffer is not empty or the reader has failed
+        self._ready_r, self._ready_w = os.pipe()
+        self._ready = False
+        self._thread = threading.Thread(target=self._run,
+                                        name='inotify-reader')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        poll = select.poll()
+        poll.register(self.watcher.fileno(), select.POLLIN)
+        poll.register(self._wakeup_r, select.POLLIN)
+        timeout = getattr(self.watcher, 'timeout', lambda: None)
+        try:
+            while not self._stopped:
+                # Also wake up for the timed events of a wrapped stage
+                t = timeout()
+                ready = [fd for fd, _ in
+                         poll.poll(None if t is None else t * 1000)]
+                if self._wakeup_r in ready:
+                    break
+                with self.lock:
+                    events = self.watcher.read(block=False)
+                self._store(events)
+        except Exception as err:
+            with self._cond:
+                self._error = err
+                self._signal()
+                self._cond.notify_all()
+
+    def _signal(self):
+        # Called with _cond held
+        if not self._ready:
+            os.write(self._ready_w, b'x')
+            self._ready = True
+
+    def _store(self, events):
+        with self._cond:
+            self._received += len(events)
+            buffer = self._buffer
+            for evt in events:
+                if len(buffer) >= self.high_water:
+                    if self.policy == 'drop_newest':
+                        self._dropped += 1
+                        continue
+                    elif self.policy == 'drop_oldest':
+                        buffer.popleft()
+                        self._dropped += 1
+                    else:
+                        while len(buffer) >= self.high_water and \
+                                not self._stopped:
+                            self._cond.wait()
+                        if self._stopped:
+                            return
+                buffer.append(evt)
+            self._peak = max(self._peak, len(buffer))
+            if buffer:
+                self._signal()
+            self._cond.notify_all()
+
+    def read(self, block=True, timeout=None):
+        '''Return a list of all buffered events.
+
+        If block is True (the default), wait until at least one event is
+        available, or until timeout seconds have passed if timeout is not
+        None. Raises the exception that stopped the reader thread, if any.'''
+        with self._cond:
+            if block and not self._buffer:
+                self._wait(timeout)
+            events = list(self._buffer)
+            self._buffer.clear()
+            if self._ready and self._error is None:
+                os.read(self._ready_r, 1)
+                self._ready = False
+            self._cond.notify_all()
+            if not events and self._error is not None:
+                raise self._error
+            return events
+
+    def _wait(self, timeout):
+        # Condition.wait can't be interrupted on Python 2 if it has no
+        # timeout, so wait in steps
+        deadline = None if timeout is None else time.time() + timeout
+        while not self._buffer and self._error is None and not self._stopped:
+            remaining = 1 if deadline is None else deadline - time.time()
+            if remaining <= 0:
+                break
+            self._cond.wait(min(remaining, 1))
+
+    def fileno(self):
+        '''Return a file descriptor that is readable when events are
+        buffered.'''
+        return self._ready_r
+
+    def timeout(self):
+        '''Return 0 if events are buffered, or None otherwise.'''
+        with self._cond:
+            return 0 if self._buffer else None
+
+    def __iter__(self):
+        while True:
+            for e in self.read():
+                yield e
+
+    def stats(self):
+        '''Return a dict with the number of events received from the watcher,
+        dropped, currently buffered, and the largest number of events that
+        was buffered at once.'''
+        with self._cond:
+            return dict(received=self._received, dropped=self._dropped,
+                        buffered=len(self._buffer), peak=self._peak)
+
+    def close(self):
+        '''Stop the reader thread. This does not close the wrapped watcher.'''
+        if self._stopped:
+            return
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+        os.write(self._wakeup_w, b'x')
+        self._thread.join()
+        for fd in (self._wakeup_r, self._wakeup_w, self._ready_r,
+                   self._ready_w):
+            os.close(fd)
+
+
 class Threshold(object):
     '''Class that indicates whether a file descriptor has reached a
     threshold of readable bytes available.
@@ -425,6 +1921,11 @@ class Threshold(object):
 
 
 
+class InotifyWatcherException (Exception):
+    '''A path or watch descriptor is not known to this watcher.'''
+    pass
+
+
 class NoFilesException (Exception):
     '''This inotify instance does not watch anything.'''
     pass
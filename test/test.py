@@ -11,7 +11,7 @@
 
 from __future__ import print_function
 
-import sys, os, shutil, tempfile, inspect
+import sys, os, shutil, tempfile, inspect, time, threading, gc, weakref, select
 import pytest
 
 if not sys.platform.startswith('linux'): raise Exception("This module will only work on Linux")
@@ -99,6 +99,12 @@ def test_alias(w):
   open('testlink').close()
   ev1, ev2 = w.read(block=False)
   assert ev1.open and ev2.close
+  # the cached paths of an event follow the aliases of its watch
+  assert sorted(ev1.paths) == ['testfile', 'testlink']
+  w.remove_path('testlink')
+  assert ev1.paths == ['testfile'] and ev1.fullpath == 'testfile'
+  w.add('testlink', inotify.IN_CLOSE)
+  assert sorted(ev1.paths) == ['testfile', 'testlink']
   w.remove_path('testfile')
   open('testlink').close()
   ev = w.read(block=False)
@@ -121,6 +127,33 @@ def test_noent(w):
         w.add_all('nonexistant', inotify.IN_OPEN)
     assert excinfo.value.errno == os.errno.ENOENT
 
+def test_ignored_event_paths(w):
+  os.mkdir('testdir/a')
+  os.makedirs('testdir/b/c')
+  w.add('testdir/a', inotify.IN_CREATE)
+  w.add_all('testdir/b', inotify.IN_CREATE)
+  open('testdir/a/f', 'w').close()
+  shutil.rmtree('testdir/a')
+  evts = w.read(block=False)
+  # the removed watch keeps its path for the events of the same batch, and
+  # does not borrow another's
+  assert [e.fullpath for e in evts] == ['testdir/a/f', 'testdir/a']
+  assert evts[-1].ignored and evts[-1].paths == ['testdir/a']
+  assert evts[0].watch.path == 'testdir/a'
+  assert evts[0].watch.paths == {'testdir/a'}
+  assert w.get_watch('testdir/b/c').path == 'testdir/b/c'
+  assert 'testdir/a' not in w.paths()
+
+def test_autowatcher_removed_parent():
+  w = watcher.AutoWatcher()
+  os.mkdir('testdir/d')
+  w.add_all('testdir', inotify.IN_CREATE | inotify.IN_DELETE)
+  os.mkdir('testdir/d/sub')
+  shutil.rmtree('testdir/d')
+  evts = w.read(block=False)
+  assert [e.fullpath for e in evts if e.create] == ['testdir/d/sub']
+  assert set(w.paths()) == {'testdir'}
+
 def test_removewatch(w):
   'test Watcher.remove_path and Watcher.remove_watch functionality'
   open('testfile2', 'w').close()
@@ -185,3 +218,851 @@ def test_read_args(w):
 def test_kwarg(w):
   with pytest.raises(TypeError):
     inotify.inotify.read(w.fileno(), False)
+
+
+@pytest.mark.skipif(watcher.asyncio is None, reason="requires asyncio")
+def test_asyncwatcher(w):
+  import asyncio
+  w.add('.', inotify.IN_CREATE | inotify.IN_DELETE)
+  loop = asyncio.new_event_loop()
+  try:
+    aw = w.aio(loop)
+    loop.call_soon(lambda: open('newfile', 'w').close())
+    evt = loop.run_until_complete(asyncio.wait_for(aw.__anext__(), 5))
+    assert evt.create and evt.name == 'newfile'
+    loop.call_soon(os.remove, 'newfile')
+    evts = loop.run_until_complete(asyncio.wait_for(aw.read(), 5))
+    assert [e.name for e in evts] == ['newfile']
+    assert evts[0].delete
+    # nothing is registered with the loop while nobody is waiting
+    assert not loop.remove_reader(w.fileno())
+  finally:
+    aw.close()
+    loop.close()
+
+
+def test_coalescer(w):
+  from inotify import stages
+  w.add('.', inotify.IN_ALL_EVENTS)
+  c = stages.Coalescer(w)
+  with open('newfile', 'w') as f:
+    for i in range(3):
+      f.write('x')
+      f.flush()
+  with open('testfile', 'w') as f:
+    for i in range(3):
+      f.write('x')
+      f.flush()
+  open('tmpfile', 'w').close()
+  os.remove('tmpfile')
+  evts = c.read(block=False)
+  assert not any(e.name == 'tmpfile' for e in evts)
+  new = [e for e in evts if e.name == 'newfile']
+  assert len(new) == 1
+  assert new[0].create and new[0].modify and new[0].close_write
+  # the create event itself is not changed
+  assert new[0].event.mask == inotify.IN_CREATE
+  modifies = [e for e in evts if e.name == 'testfile' and e.modify]
+  assert len(modifies) == 1
+  assert c.coalesced > 0
+
+
+def test_read_buffer(w):
+  w.add('.', inotify.IN_CREATE)
+  buf = bytearray(300)
+  for i in range(20):
+    open('file%02d' % i, 'w').close()
+  evts = inotify.inotify.read(w.fileno(), block=False, buffer=buf)
+  assert [e.name for e in evts] == ['file%02d' % i for i in range(20)]
+  with pytest.raises(ValueError):
+    inotify.inotify.read(w.fileno(), block=False, buffer=bytearray(16))
+  with pytest.raises(BufferError):
+    inotify.inotify.read(w.fileno(), block=False, buffer=b'\0' * 1024)
+  w2 = watcher.Watcher(buffer_size=1024)
+  w2.add('.', inotify.IN_DELETE)
+  for i in range(20):
+    os.remove('file%02d' % i)
+  assert len(w2.read(block=False)) == 20
+
+
+def test_read_raw(w):
+  from inotify import batch
+  w.add('.', inotify.IN_CREATE | inotify.IN_DELETE)
+  watch = w.add('testfile', inotify.IN_DELETE_SELF)
+  assert len(w.read_raw(block=False)) == 0
+  open('newfile', 'w').close()
+  os.remove('testfile')
+  b = w.read_raw(block=False)
+  assert len(b) == 4
+  names = dict(zip(b.mask, b.names()))
+  assert names == {inotify.IN_CREATE: 'newfile', inotify.IN_DELETE: 'testfile',
+                   inotify.IN_DELETE_SELF: None, inotify.IN_IGNORED: None}
+  i, = b.select(inotify.IN_DELETE_SELF)
+  assert b.wd[i] == watch.wd
+  assert len(b.select(inotify.IN_DELETE | inotify.IN_DELETE_SELF)) == 2
+  # the ignored event removed the watch
+  assert w.num_watches() == 1
+
+  buf = bytearray(4096)
+  open('newfile2', 'w').close()
+  n = inotify.inotify.readinto(w.fileno(), buf, block=False)
+  b = batch.EventBatch(buf, n)
+  assert b.names() == ['newfile2']
+  with pytest.raises(ValueError):
+    batch.EventBatch(buf, n - 1)
+
+
+def test_event_type(w):
+  w.add('.', inotify.IN_CREATE)
+  os.mkdir('newdir')
+  evt, = w.read(block=False)
+  assert isinstance(evt, inotify.inotify.event)
+  assert evt.raw is evt
+  assert evt.wd == evt.watch.wd
+  assert evt.mask == inotify.IN_CREATE | inotify.IN_ISDIR
+  assert evt.isdir == inotify.IN_ISDIR and evt.create and not evt.modify
+  assert evt.cookie is None
+  assert evt.fullpath == './newdir'
+  assert 'IN_CREATE' in repr(evt) and "paths=['.']" in repr(evt)
+  assert not hasattr(evt, '__dict__')
+
+  e = watcher.Event(1, inotify.IN_MOVED_TO, cookie=5, name='x')
+  assert e.moved_to and e.move and e.cookie == 5
+  assert e.watch is None and e.fullpath is None
+  e.mask = inotify.IN_DELETE
+  assert e.cookie is None and e.delete
+  with pytest.raises(TypeError):
+    inotify.inotify.read(w.fileno(), block=False, event_type=object)
+
+
+def test_name_cache():
+  w = watcher.Watcher(name_cache=2)
+  w.add('.', inotify.IN_OPEN | inotify.IN_CLOSE)
+  names = ['testfile', 'a', 'testfile', 'b', 'c', 'testfile']
+  for name in names:
+    open(name, 'a').close()
+  evts = w.read(block=False)
+  assert [e.name for e in evts] == [n for n in names for i in (1, 2)]
+  assert evts[0].name is evts[1].name is evts[4].name
+  # 'testfile' was evicted by 'b' and 'c'
+  assert evts[10].name is not evts[0].name
+  assert (w._names.hits, w._names.misses) == (7, 5)
+  assert len(w._names) == 2
+  assert w._names.get('c') is evts[8].name
+  w._names.clear()
+  assert len(w._names) == 0
+
+
+def test_add_all(w):
+  for d in ['testdir/a', 'testdir/a/b', 'testdir/c', 'other']:
+    os.mkdir(d)
+  os.symlink('../other', 'testdir/link')
+  open('testdir/a/file', 'w').close()
+  watches = w.add_all('testdir', inotify.IN_CREATE)
+  assert len(watches) == 5
+  assert set(w.paths()) == {'testdir', 'testdir/a', 'testdir/a/b', 'testdir/c', 'testdir/link'}
+  assert all(wt.onlydir for wt in watches[1:])
+  open('testdir/a/b/new', 'w').close()
+  evt, = w.read(block=False)
+  assert evt.fullpath == 'testdir/a/b/new'
+
+  errors = []
+  os.mkdir('testdir/c/locked')
+  os.mkdir('testdir/c/locked/sub')
+  os.chmod('testdir/c/locked', 0)
+  try:
+    w.add_all('testdir', inotify.IN_CREATE, onerror=errors.append)
+  finally:
+    os.chmod('testdir/c/locked', 0o755)
+  if os.geteuid() != 0:
+    assert [e.filename for e in errors] == ['testdir/c/locked']
+
+  # paths below '.' are stored normalized, as add() stores them
+  w2 = watcher.Watcher()
+  w2.add_all('.', inotify.IN_CREATE)
+  assert 'testdir/a/b' in w2.paths() and not any(p.startswith('./') for p in w2.paths())
+  w2.remove_path('testdir/a/b')
+  w2.close()
+
+
+def test_move_dir():
+  w = watcher.AutoWatcher()
+  for d in ['testdir/a', 'testdir/a/b', 'testdir/c']:
+    os.mkdir(d)
+  w.add_all('testdir', inotify.IN_ALL_EVENTS)
+  os.rename('testdir/a', 'testdir/c/moved')
+  w.read(block=False)
+  assert set(w.paths()) == {'testdir', 'testdir/c', 'testdir/c/moved', 'testdir/c/moved/b'}
+  assert w.get_watch('testdir/c/moved/b').paths == {'testdir/c/moved/b'}
+  open('testdir/c/moved/b/file', 'w').close()
+  evts = w.read(block=False)
+  assert evts[0].fullpath == 'testdir/c/moved/b/file'
+  # fullpath and paths are cached, but follow later moves of the watch
+  assert evts[0].fullpath is evts[0].fullpath
+  assert evts[0].paths is evts[0].paths
+  os.rename('testdir/c/moved', 'testdir/c/again')
+  w.read(block=False)
+  assert evts[0].fullpath == 'testdir/c/again/b/file'
+  assert evts[0].paths == ['testdir/c/again/b']
+
+  w.remove_path('testdir/c', recursive=True)
+  assert set(w.paths()) == {'testdir'}
+  w.read(block=False)
+  assert w.num_watches() == 1
+  with pytest.raises(watcher.InotifyWatcherException):
+    w.remove_path('testdir/c')
+
+  # an unpaired directory move does not keep the watcher alive
+  os.mkdir('testdir/out')
+  w.add('testdir', inotify.IN_ALL_EVENTS)
+  os.rename('testdir/out', 'gone')
+  evts = w.read(block=False)
+  assert gc.is_tracked(evts[0])
+  ref = weakref.ref(w)
+  w.close()
+  del w, evts
+  assert ref() is None
+
+def test_move_pairer(w):
+  from inotify import stages
+  w.add('.', inotify.IN_MOVE)
+  w.add('testdir', inotify.IN_MOVE)
+  p = stages.MovePairer(w, max_age=0.2)
+  os.rename('testfile', 'testdir/renamed')
+  evt, = p.read(block=False)
+  assert isinstance(evt, stages.MoveEvent)
+  assert (evt.src, evt.dst) == ('./testfile', 'testdir/renamed')
+  assert evt.moved_from and evt.moved_to and not evt.isdir
+
+  outside = tempfile.mkdtemp(prefix='inotify-test-outside-')
+  try:
+    os.rename('testdir/renamed', outside + '/gone')
+    assert p.read(block=False) == []
+    assert 0 < p.timeout() <= 0.2
+    evt, = p.read()
+    assert evt.delete and evt.fullpath == 'testdir/renamed'
+    os.rename(outside + '/gone', 'back')
+    evt, = p.read(block=False)
+    assert evt.create and evt.fullpath == './back'
+    # halves that were merged by an earlier stage are converted as well
+    os.mkdir(outside + '/sub')
+    os.rename(outside + '/sub', 'sub')
+    merged = [stages.MergedEvent(e, e.mask) for e in w.read(block=False)]
+    evt, = p.process(merged)
+    assert isinstance(evt, watcher.Event)
+    assert evt.create and evt.isdir and evt.fullpath == './sub'
+  finally:
+    shutil.rmtree(outside)
+
+
+def test_overflow_recovery():
+  w = watcher.AutoWatcher(recover_overflow=True)
+  open('testdir/a', 'w').close()
+  open('testdir/b', 'w').close()
+  os.mkdir('testdir/sub')
+  w.add_all('testdir', inotify.IN_ALL_EVENTS)
+  time.sleep(0.01)
+  open('testdir/early', 'w').close()
+  # Fill the kernel queue with opens and closes until it overflows, so the
+  # changes below are lost and only found by rescanning
+  with open('/proc/sys/fs/inotify/max_queued_events') as f:
+    limit = int(f.read())
+  for i in range(limit // 2 + 1):
+    os.close(os.open('testdir/b', os.O_RDONLY))
+  os.remove('testdir/a')
+  open('testdir/new', 'w').close()
+  os.mkdir('testdir/newdir')
+  time.sleep(0.01)
+  with open('testdir/b', 'w') as f:
+    f.write('changed')
+  open('testdir/sub/untouched', 'w').close()
+
+  # Read in small batches, so the overflow comes after the early event was
+  # seen in an earlier read
+  evts = []
+  while True:
+    read = w.read(block=False, max_events=10)
+    if not read:
+      break
+    evts.extend(read)
+  assert [e.name for e in evts if e.create][0] == 'early'
+  overflows = [i for i, e in enumerate(evts) if e.mask & inotify.IN_Q_OVERFLOW]
+  assert len(overflows) == 1
+  # The rescan itself opens the directories, ignore those events
+  changes = sorted((e.name, sorted(inotify.decode_mask(e.mask)))
+                   for e in evts[overflows[0]+1:]
+                   if e.create or e.delete or e.modify)
+  assert changes == [('a', ['IN_DELETE']), ('b', ['IN_MODIFY']),
+                     ('new', ['IN_CREATE']),
+                     ('newdir', ['IN_CREATE', 'IN_ISDIR']),
+                     ('untouched', ['IN_CREATE'])]
+  # nothing changed since the rescan
+  assert w._rescan() == []
+
+
+def test_buffered_watcher(w):
+  w.add('.', inotify.IN_CREATE)
+  b = watcher.BufferedWatcher(w, high_water=3, policy='drop_oldest')
+  try:
+    for i in range(5):
+      open('file%d' % i, 'w').close()
+    deadline = time.time() + 5
+    while b.stats()['received'] < 5 and time.time() < deadline:
+      time.sleep(0.01)
+    evts = b.read(timeout=5)
+    assert [e.name for e in evts] == ['file2', 'file3', 'file4']
+    assert b.stats() == dict(received=5, dropped=2, buffered=0, peak=3)
+    assert b.read(block=False) == []
+    assert b.read(timeout=0.01) == []
+
+    # fileno() is readable while events are buffered
+    assert select.select([b], [], [], 0)[0] == [] and b.timeout() is None
+    open('file5', 'w').close()
+    assert select.select([b], [], [], 5)[0] == [b]
+    while b.timeout() is None and time.time() < deadline:
+      time.sleep(0.01)
+    assert b.timeout() == 0
+    assert [e.name for e in b.read(block=False)] == ['file5']
+    assert select.select([b], [], [], 0)[0] == []
+
+    # so it can be the source of a stage
+    from inotify import stages
+    open('file6', 'w').close()
+    evt, = stages.Coalescer(b).read()
+    assert evt.name == 'file6' and evt.create
+  finally:
+    b.close()
+
+
+def test_sharded_watcher():
+  for i in range(8):
+    os.mkdir('testdir/d%d' % i)
+    os.mkdir('testdir/d%d/sub' % i)
+  # symlinks to directories are watched but not followed, like add_all does
+  os.makedirs('other/sub')
+  os.symlink('../other', 'testdir/link')
+  w = watcher.ShardedWatcher(shards=3, auto=True)
+  try:
+    w.add_all('testdir', inotify.IN_CREATE | inotify.IN_MOVE)
+    assert w.num_watches() == 18
+    assert sorted(w.paths()) == sorted(['testdir', 'testdir/link'] +
+        ['testdir/d%d' % i for i in range(8)] + ['testdir/d%d/sub' % i for i in range(8)])
+    assert sum(1 for s in w.shards if s.num_watches()) > 1
+    assert w.get_watch('testdir/d3/sub') is w.shard('testdir/d3').get_watch('testdir/d3/sub')
+    for i in range(8):
+      open('testdir/d%d/sub/file' % i, 'w').close()
+    evts = []
+    while len(evts) < 8:
+      evts.extend(w.read(timeout=5))
+    assert sorted(e.fullpath for e in evts) == ['testdir/d%d/sub/file' % i for i in range(8)]
+    assert w.read(block=False) == []
+
+    # a directory renamed into a directory of another shard keeps its watch
+    src = 'testdir/d0'
+    dst = next('testdir/d%d' % i for i in range(1, 8)
+               if w.shard('testdir/d%d' % i) is not w.shard(src))
+    os.rename(src + '/sub', dst + '/moved')
+    evts = []
+    while len(evts) < 2:
+      evts.extend(w.read(timeout=5))
+    assert w.get_watch(dst + '/moved') is not None
+    with pytest.raises(watcher.InotifyWatcherException):
+      w.get_watch(src + '/sub')
+    open(dst + '/moved/new', 'w').close()
+    evt, = w.read(timeout=5)
+    assert evt.fullpath == dst + '/moved/new'
+  finally:
+    w.close()
+
+
+def test_read_batch(w):
+  w.add('.', inotify.IN_CREATE)
+  assert w.read_batch(block=False) == []
+  open('file0', 'w').close()
+  start = time.time()
+  evts = w.read_batch(min_bytes=1 << 20, max_latency=0.1)
+  assert 0.09 < time.time() - start < 2
+  assert [e.name for e in evts] == ['file0']
+  for i in range(1, 4):
+    open('file%d' % i, 'w').close()
+  start = time.time()
+  evts = next(w.iter_batches(min_bytes=16, max_latency=10))
+  assert time.time() - start < 1
+  assert [e.name for e in evts] == ['file1', 'file2', 'file3']
+
+  # events that keep arriving end the wait once min_bytes is reached
+  def create():
+    for i in range(20):
+      open('slow%02d' % i, 'w').close()
+      time.sleep(0.015)
+  t = threading.Thread(target=create)
+  start = time.time()
+  t.start()
+  evts = w.read_batch(min_bytes=8 * 32, max_latency=2.0)
+  assert time.time() - start < 1
+  assert len(evts) >= 8
+  t.join()
+
+  # events left over by a bounded read are returned without waiting
+  w.read(block=False)
+  for i in range(3):
+    open('left%d' % i, 'w').close()
+  assert [e.name for e in w.read(block=False, max_events=1)] == ['left0']
+  start = time.time()
+  assert [e.name for e in w.read_batch(max_latency=5)] == ['left1', 'left2']
+  assert time.time() - start < 1
+
+
+def test_filter(w):
+  w.add('.', inotify.IN_CREATE | inotify.IN_CLOSE_WRITE)
+  f = w.set_filter(mask=inotify.IN_CLOSE_WRITE, suffixes=['.parquet'],
+                   prefixes=['keep'], globs=['data-[0-9].csv'])
+  for name in ['a.parquet', 'a.tmp', 'keep.tmp', 'data-1.csv', 'data-x.csv']:
+    open(name, 'w').close()
+  os.mkdir('newdir')
+  evts = w.read(block=False)
+  assert [(e.name, e.mask) for e in evts] == [
+    ('a.parquet', inotify.IN_CLOSE_WRITE), ('keep.tmp', inotify.IN_CLOSE_WRITE),
+    ('data-1.csv', inotify.IN_CLOSE_WRITE), ('newdir', inotify.IN_CREATE | inotify.IN_ISDIR)]
+  assert (f.passed, f.filtered) == (4, 7)
+  w.filter = None
+  open('a.tmp', 'w').close()
+  assert len(w.read(block=False)) == 1
+
+
+def test_filter_overflow_recovery():
+  w = watcher.Watcher(recover_overflow=True)
+  w.add('testdir', inotify.IN_CREATE | inotify.IN_DELETE)
+  w.set_filter(prefixes=['keep'])
+  open('testdir/skip', 'w').close()
+  open('testdir/keep', 'w').close()
+  assert [e.name for e in w.read(block=False)] == ['keep']
+  time.sleep(0.01)
+  open('testdir/skip2', 'w').close()
+  open('testdir/keep2', 'w').close()
+  # an overflow that lost those events: the snapshot saw the filtered
+  # event, and the synthetic events are filtered too
+  w._backlog.append(watcher.Event(-1, inotify.IN_Q_OVERFLOW))
+  evts = w.read(block=False)
+  assert [(e.name, e.mask) for e in evts] == [
+    (None, inotify.IN_Q_OVERFLOW), ('keep2', inotify.IN_CREATE)]
+
+def test_debouncer(w):
+  import asyncio
+  from inotify import stages
+  w.add('.', inotify.IN_MODIFY | inotify.IN_CLOSE_WRITE)
+  d = stages.Debouncer(w, quiet=0.2, resolution=0.02)
+  with open('testfile', 'w') as f:
+    for i in range(3):
+      f.write('x')
+      f.flush()
+      assert d.read(block=False) == []
+  assert len(d) == 1 and 0 < d.timeout() <= 0.25
+  start = time.time()
+  evt, = d.read()
+  assert time.time() - start >= 0.15
+  assert evt.fullpath == './testfile' and evt.modify and evt.close_write
+  # the original event is not changed
+  assert isinstance(evt, stages.MergedEvent) and evt.event.mask == inotify.IN_MODIFY
+  assert len(d) == 0 and d.timeout() is None
+
+  # merging into the MoveEvents of a MovePairer below
+  open('testdir/x', 'w').close()
+  w2 = watcher.Watcher()
+  w2.add('testdir', inotify.IN_MOVE | inotify.IN_CLOSE_WRITE)
+  d2 = stages.Debouncer(stages.MovePairer(w2), quiet=10)
+  os.rename('testdir/x', 'testdir/y')
+  open('testdir/y', 'w').close()
+  assert d2.read(block=False) == []
+  evt, = d2.flush()
+  assert (evt.src, evt.dst) == ('testdir/x', 'testdir/y')
+  assert evt.moved_from and evt.moved_to and evt.close_write
+  w2.close()
+
+  loop = asyncio.new_event_loop()
+  try:
+    aw = d.aio(loop)
+    loop.call_soon(lambda: open('testfile', 'w').close())
+    evts = loop.run_until_complete(asyncio.wait_for(aw.read(), 5))
+    assert [e.name for e in evts] == ['testfile']
+  finally:
+    aw.close()
+    loop.close()
+
+
+def test_stats(w):
+  batches = []
+  w.on_batch = lambda n, t: batches.append((n, t))
+  w.add('.', inotify.IN_CREATE | inotify.IN_DELETE)
+  try:
+    w.add('nonexistent', inotify.IN_CREATE)
+  except OSError:
+    pass
+  open('newfile', 'w').close()
+  os.remove('newfile')
+  assert len(w.read(block=False)) == 2
+  assert w.read(block=False) == []
+  s = w.stats()
+  assert s['reads'] == 2 and s['read_syscalls'] == 1 and s['events'] == 2
+  # struct inotify_event plus 'newfile' padded to 16 bytes, twice
+  assert s['bytes_read'] == 2 * (16 + 16)
+  assert s['events_by_mask'] == {'IN_CREATE': 1, 'IN_DELETE': 1}
+  assert s['overflows'] == 0 and s['decode_time'] >= 0
+  assert (s['watches'], s['watches_added'], s['watches_removed']) == (1, 1, 0)
+  assert s['add_errors'] == {'ENOENT': 1}
+  assert len(batches) == 1 and batches[0][0] == 2
+
+  # the raw counters are indexed by the STAT_* constants
+  raw = w._read_stats
+  assert raw[inotify.inotify.STAT_EVENTS] == 2
+  assert raw[inotify.inotify.STAT_MASK_BITS + 8] == 1  # IN_CREATE
+  assert inotify.inotify.READ_STATS_SIZE == inotify.inotify.STAT_MASK_BITS + 32
+
+
+def test_watch_table():
+  t = watcher._WatchTable()
+  assert t.add('a/b', 1, inotify.IN_OPEN) and t.add('a/b/c', 2, inotify.IN_OPEN)
+  assert not t.add('x', 1, inotify.IN_CLOSE)
+  assert t.paths(1) == {'a/b', 'x'} and t.mask(1) == inotify.IN_CLOSE
+  assert (t.num_watches(), t.num_paths()) == (2, 3)
+  # the primary path is replaced by the alias when it is removed
+  assert t.remove_path('a/b') == 1 and t.path(1) == 'x'
+  assert t.get('a/b/c') == 2 and t.get('a/b') == -1 and t.get('a') == -1
+  # moving onto a watched path takes that path away from its watch
+  t.add('y/z', 3, inotify.IN_OPEN)
+  t.move('a', 'y')
+  assert t.get('y/b/c') == 2 and t.path(3) is None and t.has_watch(3)
+  assert sorted(t.all_paths()) == ['x', 'y/b/c']
+  t.remove(2)
+  t.remove(3)
+  assert not t.has_watch(2) and list(t.wds()) == [1]
+  assert sorted(t.subtree('')) == [] and t.subtree('x') == [('x', 1)]
+  # freed nodes are reused
+  nodes = len(t._name)
+  t.add('p/q', 4, inotify.IN_OPEN)
+  assert len(t._name) == nodes
+  # a move only drops the cached paths of the moved subtree
+  t.add('p/q/r', 5, inotify.IN_OPEN)
+  x, q, r = t.path(1), t.path(4), t.path(5)
+  t.move('p/q', 'p/s')
+  assert t.path(1) is x and t.path(4) == 'p/s' and t.path(5) == 'p/s/r'
+  # the cache is bounded
+  t._PATH_CACHE_SIZE = 2
+  t._path_cache.clear()
+  assert [t.path(wd) for wd in (1, 4, 5)] == ['x', 'p/s', 'p/s/r']
+  assert list(t._path_cache) == [4, 5]
+
+
+def test_watch_budget(w):
+  for d in 'abcd':
+    os.makedirs('testdir/' + d)
+  b = inotify.WatchBudget(w, limit=4, low_water=0.5, poll_interval=0.05)
+  b.add_all('testdir', inotify.IN_CREATE)
+  # five watches exceed the budget, leaf directories are evicted down to two
+  polled = b.polled()
+  assert b.num_watches() == 2 and b.evictions == 3 and len(polled) == 3
+  assert 'testdir' not in polled
+  # the IN_IGNORED events of the evicted watches are not passed on
+  assert b.read(block=False) == []
+  assert w.num_watches() == 2
+  # unchanged directories are not listed again
+  time.sleep(0.06)
+  assert b.read(block=False) == [] and len(b.polled()) == 3
+
+  # let the directory's mtime change
+  time.sleep(0.01)
+  open(polled[0] + '/new', 'w').close()
+  evt, = b.read()
+  assert evt.create and evt.fullpath == polled[0] + '/new'
+  assert b.rearms == 1 and polled[0] not in b.polled()
+  assert w.get_watch(polled[0]).wd == evt.wd
+
+
+def test_watch_budget_unpollable():
+  import errno
+  class Full(watcher.Watcher):
+    def add(self, path, mask):
+      raise OSError(errno.ENOSPC, 'No space left on device', path)
+  b = inotify.WatchBudget(Full(), limit=10)
+  os.mkdir('testdir/sub')
+  # paths that cannot be polled either are skipped
+  assert b.add('testfile', inotify.IN_CREATE) is None
+  assert b.add('missing', inotify.IN_CREATE) is None
+  assert b.add('testdir/sub', inotify.IN_CREATE) is None
+  assert b.polled() == ['testdir/sub']
+  b.close()
+
+def test_save_state(w):
+  for d in ['a', 'a/b', 'c', 'gone']:
+    os.makedirs('testdir/' + d)
+  w.add_all('testdir', inotify.IN_CREATE)
+  w.add('testfile', inotify.IN_MODIFY)
+  fd, state = tempfile.mkstemp()
+  os.close(fd)
+  try:
+    w.save_state(state)
+    time.sleep(0.01)
+    os.rmdir('testdir/gone')
+    os.makedirs('testdir/a/new/sub')
+
+    w2 = watcher.Watcher()
+    try:
+      changed = w2.load_state(state)
+      assert sorted(changed) == ['testdir', 'testdir/a', 'testdir/gone']
+      assert sorted(w2.paths()) == ['testdir', 'testdir/a', 'testdir/a/b',
+        'testdir/a/new', 'testdir/a/new/sub', 'testdir/c', 'testfile']
+      assert w2.get_watch('testfile').mask == inotify.IN_MODIFY
+      assert w2.get_watch('testdir/c').mask == \
+        inotify.IN_CREATE | inotify.IN_ONLYDIR
+    finally:
+      w2.close()
+  finally:
+    os.remove(state)
+
+
+def test_dispatcher(w):
+  import multiprocessing
+  from inotify import dispatch
+  ctx = multiprocessing.get_context('fork')
+  results = ctx.Queue()
+  def handler(evt):
+    if evt.name == 'bad':
+      raise ValueError('bad event')
+    results.put((os.getpid(), evt.fullpath, evt.mask))
+  w.add('.', inotify.IN_CREATE | inotify.IN_CLOSE_WRITE)
+  d = dispatch.Dispatcher(w, handler, workers=3, max_in_flight=2, context=ctx)
+  try:
+    names = ['f%d' % i for i in range(10)]
+    for name in names:
+      open(name, 'w').close()
+    assert d.step(5) == 20
+    assert d.drain(5) and d.handled == d.dispatched == 20
+    got = [results.get(timeout=5) for i in range(20)]
+    pids = {}
+    for pid, path, mask in got:
+      # all events for a path go to one worker, in order
+      assert pids.setdefault(path, pid) == pid
+    for name in names:
+      masks = [m for pid, p, m in got if p == './' + name]
+      assert masks == [inotify.IN_CREATE, inotify.IN_CLOSE_WRITE]
+    assert len(set(pids.values())) > 1
+
+    open('bad', 'w').close()
+    d.step(5)
+    with pytest.raises(inotify.InotifyWatcherException):
+      d.drain(5)
+  finally:
+    d.close()
+
+
+def test_dispatcher_timed_source(w):
+  import multiprocessing
+  from inotify import dispatch
+  from inotify import stages
+  ctx = multiprocessing.get_context('fork')
+  results = ctx.Queue()
+  w.add('.', inotify.IN_CREATE)
+  deb = stages.Debouncer(w, quiet=0.2)
+  d = dispatch.Dispatcher(deb, lambda evt: results.put(evt.name), workers=1,
+                          context=ctx)
+  try:
+    open('held', 'w').close()
+    # the debouncer holds the event back, and releases it without a new
+    # kernel event once it settled
+    assert d.step(5) == 0
+    start = time.time()
+    assert d.step(5) == 1
+    assert time.time() - start < 1
+    assert d.drain(5) and results.get(timeout=5) == 'held'
+  finally:
+    d.close()
+
+def test_dispatcher_busy_and_dead_workers(w):
+  import multiprocessing
+  from inotify import dispatch
+  ctx = multiprocessing.get_context('fork')
+  w.add('.', inotify.IN_CREATE)
+  def slow(evt, started=[]):
+    if not started:
+      started.append(True)
+      time.sleep(1)
+  d = dispatch.Dispatcher(w, slow, workers=1, max_in_flight=100000, context=ctx)
+  try:
+    # far more than fits in the worker's pipe while it is busy
+    for i in range(3000):
+      open('%0100d' % i, 'w').close()
+    start = time.time()
+    read = 0
+    while read < 3000:
+      read += d.step(5)
+    assert time.time() - start < 0.5
+    assert d.drain(10) and d.handled == 3000
+  finally:
+    d.close()
+
+  for name in os.listdir('.'):
+    if name.startswith('0'):
+      os.remove(name)
+  w.read(block=False)
+  results = ctx.Queue()
+  def die(evt):
+    if evt.name == 'die':
+      os._exit(1)
+    results.put(evt.name)
+  errors = []
+  d = dispatch.Dispatcher(w, die, workers=2, max_in_flight=1,
+                          onerror=errors.append, context=ctx)
+  try:
+    names = ['die'] + ['f%d' % i for i in range(20)]
+    for name in names:
+      open(name, 'w').close()
+    d.step(5)
+    assert d.drain(10)
+    assert len(errors) == 1 and 'died with 1 unfinished events' in errors[0]
+    assert sorted(results.get(timeout=5) for i in range(20)) == sorted(names[1:])
+    assert d.handled == 20
+  finally:
+    d.close()
+
+
+def test_journal(w):
+  from inotify import journal
+  w.add('.', inotify.IN_CREATE | inotify.IN_MOVE)
+  w.add('testdir', inotify.IN_CREATE)
+  fd, log = tempfile.mkstemp()
+  os.close(fd)
+  try:
+    j = journal.Journal(w, log)
+    open('a', 'w').close()
+    os.rename('a', 'b')
+    open('testdir/c', 'w').close()
+    live = j.read(block=False)
+    open('d', 'w').close()
+    live += j.read(block=False)
+    assert j.written == 5
+
+    r = journal.JournalReader(log)
+    try:
+      first = r.read()
+      assert [(e.fullpath, e.mask, e.cookie) for e in first] == \
+        [(e.fullpath, e.mask, e.cookie) for e in live[:4]]
+      assert first[2].cookie == live[2].cookie and first[2].moved_to
+      assert r.time <= time.time()
+      assert [e.fullpath for e in r.read()] == ['./d']
+      assert r.read() == []
+      # batches appended later are picked up
+      open('e', 'w').close()
+      j.read(block=False)
+      assert [e.name for e in r] == ['e']
+    finally:
+      r.close()
+    r = journal.JournalReader(log)
+    assert [len(b) for b in r.replay(speed=None)] == [4, 1, 1]
+    r.close()
+  finally:
+    os.remove(log)
+
+
+def test_simulated_backend():
+  from inotify.backend import SimulatedBackend
+  sim = SimulatedBackend(max_queued_events=100)
+  sim.make_tree('root', depth=2, fanout=2, files=1)
+  w = inotify.watcher.AutoWatcher(backend=sim)
+  w.add_all('root', inotify.IN_ALL_EVENTS)
+  assert w.num_watches() == 7
+  assert not w.read(block=False)
+
+  sim.write('root/d0/f0')
+  sim.mkdir('root/d1/new')
+  assert [(e.fullpath, e.mask & ~inotify.IN_ISDIR) for e in w.read(block=False)] == [
+    ('root/d0/f0', inotify.IN_OPEN), ('root/d0/f0', inotify.IN_MODIFY),
+    ('root/d0/f0', inotify.IN_CLOSE_WRITE), ('root/d1/new', inotify.IN_CREATE)]
+  sim.rename('root/d0', 'root/moved')
+  sim.remove('root/d1/d0')
+  events = w.read(block=False)
+  assert [(e.fullpath, e.mask & ~inotify.IN_ISDIR) for e in events[:2]] == [
+    ('root/d0', inotify.IN_MOVED_FROM), ('root/moved', inotify.IN_MOVED_TO)]
+  assert events[0].cookie == events[1].cookie != 0
+  assert w.num_watches() == 7
+  assert w.get_watch('root/moved/d1').paths == {'root/moved/d1'}
+  assert 'root/d1/d0' not in w.paths()
+  assert sim.listdir('root/moved') == ['d0', 'd1', 'f0']
+  assert sim.isdir('root/moved/d1') and sim.exists('root/moved/d1/f0')
+  assert not sim.exists('root/d0') and not sim.exists('root/d0/f0')
+
+  # the queue overflows like the kernel's
+  for i in range(200):
+    sim.create('root/n%d' % i)
+  events = w.read(block=False)
+  assert len(events) == 101 and events[-1].q_overflow
+
+  # a churn is reproducible, and can be read raw
+  counts = []
+  for i in range(2):
+    s = SimulatedBackend(seed=1)
+    s.make_tree('t', depth=1, fanout=4, files=10)
+    rw = inotify.watcher.Watcher(backend=s)
+    rw.add_all('t', inotify.IN_MODIFY | inotify.IN_MOVE)
+    s.churn(1000, renames=0.1)
+    batch = rw.read_raw(block=False)
+    counts.append((len(batch), batch.mask_union))
+    rw.close()
+  assert counts[0] == counts[1] and counts[0][0] > 0
+
+  # queues larger than a pipe's capacity are read completely
+  sim.max_queued_events = 16384
+  for i in range(2000):
+    sim.create('root/moved/m%d' % i)
+  events = w.read(block=False)
+  assert len(events) == 6000 and not w.read(block=False)
+  w.close()
+
+
+def test_bounded_read(w):
+  w.add('testdir', inotify.IN_CREATE)
+  for i in range(100):
+    open('testdir/f%02d' % i, 'w').close()
+  # the kernel returns whole events only, 32 bytes each here
+  assert [e.name for e in w.read(block=False, max_bytes=320)] == \
+    ['f%02d' % i for i in range(10)]
+  evts = w.read(block=False, max_events=5)
+  assert [e.name for e in evts] == ['f%02d' % i for i in range(10, 15)]
+  assert w.timeout() == 0
+  assert evts[0].fullpath == 'testdir/f10'
+  rest = list(w.iter_events(block=False, max_events=7))
+  assert [e.name for e in rest] == ['f%02d' % i for i in range(15, 100)]
+  assert w.timeout() is None and w.read(block=False) == []
+  for bad in (0, -1):
+    with pytest.raises(ValueError):
+      w.read(block=False, max_events=bad)
+    with pytest.raises(ValueError):
+      next(w.iter_events(block=False, max_events=bad))
+
+  from inotify.backend import SimulatedBackend
+  sim = SimulatedBackend()
+  sim.mkdir('root')
+  aw = inotify.watcher.AutoWatcher(backend=sim)
+  aw.add('root', inotify.IN_CREATE)
+  for i in range(5000):
+    sim.create('root/f%d' % i)
+  seen = 0
+  for e in aw.iter_events(block=False, max_bytes=4096):
+    assert len(aw._backlog) == 0 and e.name == 'f%d' % seen
+    seen += 1
+  assert seen == 5000
+  assert aw.stats()['read_syscalls'] > 5000 * 32 // 4096
+
+def test_blocking_iter_events(w):
+  w.add('testdir', inotify.IN_CREATE)
+  def writer():
+    for i in range(3):
+      time.sleep(0.05)
+      open('testdir/f%d' % i, 'w').close()
+  t = threading.Thread(target=writer)
+  t.start()
+  try:
+    # each read finds the queue empty and has to wait for the writer
+    it = w.iter_events()
+    assert [next(it).name for i in range(3)] == ['f0', 'f1', 'f2']
+  finally:
+    t.join()